@@ -0,0 +1,146 @@
+"""Векторная аналитика по пользователям: когорты, блокировки, напоминания.
+
+Поля пользователей один раз выгружаются из строк снапшота в столбцы NumPy
+(даты — номера дней от эпохи, город и язык — коды категорий), дальше всё
+считается через bincount без циклов по пользователям. Удержание берётся
+из карт активности и передаётся в report() готовым.
+"""
+import numpy as np
+
+MISSING = -1
+WEEK = 7
+COHORT_WEEKS = 8
+
+class Columns:
+    """Столбцы полей пользователей"""
+
+    __slots__ = (
+        "size", "joined", "blocked", "blocked_day",
+        "remind", "city", "lang", "cities", "langs",
+    )
+
+def optional_column(values):
+    """Целые значения, None -> MISSING"""
+    column = np.array(values, np.float64)
+    return np.where(np.isnan(column), MISSING, column).astype(np.int64)
+
+def day_column(timestamps):
+    """Номер дня метки времени или MISSING"""
+    column = optional_column(timestamps)
+    return np.where(column == MISSING, MISSING, column // 86400).astype(np.int32)
+
+def category_column(indices, strings):
+    """Коды категорий и список их значений по индексам в таблице строк снапшота"""
+    values, codes = np.unique(optional_column(indices), return_inverse=True)
+    return codes.ravel().astype(np.int16), [None if value == MISSING else strings[value] for value in values]
+
+def load_columns(state, layout):
+    """Столбцы из снимка users_rows (строки, id, кортежи полей).
+
+    Кортежи транспонируются одним проходом zip(*rows); layout — раскладка
+    строки (ROW_LAYOUT в main): порядок полей, маска joined в times и биты flags.
+    """
+    strings, _, rows = state
+    fields = dict(zip(layout["fields"], zip(*rows))) if rows else dict.fromkeys(layout["fields"], ())
+    columns = Columns()
+    columns.size = len(rows)
+    flags = np.array(fields["flags"], np.int64)
+    times = np.array(fields["times"], np.uint64)
+    joined = (times & np.uint64(layout["ts_mask"])).astype(np.int64) // 86400
+    columns.joined = np.where(flags & layout["joined"], joined, MISSING).astype(np.int32)
+    columns.blocked = (flags & layout["blocked"]) != 0
+    columns.blocked_day = day_column(fields["blocked_date"])
+    columns.remind = optional_column(fields["remind_min"]).astype(np.int32)
+    columns.city, columns.cities = category_column(fields["city"], strings)
+    columns.lang, columns.langs = category_column(fields["lang"], strings)
+    return columns
+
+def weekly_cohorts(columns, today, weeks=COHORT_WEEKS):
+    """Номер недельной когорты (0 — самая старая, weeks - 1 — последние 7 дней) или MISSING"""
+    age = (today - columns.joined) // WEEK
+    cohort = weeks - 1 - age
+    cohort[(columns.joined == MISSING) | (cohort < 0) | (age < 0)] = MISSING
+    return cohort
+
+def block_rate(groups, blocked, size):
+    """(число пользователей, число заблокировавших) по кодам групп 0..size-1"""
+    valid = groups != MISSING
+    totals = np.bincount(groups[valid], minlength=size)
+    blocks = np.bincount(groups[valid], weights=blocked[valid], minlength=size).astype(np.int64)
+    return totals, blocks
+
+def weekly_blocks(columns, today, weeks=COHORT_WEEKS):
+    """Блокировки по неделям даты блокировки (0 — самая старая неделя).
+
+    Возвращает (число блокировок, число зарегистрированных к концу недели).
+    """
+    age = (today - columns.blocked_day) // WEEK
+    week = weeks - 1 - age
+    valid = (columns.blocked_day != MISSING) & (week >= 0) & (age >= 0)
+    counts = np.bincount(week[valid], minlength=weeks)
+    week_ends = today - (weeks - 1 - np.arange(weeks)) * WEEK
+    # Без даты регистрации (MISSING) пользователь считается старым
+    registered = np.searchsorted(np.sort(columns.joined), week_ends, side="right")
+    return counts, registered
+
+def reminder_distribution(columns):
+    """(значения remind_min, таблица город × значение)"""
+    values, inverse = np.unique(columns.remind, return_inverse=True)
+    table = np.bincount(
+        columns.city.astype(np.int64) * len(values) + inverse.ravel(),
+        minlength=len(columns.cities) * len(values),
+    ).reshape(len(columns.cities), len(values))
+    return values, table
+
+def percent(part, total):
+    return f"{part / total:.0%}" if total else "—"
+
+def report(columns, today, city_name=str, weeks=COHORT_WEEKS, retention=()):
+    """Текстовый отчёт для админа (моноширинный).
+
+    retention — [(n, размер когорт, вернулись на день n)] по картам активности.
+    """
+    lines = [f"Пользователей: {columns.size}", ""]
+
+    if retention:
+        lines.append("Удержание по картам активности (когорты по дням регистрации):")
+        for n, size, returned in retention:
+            lines.append(f"  День {n}: {percent(returned, size)} ({returned}/{size})")
+        lines.append("")
+
+    totals, blocks = block_rate(weekly_cohorts(columns, today, weeks), columns.blocked, weeks)
+    lines.append("Недельные когорты регистрации:")
+    lines.append("Когорта  Кол-во Блок")
+    for cohort in range(weeks):
+        start = today - (weeks - 1 - cohort) * WEEK - (WEEK - 1)
+        label = np.datetime64(int(start), "D").item().strftime("%d.%m")
+        lines.append(f"{label:<8} {totals[cohort]:>6} {percent(blocks[cohort], totals[cohort]):>4}")
+    lines.append("")
+
+    counts, registered = weekly_blocks(columns, today, weeks)
+    lines.append("Блокировки по неделям (по дате блокировки):")
+    for week in range(weeks):
+        start = today - (weeks - 1 - week) * WEEK - (WEEK - 1)
+        label = np.datetime64(int(start), "D").item().strftime("%d.%m")
+        lines.append(f"  {label}: {counts[week]} ({percent(counts[week], registered[week])})")
+    lines.append("")
+
+    totals, blocks = block_rate(columns.city, columns.blocked, len(columns.cities))
+    lines.append("Блокировки по городам:")
+    for code in np.argsort(-totals):
+        name = city_name(columns.cities[code]) if columns.cities[code] else "—"
+        lines.append(f"  {name}: {blocks[code]}/{totals[code]} ({percent(blocks[code], totals[code])})")
+    lines.append("")
+
+    values, table = reminder_distribution(columns)
+    lines.append("Напоминания (мин) по городам:")
+    for code in np.argsort(-table.sum(axis=1)):
+        name = city_name(columns.cities[code]) if columns.cities[code] else "—"
+        row = table[code]
+        total = row.sum()
+        cells = ", ".join(
+            f"{'нет' if value == MISSING else value}: {percent(count, total)}"
+            for value, count in zip(values, row) if count
+        )
+        lines.append(f"  {name}: {cells}")
+    return "\n".join(lines)
@@ -0,0 +1,216 @@
+"""Замеры хранения пользователей на синтетических данных.
+
+    python bench.py [--users N] [--repeat N]
+
+Сравнивает память на пользователя в dict и в UserRecord, запись и чтение
+users.json и бинарного снапшота и считает, сколько записей на диск дают
+частые save_users() при слиянии сохранений; для расписаний — время
+scan() по каталогу сезонов и скорость get() по дате.
+Данные пишутся во временный DATA_DIR, боевые файлы не трогаются.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+CITIES = ("tashkent", "bremen")
+LANGS = ("uz", "ru")
+REMIND_CHOICES = (5, 10, 15)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Замеры хранения пользователей")
+    parser.add_argument("--users", type=int, default=50000, help="число синтетических пользователей")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов каждого замера (берётся лучший)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+def import_bot():
+    """Импортирует main с временным DATA_DIR"""
+    data_dir = tempfile.mkdtemp(prefix="ramadan-bench-")
+    os.environ["DATA_DIR"] = data_dir
+    os.environ.setdefault("LOG_FORMAT", "text")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    return main, data_dir
+
+def user_dicts(count, seed):
+    """Пользователи в том виде, в каком они лежат в users.json"""
+    rng = random.Random(seed)
+    data = {}
+    for i in range(count):
+        user = {
+            "lang": rng.choice(LANGS),
+            "city": rng.choice(CITIES),
+            "remind_min": rng.choice(REMIND_CHOICES),
+            "first_name": f"Имя{i}",
+            "username": f"user{i}" if i % 3 else None,
+            "joined": f"2026-02-{1 + i % 28:02d} 12:{i % 60:02d}:00",
+            "last_active": f"2026-03-{1 + i % 9:02d} 12:00:00",
+            "push_sent": False,
+        }
+        if i % 10 == 0:
+            user["is_blocked"] = True
+            user["blocked_date"] = "2026-03-01 10:00:00"
+        for day in range(19, 19 + rng.randrange(10)):
+            user[f"suhoor_congrats_sent_2026-02-{day}"] = True
+            user[f"iftar_congrats_sent_2026-02-{day}"] = True
+        data[str(100000000 + i)] = user
+    return data
+
+def best_of(repeat, func):
+    """Лучшее время из repeat запусков, с"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+def traced_size(build):
+    """Память, которую занимает результат build(), байт"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+def bench_memory(main, text):
+    """Память на пользователя: dict из json.loads против UserRecord"""
+    raw = json.loads(text)
+    dict_size = traced_size(lambda: json.loads(text))
+    record_size = traced_size(lambda: {uid: main.UserRecord(data) for uid, data in raw.items()})
+    count = len(raw)
+    print(
+        f"Память на пользователя: dict {dict_size / count:.0f} Б, UserRecord {record_size / count:.0f} Б "
+        f"({dict_size / record_size:.1f}×)"
+    )
+
+def bench_files(main, users, repeat):
+    """Запись и чтение users.json и снапшота"""
+    state = main.users_rows(users)
+    json_time = best_of(repeat, lambda: main.write_users_json(state))
+    snap_time = best_of(repeat, lambda: main.write_snapshot(main.USERS_SNAPSHOT_FILE, main.encode_users_rows(state)))
+
+    def load_json():
+        with open(main.USERS_FILE, "r", encoding="utf-8") as f:
+            return {uid: main.UserRecord(data) for uid, data in json.load(f).items()}
+
+    json_load = best_of(repeat, load_json)
+    snap_load = best_of(repeat, lambda: main.decode_users_snapshot(main.read_snapshot(main.USERS_SNAPSHOT_FILE)))
+    snapshot_time = best_of(repeat, lambda: main.users_rows(users))
+    stall = max(asyncio.run(loop_stall(main.users_rows_chunked(users))) for _ in range(repeat))
+
+    print(f"Пользователей: {len(users):,}")
+    print(f"{'':<22}{'запись, с':>12}{'чтение, с':>12}{'размер, КБ':>12}")
+    print(f"{'users.json':<22}{json_time:>12.3f}{json_load:>12.3f}{os.path.getsize(main.USERS_FILE) / 1024:>12,.0f}")
+    print(
+        f"{'снапшот':<22}{snap_time:>12.3f}{snap_load:>12.3f}"
+        f"{os.path.getsize(main.USERS_SNAPSHOT_FILE) / 1024:>12,.0f}"
+    )
+    print(
+        f"Снимок целиком: {snapshot_time * 1000:.1f} мс; пачками по {main.USERS_SNAPSHOT_CHUNK}: "
+        f"цикл событий занят подряд не дольше {stall * 1000:.1f} мс"
+    )
+
+async def loop_stall(coro):
+    """Самый долгий непрерывный шаг цикла событий, пока выполняется coro, с"""
+    longest = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal longest
+        last = time.perf_counter()
+        while not done:
+            await asyncio.sleep(0)
+            now = time.perf_counter()
+            longest = max(longest, now - last)
+            last = now
+
+    tick = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0)
+    await coro
+    done = True
+    await tick
+    return longest
+
+def bench_coalescing(main, calls):
+    """Сколько записей на диск дают calls вызовов save_users() подряд"""
+    writes = []
+    write_users_files = main.write_users_files
+
+    def counting_write(state):
+        writes.append(time.perf_counter())
+        write_users_files(state)
+
+    main.write_users_files = counting_write
+
+    async def burst():
+        started = time.perf_counter()
+        for _ in range(calls):
+            main.save_users()
+            await asyncio.sleep(0)
+        blocked = time.perf_counter() - started
+        await main.flush_saves()
+        return blocked
+
+    try:
+        blocked = asyncio.run(burst())
+    finally:
+        main.write_users_files = write_users_files
+    print(f"save_users() × {calls}: записей на диск {len(writes)}, цикл занят {blocked * 1000:.1f} мс")
+
+def bench_timetable(main, seasons, lookups):
+    """scan() по seasons файлам сезонов и lookups вызовов get()"""
+    city_dir = os.path.join(main.DATA_DIR, "timetables", "bremen")
+    os.makedirs(city_dir, exist_ok=True)
+    first = date(2026, 2, 19)
+    for year in range(seasons):
+        start = first.replace(year=first.year + year)
+        with open(os.path.join(city_dir, f"{start}.json"), "w", encoding="utf-8") as f:
+            json.dump({"start": start.isoformat(), "suhoor": ["05:00"] * 30, "iftar": ["18:00"] * 30}, f)
+
+    timetable = main.CityTimetable("bremen")
+    scan_time = best_of(5, timetable.scan)
+    timetable.apply(*timetable.scan())
+    timetable.add(timetable.read(timetable.starts[0]))
+    days = [(first + timedelta(days=i % 30)).isoformat() for i in range(lookups)]
+
+    def lookup():
+        for day in days:
+            timetable.get(day)
+
+    get_time = best_of(3, lookup)
+    print(
+        f"Расписание: scan() по {seasons} сезонам {scan_time * 1000:.2f} мс, "
+        f"get() {lookups / get_time:,.0f} в секунду"
+    )
+
+def main_cli():
+    args = parse_args()
+    main, data_dir = import_bot()
+    try:
+        data = user_dicts(args.users, args.seed)
+        bench_memory(main, json.dumps(data, ensure_ascii=False))
+        main.users.clear()
+        main.users.update({uid: main.UserRecord(user) for uid, user in data.items()})
+        del data
+        bench_files(main, main.users, args.repeat)
+        bench_coalescing(main, 1000)
+        bench_timetable(main, 30, 100000)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,32 +1,180 @@
 import logging
 import json
+import marshal
+import math
+import queue
 import os
+import signal
+import struct
+import sys
+import time
 import asyncio
-from datetime import datetime, timedelta
+import atexit
+import csv
+import html
+import inspect
+import tempfile
+import threading
+import tracemalloc
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time as dt_time, timedelta
+from functools import wraps
+from io import BytesIO, StringIO
+from logging.handlers import QueueHandler, QueueListener
 from zoneinfo import ZoneInfo
 from threading import Lock
 
-from telegram import BotCommand, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    BotCommand,
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    KeyboardButton,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+)
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
+    InlineQueryHandler,
+    ExtBot,
     MessageHandler,
     filters,
 )
-from telegram.error import Forbidden
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 from translations import TEXTS
 
+try:
+    import analytics
+except ImportError:
+    # Аналитика требует numpy; без него бот работает, отчёт недоступен
+    analytics = None
+
 # ---------------- CONFIG ----------------
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = 1265652628
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# ---------------- LOGGING ----------------
+# Логи пишутся через очередь: обработчики в цикле событий только кладут
+# запись в SimpleQueue, форматирование и запись делает поток QueueListener.
+# LOG_FORMAT=text (по умолчанию) — прежний формат, json — по строке JSON на запись.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# Массовые события: подробно логируем первые LOG_SAMPLE_FIRST и каждое
+# LOG_SAMPLE_EVERY-е за тик, остальное — в сводке
+LOG_SAMPLE_FIRST = 3
+LOG_SAMPLE_EVERY = 1000
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON (поля из extra={"fields": ...})"""
+
+    def format(self, record):
+        data = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            data.update(fields)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+def setup_logging():
+    """Подключает очередь логов к корневому логгеру"""
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers[:] = [QueueHandler(log_queue)]
+    
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+
+class EventLog:
+    """Счётчики массовых событий: выборочные подробные записи и сводка за тик"""
+
+    def __init__(self):
+        # (вид, ключ) -> [количество, время первого, время последнего]
+        self.counts = {}
+
+    def record(self, kind, key, message, *args, level=logging.INFO, **fields):
+        now = time.monotonic()
+        entry = self.counts.get((kind, key))
+        if entry is None:
+            entry = self.counts[(kind, key)] = [0, now, now]
+        entry[0] += 1
+        entry[2] = now
+        if entry[0] <= LOG_SAMPLE_FIRST or entry[0] % LOG_SAMPLE_EVERY == 0:
+            logging.log(level, message, *args, extra={"fields": {"kind": kind, "n": entry[0], **fields}})
+
+    def flush(self):
+        """Пишет сводку по всем событиям с прошлого сброса"""
+        for (kind, key), (count, first, last) in sorted(self.counts.items()):
+            logging.info(
+                "📊 %s %s: %s за %.1fс", kind, " ".join(key), f"{count:,}", last - first,
+                extra={"fields": {"kind": kind, "summary": True, "key": list(key), "count": count, "seconds": round(last - first, 3)}}
+            )
+        self.counts.clear()
+
+event_log = EventLog()
+
+# ---------------- CLOCK ----------------
+# Всё «текущее время» бота берётся из clock: в работе это системные часы,
+# а в simulate.py — виртуальные, которые можно прокручивать вперёд.
+class Clock:
+    """Системные часы"""
+
+    def time(self):
+        return time.time()
+
+    def now(self, tz=None):
+        return datetime.now(tz)
+
+class SimulatedClock(Clock):
+    """Виртуальные часы: время меняется только через set/advance"""
+
+    def __init__(self, ts):
+        self.ts = float(ts)
+
+    def time(self):
+        return self.ts
+
+    def now(self, tz=None):
+        return datetime.fromtimestamp(self.ts, tz)
+
+    def set(self, ts):
+        self.ts = max(self.ts, float(ts))
+
+    def advance(self, seconds):
+        self.ts += seconds
+
+clock = Clock()
+
+def set_clock(new_clock):
+    """Подменяет источник времени (для симуляции)"""
+    global clock
+    clock = new_clock
 
 # ---------------- CONSTANTS ----------------
 ONBOARD_LANG = "onb_lang"
@@ -36,6 +184,27 @@ BROADCAST_PREVIEW = "broadcast_preview"
 
 LATE_WINDOW_SECONDS = 120
 
+# Что делать с напоминаниями, время которых прошло, пока бот был выключен:
+#   "skip"   — не отправлять
+#   "before" — отправить, если само событие (сухур/ифтар) ещё не наступило
+#   "all"    — отправить все пропущенные за текущий день
+REMINDER_CATCHUP = os.getenv("REMINDER_CATCHUP", "before")
+
+# Общий бюджет исходящих запросов (сообщений в секунду) и веса полос.
+# Полоса broadcast дополнительно ждёт, пока не опустеет очередь reminder.
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "25"))
+LANE_WEIGHTS = {"interactive": 6, "reminder": 3, "broadcast": 1}
+LANE_POOL_SIZES = {"interactive": 8, "reminder": 16, "broadcast": 4}
+OUTBOUND_MAX_RETRIES = 3
+
+# Сколько апдейтов обрабатывается одновременно (апдейты одного чата — строго по очереди)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+BLOCK_CHECK_PROGRESS_EVERY = 200
+
+# Квитанции рассылок сбрасываются на диск пачками
+RECEIPTS_FLUSH_EVERY = 500
+BROADCAST_JOB_PROGRESS_EVERY = 50
+
 # ---------------- PATHS ----------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.getenv("DATA_DIR", "/data")
@@ -43,6 +212,675 @@ os.makedirs(DATA_DIR, exist_ok=True)
 
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
 TRACKER_FILE = os.path.join(DATA_DIR, "tracker.json")
+USERS_SNAPSHOT_FILE = os.path.join(DATA_DIR, "users.snap")
+TRACKER_SNAPSHOT_FILE = os.path.join(DATA_DIR, "tracker.snap")
+SCHEDULE_FILE = os.path.join(DATA_DIR, "schedule.snap")
+RECOVERY_FILE = os.path.join(DATA_DIR, "recovery.json")
+DAILY_STATS_FILE = os.path.join(DATA_DIR, "daily_stats.jsonl")
+# Сезоны расписаний: поставляемые с кодом и добавленные на сервере без деплоя
+TIMETABLE_DIRS = (os.path.join(BASE_DIR, "timetables"), os.path.join(DATA_DIR, "timetables"))
+ARCHIVE_FILE = os.path.join(DATA_DIR, "archive.snap")
+ACTIVITY_DIR = os.path.join(DATA_DIR, "activity")
+BROADCASTS_DIR = os.path.join(DATA_DIR, "broadcasts")
+os.makedirs(BROADCASTS_DIR, exist_ok=True)
+
+# ---------------- USER MODEL ----------------
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+CONGRATS_MARKER = "_congrats_sent_"
+
+def ts_to_int(value):
+    """Переводит строку времени (Ташкент) в целое число секунд; None для некорректной.
+
+    Метки с часовым поясом приводятся к ташкентскому времени; значения вне
+    0..TS_MASK (до 1970 года или после 2106-го) не помещаются в 32 бита
+    упакованных times и отбрасываются.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, int):
+        try:
+            moment = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            logging.warning(f"Некорректная метка времени {value!r}, поле пропущено")
+            return None
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(ZoneInfo("Asia/Tashkent")).replace(tzinfo=None)
+        value = int((moment - datetime(1970, 1, 1)).total_seconds())
+    if not 0 <= value <= TS_MASK:
+        logging.warning(f"Метка времени {value!r} вне 32-битного диапазона, поле пропущено")
+        return None
+    return value
+
+def ts_to_str(value):
+    """Переводит целое число секунд обратно в строку времени"""
+    if value is None:
+        return None
+    return time.strftime(TS_FORMAT, time.gmtime(value))
+
+# Имена: байт состояний (по 2 бита на имя: 0 — нет, 1 — None, 2 — значение),
+# длина first_name и UTF-8 байты обоих имён подряд
+NAMES_HEADER = struct.Struct("<BH")
+NAME_ABSENT, NAME_NONE, NAME_VALUE = 0, 1, 2
+# Биты flags: наличие и значение push_sent/is_blocked, наличие joined/last_active
+FLAG_PUSH_SET, FLAG_PUSH, FLAG_BLOCKED_SET, FLAG_BLOCKED = 1, 2, 4, 8
+FLAG_JOINED, FLAG_LAST_ACTIVE = 16, 32
+TS_MASK = 0xFFFFFFFF
+# Дни последних поздравлений (ординалы дат) по 20 бит в одном целом, 0 — не было
+CONGRATS_BITS = 20
+CONGRATS_MASK = (1 << CONGRATS_BITS) - 1
+
+class UserRecord:
+    """Компактная запись пользователя с dict-подобным доступом.
+
+    Поля хранятся в __slots__, lang/city интернируются, оба имени — одной
+    строкой UTF-8 байт, joined и last_active — одним целым (по 32 бита),
+    push_sent/is_blocked — битами flags, флаги поздравлений — номерами дней
+    последней отправки в одном целом.
+    Отсутствующее поле — как отсутствующий ключ в dict; поле, явно
+    записанное как None, возвращается как None (для имён это хранится
+    в names, для остальных — ключом со значением None в extra).
+    """
+
+    __slots__ = (
+        "lang", "city", "remind_min", "names", "times", "flags",
+        "blocked_date", "unblocked_date", "congrats", "extra",
+    )
+
+    FIELDS = (
+        "lang", "city", "remind_min", "first_name", "username",
+        "joined", "last_active", "push_sent", "is_blocked",
+        "blocked_date", "unblocked_date",
+    )
+    PLAIN_FIELDS = frozenset({"remind_min", "push_sent", "is_blocked"})
+    NAME_FIELDS = ("first_name", "username")
+    INTERNED_FIELDS = frozenset({"lang", "city"})
+    TS_FIELDS = frozenset({"joined", "last_active", "blocked_date", "unblocked_date"})
+    CONGRATS_EVENTS = ("suhoor", "iftar")
+
+    def __init__(self, data=None, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.times = 0
+        self.flags = 0
+        self.congrats = 0
+        if data:
+            self.update(data)
+        if kwargs:
+            self.update(kwargs)
+
+    # --- упакованные поля ---
+
+    def _names(self):
+        """((состояние, байты) first_name, (состояние, байты) username)"""
+        if self.names is None:
+            return (NAME_ABSENT, None), (NAME_ABSENT, None)
+        states, first_len = NAMES_HEADER.unpack_from(self.names)
+        body = self.names[NAMES_HEADER.size:]
+        return (states & 3, body[:first_len]), (states >> 2, body[first_len:])
+
+    def _set_name(self, index, value):
+        names = list(self._names())
+        if value is None:
+            names[index] = (NAME_NONE, None)
+        else:
+            names[index] = (NAME_VALUE, value.encode("utf-8") if isinstance(value, str) else value)
+        (first_state, first), (user_state, user) = names
+        if first_state == NAME_ABSENT and user_state == NAME_ABSENT:
+            self.names = None
+            return
+        first, user = first or b"", user or b""
+        self.names = NAMES_HEADER.pack(first_state | user_state << 2, len(first)) + first + user
+
+    def _name(self, index):
+        state, value = self._names()[index]
+        if state == NAME_VALUE:
+            return value.decode("utf-8")
+        return None
+
+    @property
+    def first_name(self):
+        return self._name(0)
+
+    @property
+    def username(self):
+        return self._name(1)
+
+    @property
+    def joined(self):
+        return self.times & TS_MASK if self.flags & FLAG_JOINED else None
+
+    @joined.setter
+    def joined(self, value):
+        if value is None:
+            self.times &= ~TS_MASK
+            self.flags &= ~FLAG_JOINED
+        else:
+            self.times = (self.times & ~TS_MASK) | value
+            self.flags |= FLAG_JOINED
+
+    @property
+    def last_active(self):
+        return self.times >> 32 if self.flags & FLAG_LAST_ACTIVE else None
+
+    @last_active.setter
+    def last_active(self, value):
+        if value is None:
+            self.times &= TS_MASK
+            self.flags &= ~FLAG_LAST_ACTIVE
+        else:
+            self.times = (self.times & TS_MASK) | value << 32
+            self.flags |= FLAG_LAST_ACTIVE
+
+    def _get_bool(self, is_set, bit):
+        return bool(self.flags & bit) if self.flags & is_set else None
+
+    def _set_bool(self, is_set, bit, value):
+        if value is None:
+            self.flags &= ~(is_set | bit)
+        else:
+            self.flags = (self.flags | is_set) & ~bit | (bit if value else 0)
+
+    @property
+    def push_sent(self):
+        return self._get_bool(FLAG_PUSH_SET, FLAG_PUSH)
+
+    @push_sent.setter
+    def push_sent(self, value):
+        self._set_bool(FLAG_PUSH_SET, FLAG_PUSH, value)
+
+    @property
+    def is_blocked(self):
+        return self._get_bool(FLAG_BLOCKED_SET, FLAG_BLOCKED)
+
+    @is_blocked.setter
+    def is_blocked(self, value):
+        self._set_bool(FLAG_BLOCKED_SET, FLAG_BLOCKED, value)
+
+    def _get_congrats(self, index):
+        day = self.congrats >> (index * CONGRATS_BITS) & CONGRATS_MASK
+        return day or None
+
+    def _set_congrats(self, index, value):
+        shift = index * CONGRATS_BITS
+        self.congrats = self.congrats & ~(CONGRATS_MASK << shift) | (value or 0) << shift
+
+    @property
+    def suhoor_congrats(self):
+        return self._get_congrats(0)
+
+    @suhoor_congrats.setter
+    def suhoor_congrats(self, value):
+        self._set_congrats(0, value)
+
+    @property
+    def iftar_congrats(self):
+        return self._get_congrats(1)
+
+    @iftar_congrats.setter
+    def iftar_congrats(self, value):
+        self._set_congrats(1, value)
+
+    # --- dict-подобный доступ ---
+
+    def _explicit_none(self, key):
+        return self.extra is not None and key in self.extra and self.extra[key] is None
+
+    def _mark_none(self, key, is_none):
+        """Запоминает (или забывает), что поле явно записано как None"""
+        if is_none:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = None
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __getitem__(self, key):
+        if key in self.NAME_FIELDS:
+            state, value = self._names()[self.NAME_FIELDS.index(key)]
+            if state == NAME_ABSENT:
+                raise KeyError(key)
+            return value.decode("utf-8") if state == NAME_VALUE else None
+        if key in self.PLAIN_FIELDS or key in self.INTERNED_FIELDS:
+            value = getattr(self, key)
+        elif key in self.TS_FIELDS:
+            value = ts_to_str(getattr(self, key))
+        elif CONGRATS_MARKER in key and key.partition(CONGRATS_MARKER)[0] in self.CONGRATS_EVENTS:
+            event, _, day = key.partition(CONGRATS_MARKER)
+            sent = getattr(self, f"{event}_congrats")
+            value = True if sent is not None and sent == date.fromisoformat(day).toordinal() else None
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        else:
+            raise KeyError(key)
+
+        if value is None:
+            if self._explicit_none(key):
+                return None
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.NAME_FIELDS:
+            self._set_name(self.NAME_FIELDS.index(key), value)
+        elif key in self.PLAIN_FIELDS:
+            setattr(self, key, value)
+            self._mark_none(key, value is None)
+        elif key in self.INTERNED_FIELDS:
+            setattr(self, key, sys.intern(value) if isinstance(value, str) else value)
+            self._mark_none(key, value is None)
+        elif key in self.TS_FIELDS:
+            converted = ts_to_int(value)
+            setattr(self, key, converted)
+            # Некорректная дата считается отсутствующей, а не явным None
+            self._mark_none(key, value is None)
+        elif CONGRATS_MARKER in key and key.partition(CONGRATS_MARKER)[0] in self.CONGRATS_EVENTS:
+            event, _, day = key.partition(CONGRATS_MARKER)
+            attr = f"{event}_congrats"
+            if value:
+                sent = date.fromisoformat(day).toordinal()
+                current = getattr(self, attr)
+                setattr(self, attr, sent if current is None else max(current, sent))
+            else:
+                setattr(self, attr, None)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def update(self, data=(), **kwargs):
+        items = data.items() if hasattr(data, "items") else data
+        for key, value in items:
+            self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def items(self):
+        extra = self.extra
+        for name in self.FIELDS:
+            try:
+                value = self[name]
+            except KeyError:
+                continue
+            if value is None and name not in self.NAME_FIELDS:
+                # Явный None отдаётся вместе с остальным extra
+                continue
+            yield name, value
+        for event in self.CONGRATS_EVENTS:
+            sent = getattr(self, f"{event}_congrats")
+            if sent is not None:
+                yield f"{event}{CONGRATS_MARKER}{date.fromordinal(sent).isoformat()}", True
+        if extra:
+            yield from extra.items()
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return f"UserRecord({self.to_dict()!r})"
+
+    def to_row(self, intern_string):
+        """Кортеж полей для снапшота (lang/city — индексы в таблице строк)"""
+        return (
+            intern_string(self.lang) if self.lang is not None else None,
+            intern_string(self.city) if self.city is not None else None,
+            self.remind_min, self.names, self.times, self.flags,
+            self.blocked_date, self.unblocked_date, self.congrats, self.extra,
+        )
+
+    @classmethod
+    def from_row(cls, row, strings):
+        record = cls.__new__(cls)
+        (
+            lang, city, record.remind_min, record.names, record.times, record.flags,
+            record.blocked_date, record.unblocked_date, record.congrats, record.extra,
+        ) = row
+        record.lang = strings[lang] if lang is not None else None
+        record.city = strings[city] if city is not None else None
+        return record
+
+# Раскладка строки снапшота (UserRecord.to_row) для analytics.load_columns
+ROW_LAYOUT = {
+    "fields": UserRecord.__slots__,
+    "ts_mask": TS_MASK,
+    "joined": FLAG_JOINED,
+    "blocked": FLAG_BLOCKED,
+}
+
+def user_json_default(obj):
+    """Хук json.dump для сериализации UserRecord"""
+    if isinstance(obj, UserRecord):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# ---------------- AUDIENCE INDEX ----------------
+class AudienceIndex:
+    """Индексы пользователей по городу, языку, напоминанию, дню активности и блокировке.
+
+    Позволяют мгновенно считать и выбирать аудиторию рассылки, перебирая
+    только подходящих пользователей.
+    """
+
+    def __init__(self):
+        self.by_city = {}
+        self.by_lang = {}
+        self.by_remind = {}
+        self.by_active_day = {}
+        self.blocked = set()
+        self.all = set()
+        # uid -> (city, lang, remind_min, active_day, is_blocked), под которыми он проиндексирован
+        self._keys = {}
+
+    @staticmethod
+    def _bucket_add(buckets, key, uid):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = set()
+        bucket.add(uid)
+
+    @staticmethod
+    def _bucket_discard(buckets, key, uid):
+        bucket = buckets.get(key)
+        if bucket is not None:
+            bucket.discard(uid)
+            if not bucket:
+                del buckets[key]
+
+    def add(self, uid, user):
+        """Добавляет или переиндексирует пользователя"""
+        active_day = user.last_active // 86400 if user.last_active is not None else None
+        key = (user.city, user.lang, user.remind_min, active_day, bool(user.is_blocked))
+        old = self._keys.get(uid)
+        if old == key:
+            return
+        if old is not None:
+            self.remove(uid)
+
+        self._keys[uid] = key
+        self.all.add(uid)
+        self._bucket_add(self.by_city, key[0], uid)
+        self._bucket_add(self.by_lang, key[1], uid)
+        self._bucket_add(self.by_remind, key[2], uid)
+        self._bucket_add(self.by_active_day, key[3], uid)
+        if key[4]:
+            self.blocked.add(uid)
+
+    def remove(self, uid):
+        key = self._keys.pop(uid, None)
+        if key is None:
+            return
+        self.all.discard(uid)
+        self._bucket_discard(self.by_city, key[0], uid)
+        self._bucket_discard(self.by_lang, key[1], uid)
+        self._bucket_discard(self.by_remind, key[2], uid)
+        self._bucket_discard(self.by_active_day, key[3], uid)
+        self.blocked.discard(uid)
+
+    def rebuild(self, data):
+        self.__init__()
+        for uid, user in data.items():
+            self.add(uid, user)
+
+    def select(self, segment):
+        """Возвращает множество uid, подходящих под сегмент рассылки"""
+        sets = []
+        if segment.get("city"):
+            sets.append(self.by_city.get(segment["city"], set()))
+        if segment.get("lang"):
+            sets.append(self.by_lang.get(segment["lang"], set()))
+        if segment.get("remind"):
+            sets.append(self.by_remind.get(segment["remind"], set()))
+        if segment.get("active_days"):
+            today = ts_to_int(clock.now(ZoneInfo("Asia/Tashkent")).strftime(TS_FORMAT)) // 86400
+            window = set()
+            for day in range(today - segment["active_days"] + 1, today + 1):
+                window |= self.by_active_day.get(day, set())
+            sets.append(window)
+
+        if sets:
+            sets.sort(key=len)
+            result = sets[0].intersection(*sets[1:])
+        else:
+            result = set(self.all)
+
+        if not segment.get("include_blocked"):
+            result -= self.blocked
+        return result
+
+# ---------------- SNAPSHOTS ----------------
+# Бинарный снапшот: заголовок + секции с префиксом длины.
+# Каждая секция — marshal-данные; значения lang/city хранятся один раз
+# в таблице строк, записи пользователей — кортежами полей UserRecord.
+SNAPSHOT_MAGIC = b"RBSN"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sHHI")
+SNAPSHOT_SECTION = struct.Struct("<I")
+
+def write_snapshot(path, sections, compress=False):
+    """Атомарно записывает секции снапшота в файл (при compress — сжатые zlib); True при успехе"""
+    temp_file = f"{path}.tmp"
+    try:
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, marshal.version, len(sections))]
+        for section in sections:
+            parts.append(SNAPSHOT_SECTION.pack(len(section)))
+            parts.append(section)
+        with open(temp_file, "wb") as f:
+            if compress:
+                f.write(zlib.compress(b"".join(parts), 6))
+            else:
+                f.writelines(parts)
+            fsync_file(f)
+        os.replace(temp_file, path)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка сохранения снапшота {path}: {e}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return False
+
+def read_snapshot(path, newer_than=None, compressed=False):
+    """Читает секции снапшота или возвращает None, если он устарел или повреждён"""
+    if not os.path.exists(path):
+        return None
+    if newer_than and os.path.exists(newer_than) and os.path.getmtime(path) < os.path.getmtime(newer_than):
+        logging.info(f"Снапшот {path} старше {newer_than}, используем JSON")
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        if compressed:
+            data = zlib.decompress(data)
+        magic, version, marshal_version, count = SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or marshal_version > marshal.version:
+            logging.warning(f"Несовместимый снапшот {path}, используем JSON")
+            return None
+
+        sections = []
+        offset = SNAPSHOT_HEADER.size
+        view = memoryview(data)
+        for _ in range(count):
+            (length,) = SNAPSHOT_SECTION.unpack_from(data, offset)
+            offset += SNAPSHOT_SECTION.size
+            if offset + length > len(data):
+                raise ValueError("обрезанная секция")
+            sections.append(marshal.loads(view[offset:offset + length]))
+            offset += length
+        return sections
+    except Exception as e:
+        logging.error(f"Ошибка чтения снапшота {path}: {e}")
+        return None
+
+def users_row_builder():
+    """Таблица строк снимка и функция, превращающая запись в неизменяемый кортеж"""
+    strings = []
+    string_index = {}
+
+    def intern_string(value):
+        idx = string_index.get(value)
+        if idx is None:
+            idx = string_index[value] = len(strings)
+            strings.append(value)
+        return idx
+
+    def build(user):
+        row = user.to_row(intern_string)
+        if row[-1] is not None:
+            # extra — единственное изменяемое поле, копируем его
+            row = row[:-1] + (dict(row[-1]),)
+        return row
+
+    return strings, build
+
+def users_rows(data):
+    """Снимок пользователей: таблица строк, id и неизменяемые кортежи полей"""
+    strings, build = users_row_builder()
+    uids = []
+    rows = []
+    for uid, user in data.items():
+        uids.append(int(uid))
+        rows.append(build(user))
+    return tuple(strings), uids, rows
+
+async def users_rows_chunked(data):
+    """Тот же снимок, но пачками по USERS_SNAPSHOT_CHUNK с возвратом управления циклу.
+
+    Запись, изменённая после своей пачки, попадёт в следующее сохранение:
+    каждое изменение вызывает save_users(), а сохранения одного имени идут по очереди.
+    """
+    strings, build = users_row_builder()
+    keys = list(data)
+    uids = []
+    rows = []
+    for start in range(0, len(keys), USERS_SNAPSHOT_CHUNK):
+        for uid in keys[start:start + USERS_SNAPSHOT_CHUNK]:
+            user = data.get(uid)
+            if user is None:
+                # Удалён (архив), пока снимали предыдущие пачки
+                continue
+            uids.append(int(uid))
+            rows.append(build(user))
+        await asyncio.sleep(0)
+    return tuple(strings), uids, rows
+
+def encode_users_rows(state):
+    """Кодирует снимок пользователей в секции снапшота"""
+    strings, uids, rows = state
+    return [
+        marshal.dumps(strings),
+        marshal.dumps(uids),
+        marshal.dumps(rows),
+    ]
+
+def encode_users_snapshot(data):
+    """Кодирует пользователей в секции: строки, id, кортежи полей"""
+    return encode_users_rows(users_rows(data))
+
+def decode_users_snapshot(sections):
+    """Восстанавливает пользователей из секций снапшота"""
+    strings, uids, rows = sections
+    if rows and len(rows[0]) != len(UserRecord.__slots__):
+        # Снапшот с другой раскладкой строк — load_users перечитает users.json
+        raise ValueError(f"строки из {len(rows[0])} полей, ожидается {len(UserRecord.__slots__)}")
+    strings = tuple(sys.intern(value) for value in strings)
+    from_row = UserRecord.from_row
+    return {str(uid): from_row(row, strings) for uid, row in zip(uids, rows)}
+
+# ---------------- PERSISTENCE ----------------
+# Сериализация и запись на диск выполняются в отдельном потоке. Внутри
+# цикла событий снимается только неизменяемый снимок данных (большие —
+# пачками, см. users_rows_chunked), а частые вызовы save_*() в пределах
+# SAVE_COALESCE_DELAY сливаются в одну запись.
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+SAVE_COALESCE_DELAY = float(os.getenv("SAVE_COALESCE_DELAY", "1.0"))
+# Сколько пользователей снимать за один шаг цикла событий
+USERS_SNAPSHOT_CHUNK = int(os.getenv("USERS_SNAPSHOT_CHUNK", "2000"))
+# имя -> [отложенный вызов, функция снимка, функция записи]
+_save_pending = {}
+# имя -> последняя запущенная запись (снимок + запись в потоке)
+_save_futures = {}
+
+def fsync_file(f):
+    """Сбрасывает записанное на диск перед атомарной подменой файла"""
+    f.flush()
+    os.fsync(f.fileno())
+
+def schedule_save(name, snapshot, write):
+    """Откладывает запись: повторные вызовы до её начала сливаются в одну"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Вне цикла событий (запуск, скрипты) пишем сразу
+        state = snapshot()
+        if inspect.isawaitable(state):
+            state = asyncio.run(state)
+        write(state)
+        return
+    
+    pending = _save_pending.get(name)
+    if pending is not None:
+        pending[1], pending[2] = snapshot, write
+        return
+    handle = loop.call_later(SAVE_COALESCE_DELAY, _submit_save, loop, name)
+    _save_pending[name] = [handle, snapshot, write]
+
+def _submit_save(loop, name):
+    """Запускает снимок и запись; записи одного имени идут строго по очереди"""
+    _, snapshot, write = _save_pending.pop(name)
+    previous = _save_futures.get(name)
+    future = _save_futures[name] = loop.create_task(_run_save(name, snapshot, write, previous))
+    future.add_done_callback(lambda done: _forget_save(name, done))
+
+async def _run_save(name, snapshot, write, previous):
+    """Снимает снимок в цикле событий (возможно, пачками) и пишет его в потоке"""
+    if previous is not None:
+        # Иначе более старый снимок мог бы лечь на диск поверх нового
+        await asyncio.gather(previous, return_exceptions=True)
+    try:
+        state = snapshot()
+        if inspect.isawaitable(state):
+            state = await state
+        await asyncio.get_running_loop().run_in_executor(IO_EXECUTOR, write, state)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения {name}: {e}")
+
+def _forget_save(name, future):
+    """Убирает завершённую запись, если за ней не пришла новая"""
+    if _save_futures.get(name) is future:
+        del _save_futures[name]
+
+async def flush_saves():
+    """Немедленно запускает отложенные записи и дожидается их завершения"""
+    loop = asyncio.get_running_loop()
+    for name in list(_save_pending):
+        _save_pending[name][0].cancel()
+        _submit_save(loop, name)
+    if _save_futures:
+        await asyncio.gather(*list(_save_futures.values()), return_exceptions=True)
+
+async def run_io(func, *args):
+    """Выполняет блокирующую функцию в потоке записи"""
+    return await asyncio.get_running_loop().run_in_executor(IO_EXECUTOR, func, *args)
 
 # ---------------- DATA ----------------
 users_lock = Lock()
@@ -50,8 +888,17 @@ tracker_lock = Lock()
 TIMES_CACHE = {}
 
 def load_users():
-    """Загружает пользователей из файла с обработкой ошибок"""
+    """Загружает пользователей: сначала из снапшота, затем из JSON"""
     with users_lock:
+        sections = read_snapshot(USERS_SNAPSHOT_FILE, newer_than=USERS_FILE)
+        if sections is not None:
+            try:
+                data = decode_users_snapshot(sections)
+                logging.info(f"Пользователи загружены из снапшота: {len(data)}")
+                return data
+            except Exception as e:
+                logging.error(f"Ошибка декодирования снапшота пользователей: {e}")
+
         if not os.path.exists(USERS_FILE):
             with open(USERS_FILE, "w", encoding="utf-8") as f:
                 json.dump({}, f)
@@ -62,11 +909,14 @@ def load_users():
                 content = f.read().strip()
                 if not content:
                     return {}
-                return json.loads(content)
+                return {
+                    uid: UserRecord(data)
+                    for uid, data in json.loads(content).items()
+                }
         except (json.JSONDecodeError, IOError) as e:
             logging.error(f"Ошибка загрузки users.json: {e}")
             if os.path.exists(USERS_FILE):
-                backup_name = f"{USERS_FILE}.backup.{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+                backup_name = f"{USERS_FILE}.backup.{clock.now().strftime('%Y%m%d_%H%M%S')}"
                 try:
                     os.rename(USERS_FILE, backup_name)
                     logging.info(f"Создан бэкап: {backup_name}")
@@ -76,61 +926,113 @@ def load_users():
                 json.dump({}, f)
             return {}
         
-def save_users():
-    """Сохраняет пользователей в файл с блокировкой"""
+# users.json — читаемая копия для ручного просмотра и восстановления; рабочий
+# формат — снапшот. JSON пишется не чаще раза в USERS_JSON_INTERVAL секунд
+# и при остановке бота.
+USERS_JSON_INTERVAL = int(os.getenv("USERS_JSON_INTERVAL", "3600"))
+_users_json_at = time.monotonic()
+_users_json_due = False
+
+def write_users_json(state):
+    """Пишет снимок пользователей в users.json (в потоке записи)"""
+    strings, uids, rows = state
+    from_row = UserRecord.from_row
+    temp_file = f"{USERS_FILE}.tmp"
+    try:
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {str(uid): from_row(row, strings) for uid, row in zip(uids, rows)},
+                f, ensure_ascii=False, indent=2, default=user_json_default
+            )
+            fsync_file(f)
+        os.replace(temp_file, USERS_FILE)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка сохранения users.json: {e}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return False
+
+def write_users_files(state):
+    """Пишет снапшот пользователей и, когда пора, users.json (в потоке записи)"""
+    global _users_json_at, _users_json_due
     with users_lock:
-        temp_file = f"{USERS_FILE}.tmp"
-        try:
-            with open(temp_file, "w", encoding="utf-8") as f:
-                json.dump(users, f, ensure_ascii=False, indent=2)
-            os.replace(temp_file, USERS_FILE)
-        except Exception as e:
-            logging.error(f"Ошибка сохранения users.json: {e}")
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
+        if _users_json_due or time.monotonic() - _users_json_at >= USERS_JSON_INTERVAL:
+            if write_users_json(state):
+                _users_json_at = time.monotonic()
+                _users_json_due = False
+        # Снапшот пишется после JSON, чтобы при загрузке он считался свежее
+        write_snapshot(USERS_SNAPSHOT_FILE, encode_users_rows(state))
+
+def save_users(with_json=False):
+    """Сохраняет пользователей в снапшот (отложенно, в потоке записи); with_json — и в users.json"""
+    global _users_json_due
+    if with_json:
+        _users_json_due = True
+    schedule_save("users", lambda: users_rows_chunked(users), write_users_files)
+
+def clean_tracker(data):
+    """Оставляет в трекере только записи за сегодня и вчера"""
+    today = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d")
+    yesterday = (clock.now(ZoneInfo("Asia/Tashkent")) - timedelta(days=1)).strftime("%Y-%m-%d")
+    
+    cleaned = {}
+    for key, value in data.items():
+        parts = key.split("_")
+        if len(parts) >= 3:
+            date_part = parts[-1]
+            if date_part in [today, yesterday]:
+                cleaned[key] = value
+    return cleaned
 
 def load_tracker():
     """Загружает трекер, очищая старые записи"""
     with tracker_lock:
-        if not os.path.exists(TRACKER_FILE):
+        sections = read_snapshot(TRACKER_SNAPSHOT_FILE, newer_than=TRACKER_FILE)
+        if sections is not None:
+            data = sections[0]
+        elif not os.path.exists(TRACKER_FILE):
             return {}
-        
-        try:
-            with open(TRACKER_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            
-            today = datetime.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d")
-            yesterday = (datetime.now(ZoneInfo("Asia/Tashkent")) - timedelta(days=1)).strftime("%Y-%m-%d")
-            
-            cleaned = {}
-            for key, value in data.items():
-                parts = key.split("_")
-                if len(parts) >= 3:
-                    date_part = parts[-1]
-                    if date_part in [today, yesterday]:
-                        cleaned[key] = value
-            
-            with open(TRACKER_FILE, "w", encoding="utf-8") as f:
-                json.dump(cleaned, f, ensure_ascii=False, indent=2)
-            
-            return cleaned
+        else:
+            try:
+                with open(TRACKER_FILE, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception as e:
+                logging.error(f"Ошибка загрузки tracker.json: {e}")
+                return {}
             
-        except Exception as e:
-            logging.error(f"Ошибка загрузки tracker.json: {e}")
-            return {}
+        cleaned = clean_tracker(data)
+        
+        # Перезаписываем файлы только если что-то действительно устарело
+        if len(cleaned) != len(data):
+            _write_tracker_files(cleaned)
+        
+        return cleaned
 
-def save_tracker(tracker_data):
-    """Сохраняет трекер атомарно"""
+def _write_tracker_files(tracker_data):
+    """Пишет трекер в JSON и снапшот (вызывается под tracker_lock)"""
+    temp_file = f"{TRACKER_FILE}.tmp"
+    try:
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(tracker_data, f, ensure_ascii=False, separators=(",", ":"))
+            fsync_file(f)
+        os.replace(temp_file, TRACKER_FILE)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения tracker.json: {e}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return
+
+    write_snapshot(TRACKER_SNAPSHOT_FILE, [marshal.dumps(tracker_data)])
+
+def write_tracker_files(tracker_data):
+    """Пишет снимок трекера (в потоке записи)"""
     with tracker_lock:
-        temp_file = f"{TRACKER_FILE}.tmp"
-        try:
-            with open(temp_file, "w", encoding="utf-8") as f:
-                json.dump(tracker_data, f, ensure_ascii=False, indent=2)
-            os.replace(temp_file, TRACKER_FILE)
-        except Exception as e:
-            logging.error(f"Ошибка сохранения tracker.json: {e}")
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
+        _write_tracker_files(tracker_data)
+
+def save_tracker(tracker_data):
+    """Сохраняет трекер атомарно (отложенно, в потоке записи)"""
+    schedule_save("tracker", lambda: dict(tracker_data), write_tracker_files)
 
 def is_notification_sent(tracker, uid, event, date_str):
     """Проверяет, было ли уже отправлено уведомление"""
@@ -146,6 +1048,8 @@ def mark_notification_sent(tracker, uid, event, date_str):
 # Загружаем данные при старте
 users = load_users()
 notification_tracker = load_tracker()
+audience = AudienceIndex()
+audience.rebuild(users)
 
 def get_user(uid: str):
     """Возвращает данные пользователя или None"""
@@ -159,6 +1063,7 @@ def update_user(uid: str, **kwargs):
         return False
     
     users[uid].update(kwargs)
+    audience.add(uid, users[uid])
     save_users()
     return True
 
@@ -169,24 +1074,27 @@ def update_activity(user_obj, uid):
         return
     
     tashkent_tz = ZoneInfo("Asia/Tashkent")
-    now = datetime.now(tashkent_tz).strftime("%Y-%m-%d %H:%M:%S")
+    now = clock.now(tashkent_tz).strftime("%Y-%m-%d %H:%M:%S")
     
     users[uid].update({
         "first_name": user_obj.first_name,
         "username": user_obj.username,
         "last_active": now
     })
+    audience.add(uid, users[uid])
+    activity.touch(uid, users[uid].last_active)
     save_users()
 
 def save_user_data(user_obj, uid, is_new=False):
     """Создает или обновляет пользователя"""
     uid = str(uid)
     tashkent_tz = ZoneInfo("Asia/Tashkent")
-    now = datetime.now(tashkent_tz)
+    now = clock.now(tashkent_tz)
     now_str = now.strftime("%Y-%m-%d %H:%M:%S")
     
-    if uid not in users:
-        users[uid] = {
+    created = uid not in users
+    if created:
+        users[uid] = UserRecord({
             "lang": "uz",
             "city": "tashkent",
             "remind_min": 10,
@@ -195,7 +1103,7 @@ def save_user_data(user_obj, uid, is_new=False):
             "joined": now_str,
             "last_active": now_str,
             "push_sent": False
-        }
+        })
     else:
         users[uid].update({
             "first_name": user_obj.first_name,
@@ -203,105 +1111,1897 @@ def save_user_data(user_obj, uid, is_new=False):
             "last_active": now_str
         })
     
+    audience.add(uid, users[uid])
+    activity.touch(uid, users[uid].last_active, new=created)
     save_users()
 
-# ---------------- HELPERS ----------------
-def t(uid, key):
-    """Получает перевод с fallback"""
-    uid = str(uid)
-    lang = users.get(uid, {}).get("lang", "uz")
+def mark_user_blocked(uid, save=True):
+    """Помечает пользователя заблокировавшим бота; True, если статус изменился"""
+    user = users.get(uid)
+    if not user or user.get("is_blocked"):
+        return False
     
-    text = TEXTS.get(lang, TEXTS["uz"]).get(key)
-    if text is None:
-        text = TEXTS["uz"].get(key, TEXTS["ru"].get(key, key))
-    return text
-
-def get_text_by_lang(lang, key):
-    """Получает текст на конкретном языке (для onboarding)"""
-    text = TEXTS.get(lang, TEXTS["uz"]).get(key)
-    if text is None:
-        text = TEXTS["uz"].get(key, TEXTS["ru"].get(key, key))
-    return text
+    user["is_blocked"] = True
+    user["blocked_date"] = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d %H:%M:%S")
+    audience.add(uid, user)
+    if save:
+        save_users()
+    return True
 
-def get_city_times(city):
-    """Получает расписание города с кэшированием"""
-    if city in TIMES_CACHE:
-        return TIMES_CACHE[city]
+def mark_user_unblocked(uid, save=True):
+    """Снимает отметку о блокировке; True, если статус изменился"""
+    user = users.get(uid)
+    if not user or not user.get("is_blocked"):
+        return False
     
-    file = os.path.join(BASE_DIR, f"times_{city}.json")
-    if os.path.exists(file):
-        try:
-            with open(file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                TIMES_CACHE[city] = data
-                return data
-        except (json.JSONDecodeError, IOError) as e:
-            logging.error(f"Ошибка загрузки {file}: {e}")
-    return {}
+    user["is_blocked"] = False
+    user["unblocked_date"] = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d %H:%M:%S")
+    audience.add(uid, user)
+    if save:
+        save_users()
+    return True
 
-def get_tz(uid):
-    """Получает часовой пояс пользователя"""
-    uid = str(uid)
-    city = users.get(uid, {}).get("city", "tashkent")
-    return ZoneInfo("Europe/Berlin" if city == "bremen" else "Asia/Tashkent")
+# ---------------- ARCHIVE ----------------
+# Заблокировавшие бота больше ARCHIVE_BLOCKED_DAYS дней назад переносятся
+# из users в сжатый снапшот ARCHIVE_FILE; в памяти остаются только их id.
+# Горячий users.json главнее архива: восстановленные записи вычищаются
+# из файла при следующей архивации.
+# Незаблокировавших не архивируем, даже если они давно не заходили:
+# получение напоминаний не обновляет last_active, а архивные напоминаний
+# не получают — такой пользователь молча остался бы без них.
+ARCHIVE_BLOCKED_DAYS = int(os.getenv("ARCHIVE_BLOCKED_DAYS", "30"))
+ARCHIVE_HOUR = 4
 
-def format_pretty_date(dt, uid):
-    """Форматирует дату красиво"""
-    uid = str(uid)
-    lang = users.get(uid, {}).get("lang", "uz")
-    months = TEXTS.get(lang, TEXTS["uz"])["months"]
-    month = months[dt.month - 1]
-    return f"{dt.day} {month} {dt.year}"
+def load_archive():
+    """Загружает архив пользователей целиком"""
+    sections = read_snapshot(ARCHIVE_FILE, compressed=True)
+    if sections is None:
+        return {}
+    try:
+        return decode_users_snapshot(sections)
+    except Exception as e:
+        logging.error(f"Ошибка декодирования архива пользователей: {e}")
+        return {}
 
-def get_city_name(city, lang):
-    """Возвращает название города на нужном языке"""
-    names = {
-        "tashkent": {"uz": "Tashkent 🇺🇿", "ru": "Ташкент 🇺🇿"},
-        "bremen": {"uz": "Bremen 🇩🇪", "ru": "Бремен 🇩🇪"}
-    }
-    return names.get(city, {}).get(lang, city)
+def load_archived_uids():
+    """Id пользователей в архиве, которых нет среди активных"""
+    sections = read_snapshot(ARCHIVE_FILE, compressed=True)
+    if sections is None:
+        return set()
+    return {str(uid) for uid in sections[1]} - users.keys()
 
-def get_lang_name(lang):
-    """Возвращает название языка"""
-    names = {"uz": "O'zbekcha 🇺🇿", "ru": "Русский 🇷🇺"}
-    return names.get(lang, lang)
+archived_uids = load_archived_uids()
 
-# ---------------- NEW: BLOCK CHECK FUNCTIONS ----------------
-async def check_user_blocked(bot, user_id: int) -> bool:
-    """Проверяет, заблокировал ли пользователь бота"""
-    try:
-        await bot.send_chat_action(chat_id=user_id, action="typing")
-        return False
-    except Forbidden:
-        return True
-    except Exception:
+def should_archive(uid, user, blocked_cutoff):
+    """Пора ли переносить пользователя в архив (только давно заблокировавших)"""
+    if int(uid) == ADMIN_ID or uid in LIVE_COUNTDOWNS or not user.is_blocked:
         return False
+    return user.blocked_date is not None and user.blocked_date < blocked_cutoff
 
-async def update_users_block_status(context: ContextTypes.DEFAULT_TYPE):
-    """Обновляет статус блокировки для всех пользователей"""
-    blocked_count = 0
-    tashkent_tz = ZoneInfo("Asia/Tashkent")
+# Перенесённые, но ещё не записанные в файл архива (uid -> запись)
+archive_in_flight = {}
+# Разобранный архив для восстановления: (таблица строк, uid -> кортеж полей).
+# Строится при первом восстановлении и сбрасывается write_archive; оба
+# работают только в потоке записи, поэтому блокировка не нужна.
+_archive_rows = None
+
+def load_archived_user(uid):
+    """Запись одного пользователя из архива или None, если её нет (в потоке записи).
+
+    Нечитаемый файл архива — исключение, а не None: пользователь должен
+    остаться в archived_uids до следующей попытки.
+    """
+    global _archive_rows
+    if _archive_rows is None:
+        sections = read_snapshot(ARCHIVE_FILE, compressed=True)
+        if sections is None:
+            if os.path.exists(ARCHIVE_FILE):
+                raise OSError(f"не удалось прочитать {ARCHIVE_FILE}")
+            return None
+        strings, uids, rows = sections
+        _archive_rows = (tuple(sys.intern(value) for value in strings), dict(zip(uids, rows)))
     
-    for uid in list(users.keys()):
-        try:
-            is_blocked = await check_user_blocked(context.bot, int(uid))
-            if is_blocked:
-                users[uid]["is_blocked"] = True
-                users[uid]["blocked_date"] = datetime.now(tashkent_tz).strftime("%Y-%m-%d %H:%M:%S")
-                blocked_count += 1
-            else:
-                if users[uid].get("is_blocked"):
-                    users[uid]["is_blocked"] = False
-                    users[uid]["unblocked_date"] = datetime.now(tashkent_tz).strftime("%Y-%m-%d %H:%M:%S")
-        except Exception as e:
-            logging.error(f"Ошибка проверки пользователя {uid}: {e}")
+    strings, rows = _archive_rows
+    row = rows.get(int(uid))
+    if row is None:
+        return None
+    user = UserRecord.from_row(row, strings)
+    if user.extra is not None:
+        # Строка остаётся в индексе — не делим с ней изменяемый extra
+        user.extra = dict(user.extra)
+    return user
+
+def write_archive(moved, hot_uids):
+    """Дописывает записи в файл архива (в потоке записи)"""
+    global _archive_rows
+    _archive_rows = None
+    archive = load_archive()
+    # Восстановленные с прошлого раза записи больше не нужны в архиве
+    for uid in list(archive):
+        if uid in hot_uids:
+            del archive[uid]
+    archive.update(moved)
+    return write_snapshot(ARCHIVE_FILE, encode_users_snapshot(archive), compress=True)
+
+async def archive_users():
+    """Переносит подходящих пользователей в архив; возвращает число перенесённых"""
+    now_ts = ts_to_int(clock.now(ZoneInfo("Asia/Tashkent")).strftime(TS_FORMAT))
+    blocked_cutoff = now_ts - ARCHIVE_BLOCKED_DAYS * 86400
     
-    if blocked_count > 0:
+    moving = [uid for uid, user in users.items() if should_archive(uid, user, blocked_cutoff)]
+    if not moving:
+        return 0
+    
+    for uid in moving:
+        archive_in_flight[uid] = users.pop(uid)
+        audience.remove(uid)
+        archived_uids.add(uid)
+    save_users()
+    
+    try:
+        written = await run_io(write_archive, dict(archive_in_flight), set(users))
+    except Exception as e:
+        logging.error(f"Ошибка записи архива: {e}")
+        written = False
+    
+    if not written:
+        # Возвращаем всех, кого не удалось записать (и ещё не восстановили)
+        for uid, user in archive_in_flight.items():
+            if uid in archived_uids:
+                archived_uids.discard(uid)
+                users[uid] = user
+                audience.add(uid, user)
+        archive_in_flight.clear()
         save_users()
+        return 0
+    
+    archive_in_flight.clear()
+    logging.info(f"🗄 В архив перенесено {len(moving)} пользователей, в архиве {len(archived_uids)}")
+    return len(moving)
+
+async def restore_archived_user(uid):
+    """Возвращает пользователя из архива в users; True, если он был в архиве"""
+    uid = str(uid)
+    if uid not in archived_uids:
+        return False
+    
+    user = archive_in_flight.get(uid)
+    if user is None:
+        try:
+            user = await run_io(load_archived_user, uid)
+        except Exception as e:
+            logging.error(f"Ошибка восстановления пользователя {uid} из архива: {e}")
+            return False
+    if uid in users:
+        # Горячая запись главнее архивной
+        archived_uids.discard(uid)
+        return False
+    if user is None:
+        logging.warning(f"🗄 Пользователь {uid} не найден в файле архива")
+        return False
+    
+    users[uid] = user
+    archived_uids.discard(uid)
+    audience.add(uid, user)
+    save_users()
+    logging.info(f"🗄 Пользователь {uid} восстановлен из архива")
+    return True
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    """Ежедневная архивация пользователей"""
+    try:
+        await archive_users()
+    except Exception as e:
+        logging.error(f"Ошибка архивации пользователей: {e}")
+
+# ---------------- DAILY STATS ----------------
+# Ежедневные агрегаты в append-only DAILY_STATS_FILE, по строке JSON на день:
+#   {"date", "total", "blocked_total", "new", "active", "blocked", "unblocked",
+#    "reminders"}; метрики — словари "город/язык" -> число.
+# Всё выводится из полей пользователей, карт активности и трекера за один
+# проход в начале следующих суток, поэтому переживает перезапуски. Метрики,
+# для которых за день нет данных (active — нет карты дня, reminders — день
+# старше вчерашнего, трекер его уже не хранит), в строку не попадают.
+DAILY_STATS_HOUR = 0
+DAILY_STATS_MINUTE = 5
+DAILY_METRICS = ("new", "active", "blocked", "unblocked", "reminders")
+GROWTH_CHART_DAYS = 30
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+# Эпоха 1970-01-01 в ординалах date: ts // 86400 + EPOCH_ORDINAL
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def load_daily_stats():
+    """Читает все сохранённые дни"""
+    if not os.path.exists(DAILY_STATS_FILE):
+        return []
+    rows = []
+    with open(DAILY_STATS_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                logging.warning(f"Пропускаю повреждённую строку {DAILY_STATS_FILE}")
+    return rows
+
+daily_stats = load_daily_stats()
+
+def append_daily_stats(rows):
+    """Дописывает дни в конец файла (в потоке записи)"""
+    with open(DAILY_STATS_FILE, "a", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+        fsync_file(f)
+
+def compute_daily_stats(first, last):
+    """Агрегаты за дни с ординалами first..last за один проход по пользователям.
+
+    Карты активности этих дней должны быть подгружены preload_activity.
+    """
+    days = {
+        ordinal: {metric: Counter() for metric in DAILY_METRICS}
+        for ordinal in range(first, last + 1)
+    }
+    
+    def user_key(user):
+        return f"{user.city or '?'}/{user.lang or '?'}" if user else "?/?"
+    
+    def bump(metric, ts, key):
+        if ts is not None:
+            day = days.get(ts // 86400 + EPOCH_ORDINAL)
+            if day is not None:
+                day[metric][key] += 1
+    
+    # Для total/blocked_total на конец каждого дня: сколько добавилось позже
+    joined_later = Counter()
+    blocked_later = Counter()
+    blocked_now = 0
+    for user in users.values():
+        key = user_key(user)
+        bump("new", user.joined, key)
+        bump("blocked", user.blocked_date, key)
+        bump("unblocked", user.unblocked_date, key)
+        if user.joined is not None and user.joined // 86400 + EPOCH_ORDINAL >= first:
+            joined_later[user.joined // 86400 + EPOCH_ORDINAL] += 1
+        if user.is_blocked:
+            blocked_now += 1
+            if user.blocked_date is not None and user.blocked_date // 86400 + EPOCH_ORDINAL >= first:
+                blocked_later[user.blocked_date // 86400 + EPOCH_ORDINAL] += 1
+    
+    # Активные — по битам карты дня: last_active хранит только последний день
+    unrecorded = {ordinal: set() for ordinal in days}
+    for ordinal, counters in days.items():
+        bitmap = activity.days.get((ACTIVITY_SUFFIX, ordinal))
+        if bitmap is None:
+            unrecorded[ordinal].add("active")
+            continue
+        for byte_index, byte in enumerate(bitmap):
+            while byte:
+                low = byte & -byte
+                byte ^= low
+                uid = activity.uids[byte_index * 8 + low.bit_length() - 1]
+                counters["active"][user_key(users.get(str(uid)))] += 1
+    
+    # В трекере хранятся только сегодня и вчера
+    tracked_from = today_ordinal() - 1
+    for ordinal in days:
+        if ordinal < tracked_from:
+            unrecorded[ordinal].add("reminders")
+    for tracker_key in notification_tracker:
+        parts = tracker_key.split("_", 2)
+        if len(parts) != 3:
+            continue
+        uid, _, date_str = parts
+        try:
+            ordinal = date.fromisoformat(date_str).toordinal()
+        except ValueError:
+            continue
+        day = days.get(ordinal)
+        if day is not None:
+            day["reminders"][user_key(users.get(uid))] += 1
+    
+    total = len(users) + len(archived_uids) - sum(count for ordinal, count in joined_later.items() if ordinal > last)
+    blocked_total = blocked_now - sum(count for ordinal, count in blocked_later.items() if ordinal > last)
+    rows = []
+    for ordinal in range(last, first - 1, -1):
+        row = {"date": date.fromordinal(ordinal).isoformat(), "total": total, "blocked_total": blocked_total}
+        row.update({
+            metric: dict(counter) for metric, counter in days[ordinal].items()
+            if metric not in unrecorded[ordinal]
+        })
+        rows.append(row)
+        total -= joined_later[ordinal]
+        blocked_total -= blocked_later[ordinal]
+    rows.reverse()
+    return rows
+
+async def rollup_daily_stats():
+    """Добавляет в файл все завершившиеся и ещё не записанные дни"""
+    yesterday = clock.now(ZoneInfo("Asia/Tashkent")).date().toordinal() - 1
+    if daily_stats:
+        first = date.fromisoformat(daily_stats[-1]["date"]).toordinal() + 1
+    else:
+        # Первый запуск: восстанавливаем дни с момента первой регистрации
+        joined = [user.joined for user in users.values() if user.joined is not None]
+        first = min(joined) // 86400 + EPOCH_ORDINAL if joined else yesterday
+    if first > yesterday:
+        return 0
+    
+    await preload_activity(range(first, yesterday + 1))
+    rows = compute_daily_stats(first, yesterday)
+    await run_io(append_daily_stats, rows)
+    daily_stats.extend(rows)
+    logging.info(f"📈 Дневная статистика записана: {rows[0]['date']}…{rows[-1]['date']}")
+    return len(rows)
+
+async def daily_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Ежедневная запись агрегатов за прошедшие сутки"""
+    try:
+        await rollup_daily_stats()
+    except Exception as e:
+        logging.error(f"Ошибка дневной статистики: {e}")
+
+def metric_series(metric, days):
+    """Значения метрики (сумма по городам/языкам) за последние дни; None — не записывалась"""
+    return [
+        sum(row[metric].values()) if metric in row else None
+        for row in daily_stats[-days:]
+    ]
+
+def series_total(values):
+    """Сумма записанных значений ряда"""
+    return sum(value for value in values if value is not None)
+
+def sparkline(values):
+    """Текстовый график ▁▂▃▄▅▆▇█ (пробел — нет данных)"""
+    if not values:
+        return ""
+    top = max((value for value in values if value is not None), default=0)
+    if top <= 0:
+        return "".join(" " if value is None else SPARK_CHARS[0] for value in values)
+    return "".join(
+        " " if value is None else SPARK_CHARS[round(value / top * (len(SPARK_CHARS) - 1))]
+        for value in values
+    )
+
+# ---------------- ACTIVITY BITMAPS ----------------
+# Активность по дням (по Ташкенту): на каждый день — битовая карта, где бит
+# с номером ordinal пользователя выставлен, если он в этот день писал боту.
+# Ordinal'ы плотные и выдаются по порядку первого появления. Когорта дня —
+# отдельная карта тех, кто в этот день зарегистрировался: ordinal'ы
+# выдаются и восстановленным из архива, и пропущенным при первом запуске,
+# поэтому по диапазону ordinal'ов когорту определять нельзя.
+# Файлы: ACTIVITY_DIR/ordinals.snap (id по ordinal'ам),
+# ACTIVITY_DIR/<дата>.bits (активность) и <дата>.joined (когорта);
+# бит i — байт i // 8, младшие биты первыми.
+ACTIVITY_INDEX_FILE = os.path.join(ACTIVITY_DIR, "ordinals.snap")
+ACTIVITY_SUFFIX = ".bits"
+COHORT_SUFFIX = ".joined"
+# Сколько последних дней держать в памяти (MAU + запас)
+ACTIVITY_CACHE_DAYS = 62
+RETENTION_DAYS = (1, 7, 30)
+# Когорты скольких дней усреднять в retention
+RETENTION_COHORTS = 30
+
+class ActivityBitmaps:
+    """Битовые карты активности и когорт по дням и плотные ordinal'ы пользователей"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.uids = []       # ordinal -> id
+        self.ordinals = {}   # id -> ordinal
+        # (суффикс файла, день) -> bytearray: активность и когорты дня
+        self.days = {}
+        self.dirty = set()   # изменённые ключи self.days
+        self.index_dirty = False
+        # Таблица старого формата с когортами-диапазонами: когорты надо пересобрать
+        self.legacy_cohorts = False
+
+    def day_path(self, day, suffix=ACTIVITY_SUFFIX):
+        return os.path.join(self.directory, f"{date.fromordinal(day).isoformat()}{suffix}")
+
+    def load(self):
+        """Читает таблицу ordinal'ов; False, если её ещё нет"""
+        os.makedirs(self.directory, exist_ok=True)
+        sections = read_snapshot(ACTIVITY_INDEX_FILE)
+        if sections is None:
+            return False
+        self.uids = list(sections[0])
+        self.ordinals = {str(uid): ordinal for ordinal, uid in enumerate(self.uids)}
+        if len(sections) > 1:
+            self.legacy_cohorts = True
+            self.index_dirty = True
+        return True
+
+    def bootstrap(self, data):
+        """Первый запуск: ordinal'ы по дате регистрации, когорты и дни joined и last_active"""
+        order = sorted(data.items(), key=lambda item: (item[1].joined or 0, int(item[0])))
+        for uid, user in order:
+            ordinal = self.assign(uid)
+            if user.joined is not None:
+                self.set_bit(user.joined // 86400 + EPOCH_ORDINAL, ordinal, COHORT_SUFFIX)
+            for ts in (user.joined, user.last_active):
+                if ts is not None:
+                    self.set_bit(ts // 86400 + EPOCH_ORDINAL, ordinal)
+        logging.info(f"📅 Карты активности созданы: {len(self.uids)} польз., {len(self.dirty)} карт")
+
+    def rebuild_cohorts(self, data):
+        """Переход со старой таблицы: когорты по полю joined известных пользователей"""
+        for uid, user in data.items():
+            ordinal = self.ordinals.get(uid)
+            if ordinal is not None and user.joined is not None:
+                self.set_bit(user.joined // 86400 + EPOCH_ORDINAL, ordinal, COHORT_SUFFIX)
+        self.legacy_cohorts = False
+        logging.info(f"📅 Когорты активности пересобраны по дате регистрации: {len(self.dirty)} карт")
+
+    def assign(self, uid):
+        """Ordinal пользователя; новому выдаётся следующий по порядку"""
+        ordinal = self.ordinals.get(uid)
+        if ordinal is None:
+            ordinal = self.ordinals[uid] = len(self.uids)
+            self.uids.append(int(uid))
+            self.index_dirty = True
+        return ordinal
+
+    def bitmap(self, day, create=False, suffix=ACTIVITY_SUFFIX):
+        """Карта дня (из памяти или с диска); None, если отметок не было"""
+        key = (suffix, day)
+        bitmap = self.days.get(key)
+        if bitmap is None:
+            path = self.day_path(day, suffix)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    bitmap = bytearray(f.read())
+            elif create:
+                bitmap = bytearray()
+            else:
+                return None
+            self.days[key] = bitmap
+        return bitmap
+
+    def set_bit(self, day, ordinal, suffix=ACTIVITY_SUFFIX):
+        """Ставит бит в карте дня; True, если он был снят"""
+        bitmap = self.bitmap(day, create=True, suffix=suffix)
+        byte = ordinal >> 3
+        if byte >= len(bitmap):
+            bitmap.extend(bytes(byte + 1 - len(bitmap)))
+        mask = 1 << (ordinal & 7)
+        if bitmap[byte] & mask:
+            return False
+        bitmap[byte] |= mask
+        self.dirty.add((suffix, day))
+        return True
+
+    def touch(self, uid, ts, new=False):
+        """Отмечает активность пользователя в день метки времени ts (new — и его регистрацию)"""
+        if ts is None:
+            return
+        day = ts // 86400 + EPOCH_ORDINAL
+        ordinal = self.assign(uid)
+        self.set_bit(day, ordinal)
+        if new:
+            self.set_bit(day, ordinal, COHORT_SUFFIX)
+        if self.dirty or self.index_dirty:
+            self.save()
+
+    def save(self):
+        schedule_save("activity", self.snapshot, self.write)
+
+    def snapshot(self):
+        """Копии изменённых карт и таблицы ordinal'ов для потока записи"""
+        days = {key: bytes(self.days[key]) for key in self.dirty}
+        index = list(self.uids) if self.index_dirty else None
+        self.dirty.clear()
+        self.index_dirty = False
+        self.trim()
+        return days, index
+
+    def write(self, state):
+        days, index = state
+        for (suffix, day), data in days.items():
+            path = self.day_path(day, suffix)
+            temp_file = f"{path}.tmp"
+            try:
+                with open(temp_file, "wb") as f:
+                    f.write(data)
+                    fsync_file(f)
+                os.replace(temp_file, path)
+            except OSError as e:
+                logging.error(f"Ошибка записи {path}: {e}")
+        if index is not None:
+            write_snapshot(ACTIVITY_INDEX_FILE, [marshal.dumps(index)])
+
+    def trim(self):
+        """Выгружает из памяти старые сохранённые дни"""
+        days = sorted({day for _, day in self.days})
+        if len(days) <= ACTIVITY_CACHE_DAYS:
+            return
+        keep = days[-ACTIVITY_CACHE_DAYS]
+        for key in [key for key in self.days if key[1] < keep and key not in self.dirty]:
+            del self.days[key]
+
+    def as_int(self, day, suffix=ACTIVITY_SUFFIX):
+        bitmap = self.bitmap(day, suffix=suffix)
+        return int.from_bytes(bitmap, "little") if bitmap else 0
+
+    def active(self, last, window=1):
+        """Число уникальных активных за window дней, заканчивая днём last"""
+        bits = 0
+        for day in range(last - window + 1, last + 1):
+            bits |= self.as_int(day)
+        return bits.bit_count()
+
+    def cohort(self, day):
+        """Маска ordinal'ов пользователей, зарегистрированных в день day"""
+        return self.as_int(day, COHORT_SUFFIX)
+
+    def retention(self, last, n, cohorts=RETENTION_COHORTS):
+        """(размер когорт, вернулись на день n) по когортам, для которых день n уже прошёл"""
+        size = returned = 0
+        for day in range(last - n - cohorts + 1, last - n + 1):
+            mask = self.cohort(day)
+            if mask:
+                size += mask.bit_count()
+                returned += (mask & self.as_int(day + n)).bit_count()
+        return size, returned
+
+activity = ActivityBitmaps(ACTIVITY_DIR)
+if not activity.load():
+    activity.bootstrap(users)
+    activity.save()
+elif activity.legacy_cohorts:
+    activity.rebuild_cohorts(users)
+    activity.save()
+
+def today_ordinal():
+    """Ординал сегодняшней даты по Ташкенту"""
+    return clock.now(ZoneInfo("Asia/Tashkent")).date().toordinal()
+
+def describe_activity():
+    """DAU/WAU/MAU и retention для админ-статистики"""
+    today = today_ordinal()
+    dau = activity.active(today)
+    mau = activity.active(today, 30)
+    text = f"🔥 DAU: {dau} · WAU: {activity.active(today, 7)} · MAU: {mau}\n"
+    if mau:
+        text += f"🧲 DAU/MAU: {dau / mau:.1%}\n"
+    parts = []
+    for n in RETENTION_DAYS:
+        size, returned = activity.retention(today - 1, n)
+        parts.append(f"D{n} {returned / size:.1%}" if size else f"D{n} —")
+    return text + f"🔁 Retention: {' · '.join(parts)}"
+
+def read_activity_days(keys):
+    """Карты (суффикс, день), которых нет в памяти, с диска (в потоке записи)"""
+    loaded = {}
+    for key in keys:
+        if key in activity.days:
+            continue
+        path = activity.day_path(key[1], key[0])
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                loaded[key] = f.read()
+    return loaded
+
+async def preload_activity(days, suffixes=(ACTIVITY_SUFFIX,)):
+    """Подгружает карты дней в память через поток записи, чтобы не читать диск в цикле"""
+    keys = [(suffix, day) for day in days for suffix in suffixes]
+    for key, data in (await run_io(read_activity_days, keys)).items():
+        activity.days.setdefault(key, bytearray(data))
+
+# ---------------- OUTBOUND LANES ----------------
+class OutboundScheduler:
+    """Раздаёт общий бюджет запросов между полосами по весам (smooth WRR)"""
+
+    # Запросы, которые не расходуют лимит на отправку сообщений
+    UNTHROTTLED_ENDPOINTS = frozenset({
+        "answerCallbackQuery", "answerInlineQuery", "getMe", "getUpdates",
+        "setMyCommands", "deleteWebhook", "getFile", "logOut", "close",
+    })
+
+    def __init__(self, rate, weights):
+        self.interval = 1 / rate
+        self.weights = weights
+        self.queues = {lane: deque() for lane in weights}
+        self.current = {lane: 0 for lane in weights}
+        self.paused_until = 0.0
+        self._wakeup = None
+        self._task = None
+
+    def backlog(self, lane):
+        return len(self.queues[lane])
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for waiters in self.queues.values():
+            while waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    future.cancel()
+
+    async def acquire(self, lane):
+        """Ждёт своей очереди на отправку в указанной полосе"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queues[lane].append(future)
+        self._wakeup.set()
+        await future
+
+    def pause(self, seconds):
+        """Останавливает все полосы (например, после RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _pick_lane(self):
+        eligible = [lane for lane, waiters in self.queues.items() if waiters]
+        # Рассылка уступает напоминаниям целиком, пока у них есть очередь
+        if "broadcast" in eligible and self.queues["reminder"]:
+            eligible.remove("broadcast")
+        if not eligible:
+            return None
+
+        total = 0
+        for lane in eligible:
+            self.current[lane] += self.weights[lane]
+            total += self.weights[lane]
+        best = max(eligible, key=self.current.__getitem__)
+        self.current[best] -= total
+        return best
+
+    async def _dispatch(self):
+        while True:
+            lane = self._pick_lane()
+            if lane is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            future = self.queues[lane].popleft()
+            if future.done():
+                continue
+            future.set_result(None)
+            await asyncio.sleep(self.interval)
+
+class LaneRateLimiter(BaseRateLimiter):
+    """Rate limiter PTB, направляющий запросы бота в свою полосу планировщика"""
+
+    def __init__(self, scheduler, lane):
+        self.scheduler = scheduler
+        self.lane = lane
+
+    async def initialize(self):
+        self.scheduler.start()
+
+    async def shutdown(self):
+        # Планировщик общий для всех полос — его останавливает post_shutdown
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        forget_edit(endpoint, data)
+        if endpoint in OutboundScheduler.UNTHROTTLED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        # Отслеживаемая отправка напоминания: отмечаем момент ухода запроса
+        in_flight = SENDS_IN_FLIGHT.get(asyncio.current_task())
+        for attempt in range(OUTBOUND_MAX_RETRIES):
+            await self.scheduler.acquire(self.lane)
+            if in_flight:
+                in_flight[3] = "sending"
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if in_flight:
+                    in_flight[3] = "queued"
+                if attempt == OUTBOUND_MAX_RETRIES - 1:
+                    raise
+                logging.warning(f"⏳ RetryAfter {e.retry_after}с в полосе {self.lane}")
+                self.scheduler.pause(e.retry_after)
+
+outbound = OutboundScheduler(OUTBOUND_RATE, LANE_WEIGHTS)
+LANE_BOTS = {}
+
+def build_lane_bot(lane):
+    """Создаёт отдельный бот с собственным пулом соединений для полосы"""
+    return ExtBot(
+        TOKEN,
+        request=HTTPXRequest(connection_pool_size=LANE_POOL_SIZES[lane]),
+        rate_limiter=LaneRateLimiter(outbound, lane),
+    )
+
+def lane_bot(context, lane):
+    """Бот для полосы reminder/broadcast (или основной бот, если полосы не подняты)"""
+    return LANE_BOTS.get(lane) or context.bot
+
+# ---------------- CONCURRENCY ----------------
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с сохранением порядка внутри чата"""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [lock, число ожидающих апдейтов]
+        self._chat_locks = {}
+
+    @staticmethod
+    def _chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        # Вызывается под общим семафором process_update: апдейт, ждущий
+        # своего чата, занимает слот воркера до конца предыдущего
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+BACKGROUND_TASKS = {}
+
+def is_background_running(name):
+    """Выполняется ли фоновая админская операция"""
+    task = BACKGROUND_TASKS.get(name)
+    return task is not None and not task.done()
+
+def start_background(context, name, coroutine):
+    """Запускает долгую админскую операцию в фоне, не блокируя обработку апдейтов"""
+    BACKGROUND_TASKS[name] = context.application.create_task(coroutine)
+    return BACKGROUND_TASKS[name]
+
+# ---------------- LOOP LAG ----------------
+# Задержка цикла событий: насколько позже запланированного просыпается
+# короткий sleep. Большие значения означают блокирующий код в цикле.
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WARN = 0.2
+loop_lag = {"last": 0.0, "max": 0.0, "total": 0.0, "samples": 0}
+
+async def monitor_loop_lag():
+    """Постоянно меряет задержку цикла событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        loop_lag["last"] = lag
+        loop_lag["max"] = max(loop_lag["max"], lag)
+        loop_lag["total"] += lag
+        loop_lag["samples"] += 1
+        if lag > LOOP_LAG_WARN:
+            logging.warning(f"🐢 Цикл событий был заблокирован на {lag * 1000:.0f} мс")
+
+def describe_loop_lag():
+    """Строка со средней и максимальной задержкой цикла"""
+    samples = loop_lag["samples"]
+    avg = loop_lag["total"] / samples if samples else 0.0
+    return f"ср {avg * 1000:.1f} мс, макс {loop_lag['max'] * 1000:.0f} мс"
+
+# ---------------- PROFILING ----------------
+# Семплирующий профайлер: отдельный поток раз в PROFILE_INTERVAL смотрит
+# стек главного потока и засчитывает семпл, только если сейчас выполняется
+# задача помеченной цели (тик планировщика, обработка кнопки, рассылка).
+# Пока профилирование выключено, обёртка стоит одну проверку множества.
+PROFILE_TARGETS = ("scheduler", "buttons", "broadcast")
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 40
+MEMORY_TRACE_FRAMES = 10
+
+class SamplingProfiler:
+    """Семплы стеков задач выбранных целей"""
+
+    def __init__(self):
+        self.targets = set()
+        self.tasks = {}  # задача -> цель
+        self.samples = {target: Counter() for target in PROFILE_TARGETS}
+        self.idle = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, targets, loop):
+        self.samples = {target: Counter() for target in PROFILE_TARGETS}
+        self.idle = 0
+        self.targets = set(targets)
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(loop, threading.get_ident()),
+            name="profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self.targets = set()
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, loop, thread_id):
+        while not self._stop.wait(PROFILE_INTERVAL):
+            target = self.tasks.get(asyncio.current_task(loop))
+            if target is None:
+                self.idle += 1
+                continue
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            self.samples[target][tuple(reversed(stack))] += 1
+
+    def report(self):
+        """Текстовый отчёт: топ функций по собственному и общему времени, свёрнутые стеки"""
+        lines = [f"Интервал семплирования: {PROFILE_INTERVAL * 1000:.0f} мс, семплов вне целей: {self.idle}"]
+        for target, stacks in self.samples.items():
+            total = sum(stacks.values())
+            if not total:
+                continue
+            own = Counter()
+            inclusive = Counter()
+            for stack, count in stacks.items():
+                own[stack[-1][:2]] += count
+                for func in {frame[:2] for frame in stack}:
+                    inclusive[func] += count
+            
+            lines.append(f"\n=== {target}: {total} семплов (~{total * PROFILE_INTERVAL:.2f} с) ===")
+            lines.append("\n-- собственное время --")
+            for (filename, name), count in own.most_common(PROFILE_TOP):
+                lines.append(f"{count / total:6.1%} {count:7d}  {name} ({filename})")
+            lines.append("\n-- включая вызовы --")
+            for (filename, name), count in inclusive.most_common(PROFILE_TOP):
+                lines.append(f"{count / total:6.1%} {count:7d}  {name} ({filename})")
+            lines.append("\n-- свёрнутые стеки (для flamegraph) --")
+            for stack, count in stacks.most_common(PROFILE_TOP):
+                lines.append(";".join(f"{name}:{line}" for _, name, line in stack) + f" {count}")
+        return "\n".join(lines)
+
+profiler = SamplingProfiler()
+
+def profiled(target):
+    """Помечает задачу корутины как цель профилирования на время её выполнения"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if target not in profiler.targets:
+                return await func(*args, **kwargs)
+            task = asyncio.current_task()
+            previous = profiler.tasks.get(task)
+            profiler.tasks[task] = target
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                if previous is None:
+                    profiler.tasks.pop(task, None)
+                else:
+                    profiler.tasks[task] = previous
+        return wrapper
+    return decorator
+
+async def run_profiler(context: ContextTypes.DEFAULT_TYPE, chat_id, targets, seconds):
+    """Профилирует цели заданное время и присылает отчёт документом"""
+    profiler.start(targets, asyncio.get_running_loop())
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+        profiler.tasks.clear()
+    
+    report = await asyncio.to_thread(profiler.report)
+    stamp = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y%m%d_%H%M%S")
+    await context.bot.send_document(
+        chat_id=chat_id,
+        document=BytesIO(report.encode("utf-8")),
+        filename=f"profile_{stamp}.txt",
+        caption=f"🔬 Профиль {', '.join(sorted(targets))} за {seconds} с"
+    )
+
+def deep_sizeof(obj):
+    """Приблизительный размер объекта со всем содержимым, байт"""
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+        elif isinstance(item, (str, bytes, int, float, bool, array)) or item is None:
+            continue
+        else:
+            for slot in getattr(type(item), "__slots__", ()):
+                value = getattr(item, slot, None)
+                if value is not None:
+                    stack.append(value)
+            if hasattr(item, "__dict__"):
+                stack.append(vars(item))
+    return size
+
+def structure_sizes():
+    """Размеры основных структур в памяти"""
+    structures = {
+        "users": users,
+        "audience": audience,
+        "TIMES_CACHE": TIMES_CACHE,
+        "notification_tracker": notification_tracker,
+        "pending_reminders": pending_reminders,
+        "RESPONSE_CACHE": RESPONSE_CACHE,
+        "EDIT_CACHE": EDIT_CACHE,
+        "INLINE_RESULTS_CACHE": INLINE_RESULTS_CACHE,
+        "LIVE_COUNTDOWNS": LIVE_COUNTDOWNS,
+    }
+    lines = []
+    for name, value in structures.items():
+        for _ in range(3):
+            try:
+                size = deep_sizeof(value)
+                break
+            except RuntimeError:
+                # Структура изменилась во время обхода — пробуем ещё раз
+                continue
+        else:
+            lines.append(f"{name:24} не удалось измерить")
+            continue
+        count = len(value) if hasattr(value, "__len__") else len(getattr(value, "all", ()))
+        lines.append(f"{name:24} {size / 1024 / 1024:9.2f} МБ  {count} записей")
+    return lines
+
+# Предыдущий снимок tracemalloc для сравнения
+memory_snapshots = []
+
+def memory_report():
+    """Отчёт tracemalloc (топ по строкам и прирост с прошлого снимка) и размеры структур"""
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"tracemalloc: сейчас {current / 1024 / 1024:.2f} МБ, пик {peak / 1024 / 1024:.2f} МБ"]
+    
+    lines.append("\n-- размеры структур --")
+    lines.extend(structure_sizes())
+    
+    lines.append(f"\n-- топ {PROFILE_TOP} по строкам --")
+    for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+        lines.append(str(stat))
+    
+    if memory_snapshots:
+        lines.append("\n-- прирост с прошлого снимка --")
+        for stat in snapshot.compare_to(memory_snapshots[-1], "lineno")[:PROFILE_TOP]:
+            lines.append(str(stat))
+    memory_snapshots[:] = [snapshot]
+    return "\n".join(lines)
+
+# ---------------- TIMETABLES ----------------
+# Расписание города хранится по сезонам: timetables/<город>/<дата начала>.json
+#   {"start": "2026-02-19", "suhoor": ["05:54", ...], "iftar": ["18:05", ...]}
+# (допускается и старый формат {"2026-02-19": {"suhoor": ..., "iftar": ...}}).
+# Старые times_<город>.json подхватываются как один из сезонов.
+# В памяти сезон — ординал первого дня и два массива минут от полуночи;
+# загружены только текущий и следующий сезоны, остальные — по запросу.
+TIMETABLE_PRELOAD_DAYS = 45
+TIMETABLE_MAX_LOADED = 3
+TIMETABLE_HOUR = 3
+
+def hhmm_to_minutes(value):
+    """Строка ЧЧ:ММ в минуты от полуночи"""
+    hours, sep, minutes = value.partition(":")
+    if not sep or len(minutes) != 2:
+        raise ValueError(f"неверное время {value!r}")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"неверное время {value!r}")
+    return hours * 60 + minutes
+
+def minutes_to_hhmm(value):
+    """Минуты от полуночи в строку ЧЧ:ММ"""
+    return f"{value // 60:02d}:{value % 60:02d}"
+
+class Season:
+    """Один сезон расписания: дни подряд начиная с start"""
+
+    __slots__ = ("start", "suhoor", "iftar")
+
+    def __init__(self, start, suhoor, iftar):
+        self.start = start
+        self.suhoor = suhoor
+        self.iftar = iftar
+
+    @property
+    def end(self):
+        return self.start + len(self.suhoor)
+
+    def day(self, ordinal):
+        """Время на день в формате старого JSON или None"""
+        i = ordinal - self.start
+        if not 0 <= i < len(self.suhoor):
+            return None
+        return {"suhoor": minutes_to_hhmm(self.suhoor[i]), "iftar": minutes_to_hhmm(self.iftar[i])}
+
+    @classmethod
+    def parse(cls, data):
+        """Проверяет и разбирает сезон из JSON (компактного или по датам)"""
+        if "start" in data:
+            start = date.fromisoformat(data["start"]).toordinal()
+            suhoor, iftar = data["suhoor"], data["iftar"]
+        else:
+            days = sorted(data)
+            start = date.fromisoformat(days[0]).toordinal()
+            for i, day in enumerate(days):
+                if date.fromisoformat(day).toordinal() != start + i:
+                    raise ValueError(f"пропущен день перед {day}")
+            suhoor = [data[day]["suhoor"] for day in days]
+            iftar = [data[day]["iftar"] for day in days]
+        
+        if len(suhoor) != len(iftar):
+            raise ValueError("разная длина suhoor и iftar")
+        if not 1 <= len(suhoor) <= 31:
+            raise ValueError(f"сезон из {len(suhoor)} дней")
+        
+        season = cls(start, array("H", map(hhmm_to_minutes, suhoor)), array("H", map(hhmm_to_minutes, iftar)))
+        for i, (s_min, i_min) in enumerate(zip(season.suhoor, season.iftar)):
+            if s_min >= i_min:
+                raise ValueError(f"сухур не раньше ифтара: {date.fromordinal(start + i)}")
+        return season
+
+class CityTimetable:
+    """Все сезоны города с dict-подобным доступом по строке даты.
+
+    Состояние (paths, starts, loaded) меняется только в цикле событий.
+    С диском работают только scan() и read() — в потоке записи, из
+    refresh_timetables; результат подставляется через apply()/add().
+    get() отвечает только по уже загруженным сезонам и диск не трогает.
+    """
+
+    def __init__(self, city):
+        self.city = city
+        self.paths = {}   # ординал начала -> файл сезона
+        self.loaded = {}  # ординал начала -> Season
+        self.starts = []
+        self._memo = {}
+
+    def scan(self):
+        """Находит файлы сезонов: (ординал начала -> файл, сезоны старых файлов times_<город>.json)"""
+        paths = {}
+        seasons = {}
+        legacy = os.path.join(BASE_DIR, f"times_{self.city}.json")
+        if os.path.exists(legacy):
+            season = self._read(legacy)
+            if season:
+                paths[season.start] = legacy
+                seasons[season.start] = season
+        
+        for directory in TIMETABLE_DIRS:
+            city_dir = os.path.join(directory, self.city)
+            if not os.path.isdir(city_dir):
+                continue
+            for name in sorted(os.listdir(city_dir)):
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    start = date.fromisoformat(name[:-5]).toordinal()
+                except ValueError:
+                    logging.warning(f"Пропускаю файл расписания {name}: имя должно быть датой начала")
+                    continue
+                paths[start] = os.path.join(city_dir, name)
+        return paths, seasons
+
+    def apply(self, paths, seasons):
+        """Подставляет результат scan(): сезоны изменившихся файлов выгружаются"""
+        loaded = {
+            start: season for start, season in self.loaded.items()
+            if self.paths.get(start) == paths.get(start)
+        }
+        loaded.update(seasons)
+        self.paths = paths
+        self.starts = sorted(paths)
+        self.loaded = loaded
+        self._memo = {}
+
+    def _read(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return Season.parse(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Ошибка расписания {path}: {e}")
+            return None
+
+    def read(self, start):
+        """Читает и проверяет сезон с диска; None, если файл некорректен"""
+        path = self.paths.get(start)
+        season = self._read(path) if path else None
+        if season is None or season.start != start:
+            if season is not None:
+                logging.error(f"Расписание {path}: дата начала не совпадает с именем файла")
+            return None
+        return season
+
+    def add(self, season):
+        """Кладёт прочитанный сезон в память"""
+        self.loaded[season.start] = season
+        self._memo = {}
+
+    def season_at(self, ordinal):
+        """Загруженный сезон, в который попадает день, или None"""
+        i = bisect_right(self.starts, ordinal) - 1
+        if i < 0:
+            return None
+        season = self.loaded.get(self.starts[i])
+        if season is None or ordinal >= season.end:
+            return None
+        return season
+
+    def start_at(self, ordinal):
+        """Начало последнего сезона, начавшегося не позже дня (или None)"""
+        i = bisect_right(self.starts, ordinal) - 1
+        return self.starts[i] if i >= 0 else None
+
+    def next_start(self, ordinal):
+        """Начало ближайшего сезона после дня (или None)"""
+        i = bisect_right(self.starts, ordinal)
+        return self.starts[i] if i < len(self.starts) else None
+
+    def trim(self, keep):
+        """Выгружает лишние сезоны, кроме keep"""
+        for start in list(self.loaded):
+            if len(self.loaded) <= TIMETABLE_MAX_LOADED:
+                break
+            if start not in keep:
+                del self.loaded[start]
+        self._memo = {}
+
+    def get(self, date_str, default=None):
+        memo = self._memo
+        value = memo.get(date_str, memo)
+        if value is memo:
+            try:
+                ordinal = date.fromisoformat(date_str).toordinal()
+            except ValueError:
+                return default
+            season = self.season_at(ordinal)
+            value = season.day(ordinal) if season else None
+            if len(memo) > 8:
+                memo.clear()
+            memo[date_str] = value
+        return default if value is None else value
+
+    def __contains__(self, date_str):
+        return self.get(date_str) is not None
+
+    def __getitem__(self, date_str):
+        value = self.get(date_str)
+        if value is None:
+            raise KeyError(date_str)
+        return value
+
+def get_city_times(city):
+    """Расписание города; сезоны в нём появляются после refresh_timetables"""
+    timetable = TIMES_CACHE.get(city)
+    if timetable is None:
+        timetable = TIMES_CACHE[city] = CityTimetable(city)
+    return timetable
+
+def read_seasons(timetable, starts):
+    """Читает сезоны с диска (в потоке записи): ординал начала -> Season или None"""
+    return {start: timetable.read(start) for start in starts}
+
+async def refresh_timetables():
+    """Пересканирует сезоны, заранее загружает и проверяет следующий; возвращает список проблем.
+
+    Диск читается в потоке записи, а состояние расписаний меняется
+    только здесь, в цикле событий.
+    """
+    problems = []
+    for city in SUPPORTED_CITIES:
+        timetable = get_city_times(city)
+        timetable.apply(*await run_io(timetable.scan))
+        today = clock.now(get_city_tz(city)).date().toordinal()
+        
+        current_start = timetable.start_at(today)
+        next_start = timetable.next_start(today)
+        if next_start is not None and next_start - today > TIMETABLE_PRELOAD_DAYS:
+            next_start = None
+        wanted = [start for start in (current_start, next_start) if start is not None and start not in timetable.loaded]
+        if wanted:
+            for season in (await run_io(read_seasons, timetable, wanted)).values():
+                if season is not None:
+                    timetable.add(season)
+        
+        current = timetable.season_at(today)
+        keep = {current.start} if current else set()
+        if next_start is not None:
+            season = timetable.loaded.get(next_start)
+            if season is None:
+                problems.append(
+                    f"❌ {get_city_name(city, 'ru')}: расписание сезона с "
+                    f"{date.fromordinal(next_start)} не прошло проверку"
+                )
+            else:
+                keep.add(next_start)
+                logging.info(
+                    f"📅 {city}: следующий сезон с {date.fromordinal(next_start)} "
+                    f"({len(season.suhoor)} дн.) загружен заранее"
+                )
+        elif current is None and timetable.next_start(today) is None:
+            logging.warning(f"📅 {city}: нет расписания на текущий или будущий сезон")
+        
+        timetable.trim(keep)
+    return problems
+
+async def timetable_job(context: ContextTypes.DEFAULT_TYPE):
+    """Ежедневная проверка и предзагрузка сезонов расписания"""
+    problems = await refresh_timetables()
+    if problems:
+        try:
+            await context.bot.send_message(chat_id=ADMIN_ID, text="\n".join(problems))
+        except Exception as e:
+            logging.error(f"Не удалось сообщить админу о расписании: {e}")
+
+# ---------------- HELPERS ----------------
+def t(uid, key):
+    """Получает перевод с fallback"""
+    uid = str(uid)
+    lang = users.get(uid, {}).get("lang", "uz")
+    
+    text = TEXTS.get(lang, TEXTS["uz"]).get(key)
+    if text is None:
+        text = TEXTS["uz"].get(key, TEXTS["ru"].get(key, key))
+    return text
+
+def get_text_by_lang(lang, key):
+    """Получает текст на конкретном языке (для onboarding)"""
+    text = TEXTS.get(lang, TEXTS["uz"]).get(key)
+    if text is None:
+        text = TEXTS["uz"].get(key, TEXTS["ru"].get(key, key))
+    return text
+
+def get_city_tz(city):
+    """Часовой пояс города"""
+    return ZoneInfo("Europe/Berlin" if city == "bremen" else "Asia/Tashkent")
+
+def get_tz(uid):
+    """Получает часовой пояс пользователя"""
+    uid = str(uid)
+    city = users.get(uid, {}).get("city", "tashkent")
+    return get_city_tz(city)
+
+def format_pretty_date_lang(dt, lang):
+    """Форматирует дату красиво на конкретном языке"""
+    months = TEXTS.get(lang, TEXTS["uz"])["months"]
+    month = months[dt.month - 1]
+    return f"{dt.day} {month} {dt.year}"
+
+def format_pretty_date(dt, uid):
+    """Форматирует дату красиво"""
+    uid = str(uid)
+    lang = users.get(uid, {}).get("lang", "uz")
+    return format_pretty_date_lang(dt, lang)
+
+def get_city_name(city, lang):
+    """Возвращает название города на нужном языке"""
+    names = {
+        "tashkent": {"uz": "Tashkent 🇺🇿", "ru": "Ташкент 🇺🇿"},
+        "bremen": {"uz": "Bremen 🇩🇪", "ru": "Бремен 🇩🇪"}
+    }
+    return names.get(city, {}).get(lang, city)
+
+def get_lang_name(lang):
+    """Возвращает название языка"""
+    names = {"uz": "O'zbekcha 🇺🇿", "ru": "Русский 🇷🇺"}
+    return names.get(lang, lang)
+
+def get_lang(uid):
+    """Язык пользователя (uz по умолчанию)"""
+    return users.get(str(uid), {}).get("lang", "uz")
+
+# ---------------- RESPONSE CACHE ----------------
+# Клавиатуры зависят только от языка и не меняются
+KEYBOARD_CACHE = {}
+# (вид, язык, город, дата, ...) -> (истекает_в_ts, текст)
+RESPONSE_CACHE = {}
+# Протухшие ответы вычищаются не чаще раза в RESPONSE_CACHE_PURGE_INTERVAL
+# секунд: между чистками они просто не отдаются (проверка срока при чтении)
+RESPONSE_CACHE_PURGE_INTERVAL = 300
+_response_cache_purge_at = 0.0
+
+def local_midnight_ts(city):
+    """Метка времени ближайшей полуночи по времени города"""
+    now = clock.now(get_city_tz(city))
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return midnight.timestamp()
+
+def purge_response_cache():
+    """Удаляет протухшие ответы (не чаще раза в RESPONSE_CACHE_PURGE_INTERVAL)"""
+    global _response_cache_purge_at
+    now_ts = clock.time()
+    if now_ts < _response_cache_purge_at:
+        return
+    _response_cache_purge_at = now_ts + RESPONSE_CACHE_PURGE_INTERVAL
+    for key in [key for key, (expires, _) in RESPONSE_CACHE.items() if expires <= now_ts]:
+        del RESPONSE_CACHE[key]
+
+def day_response(city, lang, day):
+    """Текст расписания на дату (кэшируется до полуночи города); None, если данных нет"""
+    date_str = day.strftime("%Y-%m-%d")
+    key = ("day", lang, city, date_str)
+    entry = RESPONSE_CACHE.get(key)
+    if entry and entry[0] > clock.time():
+        return entry[1]
+    
+    res = get_city_times(city).get(date_str)
+    text = None
+    if res:
+        text = (
+            f"📅 {format_pretty_date_lang(day, lang)}\n\n"
+            f"{get_text_by_lang(lang, 'suhoor_until')} {res['suhoor']}\n"
+            f"{get_text_by_lang(lang, 'iftar_time')} {res['iftar']}"
+        )
+    
+    purge_response_cache()
+    RESPONSE_CACHE[key] = (local_midnight_ts(city), text)
+    return text
+
+def my_settings_response(lang, city, remind):
+    """Текст экрана «Мои настройки» (зависит только от языка, города и напоминания)"""
+    key = ("my_settings", lang, city, remind)
+    entry = RESPONSE_CACHE.get(key)
+    if entry:
+        return entry[1]
+    
+    text = (
+        f"⚙️ {get_text_by_lang(lang, 'my_settings_title')}\n\n"
+        f"🌍 {get_text_by_lang(lang, 'set_city_btn')}: {get_city_name(city, lang)}\n"
+        f"🌐 {get_text_by_lang(lang, 'set_lang_btn')}: {get_lang_name(lang)}\n"
+        f"🔔 {get_text_by_lang(lang, 'set_remind_btn')}: {remind} {get_text_by_lang(lang, 'minute')}"
+    )
+    RESPONSE_CACHE[key] = (float("inf"), text)
+    return text
+
+# ---------------- EDIT CACHE ----------------
+# (chat_id, message_id) -> (текст, клавиатура) последней правки.
+# Любой запрос, меняющий сообщение, сбрасывает запись (см. forget_edit в
+# LaneRateLimiter), а edit_message_cached и отсчёты запоминают её заново
+# после успешной правки — прямые правки не оставляют устаревших записей.
+EDIT_CACHE = {}
+EDIT_CACHE_MAX = 20000
+EDITING_ENDPOINTS = frozenset({
+    "editMessageText", "editMessageCaption", "editMessageMedia",
+    "editMessageReplyMarkup", "deleteMessage",
+})
+# (uid, message_id, callback) -> [время последней обработки, отложенная
+# правка (TimerHandle) или None, последнее нажатие (q, render) или None]
+COUNTDOWN_TAPS = {}
+COUNTDOWN_DEBOUNCE = 1.5
+# Выполняющиеся отложенные правки (держим ссылки до завершения)
+TAP_EDITS = set()
+
+def remember_edit(key, text, reply_markup):
+    """Запоминает содержимое сообщения (старые записи вытесняются)"""
+    EDIT_CACHE.pop(key, None)
+    EDIT_CACHE[key] = (text, reply_markup)
+    if len(EDIT_CACHE) > EDIT_CACHE_MAX:
+        del EDIT_CACHE[next(iter(EDIT_CACHE))]
+
+def forget_edit(endpoint, data):
+    """Сбрасывает запись кэша для сообщения, которое меняет запрос"""
+    if endpoint not in EDITING_ENDPOINTS or not EDIT_CACHE or not data:
+        return
+    try:
+        key = (int(data["chat_id"]), int(data["message_id"]))
+    except (KeyError, TypeError, ValueError):
+        return
+    EDIT_CACHE.pop(key, None)
+
+async def edit_message_cached(q, text, reply_markup=None):
+    """Правит сообщение кнопки, пропуская правки без изменений"""
+    message = q.message
+    key = (message.chat.id, message.message_id)
+    cached = EDIT_CACHE.get(key)
+    if cached is None:
+        cached = (message.text, message.reply_markup)
+    if cached[0] == text and cached[1] == reply_markup:
+        return False
+    
+    try:
+        await q.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    remember_edit(key, text, reply_markup)
+    return True
+
+def coalesce_tap(uid, q, render):
+    """Сливает частые нажатия одной кнопки; True, если это нажатие отложено.
+
+    Первое нажатие обрабатывается сразу. Повторы в пределах COUNTDOWN_DEBOUNCE
+    не теряются: в конце окна выполняется одна правка render(q) с последним
+    нажатием, то есть с актуальным на тот момент состоянием.
+    """
+    now_ts = time.monotonic()
+    key = (uid, q.message.message_id, q.data)
+    entry = COUNTDOWN_TAPS.get(key)
+    if entry is not None and now_ts - entry[0] < COUNTDOWN_DEBOUNCE:
+        entry[2] = (q, render)
+        if entry[1] is None:
+            entry[1] = asyncio.get_running_loop().call_later(
+                entry[0] + COUNTDOWN_DEBOUNCE - now_ts, run_trailing_tap, key
+            )
+        return True
+    
+    # Записи идут в порядке нажатий — вытесняем с начала всё старше окна
+    COUNTDOWN_TAPS.pop(key, None)
+    while COUNTDOWN_TAPS:
+        oldest = next(iter(COUNTDOWN_TAPS))
+        entry = COUNTDOWN_TAPS[oldest]
+        if entry[1] is not None or now_ts - entry[0] < COUNTDOWN_DEBOUNCE:
+            break
+        del COUNTDOWN_TAPS[oldest]
+    COUNTDOWN_TAPS[key] = [now_ts, None, None]
+    return False
+
+def run_trailing_tap(key):
+    """Конец окна: правка по последнему отложенному нажатию"""
+    entry = COUNTDOWN_TAPS.pop(key, None)
+    if entry is None or entry[2] is None:
+        return
+    q, render = entry[2]
+    # Правка считается обработанным нажатием и открывает новое окно
+    COUNTDOWN_TAPS[key] = [time.monotonic(), None, None]
+    task = asyncio.get_running_loop().create_task(render_trailing_tap(q, render))
+    TAP_EDITS.add(task)
+    task.add_done_callback(TAP_EDITS.discard)
+
+async def render_trailing_tap(q, render):
+    try:
+        await render(q)
+    except TelegramError as e:
+        logging.warning(f"Не удалось применить отложенное нажатие: {e}")
+    except Exception as e:
+        logging.error(f"Ошибка отложенного нажатия: {e}")
+
+# ---------------- LIVE COUNTDOWN ----------------
+# uid -> [message_id, событие, метка времени события]
+LIVE_COUNTDOWNS = {}
+LIVE_COUNTDOWN_LIMIT = int(os.getenv("LIVE_COUNTDOWN_LIMIT", "1000"))
+LIVE_COUNTDOWN_CALLBACKS = (
+    "run_countdown_iftar", "run_countdown_suhoor",
+    "live_countdown_iftar", "live_countdown_suhoor", "live_countdown_stop"
+)
+
+def countdown_text(uid, event, now):
+    """Текст обратного отсчёта; (текст, метка времени события или None, если событие прошло)"""
+    times = get_city_times(users[uid]["city"])
+    today = now.strftime("%Y-%m-%d")
+    if today not in times:
+        return t(uid, "no_data"), None
+    
+    event_time = times[today][event]
+    event_dt = datetime.strptime(
+        f"{today} {event_time}", 
+        "%Y-%m-%d %H:%M"
+    ).replace(tzinfo=now.tzinfo)
+    
+    if event_dt <= now:
+        return t(uid, f"{event}_time_now"), None
+    return countdown_body(uid, event, event_dt.timestamp() - now.timestamp(), event_time), event_dt.timestamp()
+
+def countdown_body(uid, event, seconds_left, event_time):
+    """Оставшееся до события время"""
+    total_seconds = int(seconds_left)
+    hours = total_seconds // 3600
+    minutes = (total_seconds % 3600) // 60
+    return (
+        f"{t(uid, f'{event}_left')}\n\n"
+        f"⏳ {hours} {t(uid, 'hour')} {minutes} {t(uid, 'minute')}\n"
+        f"🕰 {event_time}"
+    )
+
+def countdown_kb(uid, event, live):
+    """Главная клавиатура с кнопкой включения/выключения живого отсчёта"""
+    lang = get_lang(uid)
+    key = ("countdown", lang, event, live)
+    kb = KEYBOARD_CACHE.get(key)
+    if kb is None:
+        if live:
+            toggle = InlineKeyboardButton(get_text_by_lang(lang, "live_countdown_off"), callback_data="live_countdown_stop")
+        else:
+            toggle = InlineKeyboardButton(get_text_by_lang(lang, "live_countdown_on"), callback_data=f"live_countdown_{event}")
+        kb = KEYBOARD_CACHE[key] = InlineKeyboardMarkup(
+            [[toggle]] + list(main_kb_for_lang(lang).inline_keyboard)
+        )
+    return kb
+
+async def show_countdown(uid, q, event):
+    """Показывает отсчёт до события в сообщении кнопки"""
+    if uid not in users:
+        return
+    text, event_ts = countdown_text(uid, event, clock.now(get_tz(uid)))
+    if event_ts is None:
+        stop_live_countdown(uid, q.message.message_id)
+        await edit_message_cached(q, text, reply_markup=main_kb(uid))
+        return
+    
+    sub = live_countdown_of(uid, q.message.message_id)
+    if sub and sub[1] == event:
+        text, kb, _ = live_countdown_render(uid, sub, clock.time())
+    else:
+        stop_live_countdown(uid, q.message.message_id)
+        live_allowed = len(LIVE_COUNTDOWNS) < LIVE_COUNTDOWN_LIMIT
+        kb = countdown_kb(uid, event, False) if live_allowed else main_kb(uid)
+    
+    await edit_message_cached(q, text, reply_markup=kb)
+
+def live_countdown_of(uid, message_id):
+    """Подписка на живой отсчёт для этого сообщения (или None)"""
+    sub = LIVE_COUNTDOWNS.get(uid)
+    if sub and sub[0] == message_id:
+        return sub
+    return None
+
+def stop_live_countdown(uid, message_id=None):
+    """Отписывает пользователя (только если подписано именно это сообщение)"""
+    sub = LIVE_COUNTDOWNS.get(uid)
+    if sub and (message_id is None or sub[0] == message_id):
+        del LIVE_COUNTDOWNS[uid]
+
+def live_countdown_render(uid, sub, now_ts):
+    """Текст и клавиатура очередного обновления; (текст, клавиатура, последнее ли)"""
+    message_id, event, event_ts = sub
+    if event_ts <= now_ts:
+        return t(uid, f"{event}_time_now"), main_kb(uid), True
+    
+    event_time = datetime.fromtimestamp(event_ts, get_tz(uid)).strftime("%H:%M")
+    text = f"{countdown_body(uid, event, event_ts - now_ts, event_time)}\n\n{t(uid, 'live_countdown_note')}"
+    return text, countdown_kb(uid, event, True), False
+
+async def live_countdown_tick(context: ContextTypes.DEFAULT_TYPE):
+    """Ежеминутный тик: запускает пакетное обновление живых отсчётов"""
+    if not LIVE_COUNTDOWNS or is_shutting_down():
+        return
+    if is_background_running("live_countdown"):
+        logging.warning(f"⏳ Обновление отсчётов не успело за минуту ({len(LIVE_COUNTDOWNS)} подписок)")
+        return
+    start_background(context, "live_countdown", update_live_countdowns(context))
+
+async def update_live_countdowns(context):
+    """Правит все подписанные сообщения пачками через полосу рассылки"""
+    bot = lane_bot(context, "broadcast")
+    now_ts = clock.time()
+    edits = []
+    newly_blocked = 0
+    
+    for uid, sub in list(LIVE_COUNTDOWNS.items()):
+        user = users.get(uid)
+        if not user or user.get("is_blocked"):
+            del LIVE_COUNTDOWNS[uid]
+            continue
+        text, kb, final = live_countdown_render(uid, sub, now_ts)
+        if final:
+            del LIVE_COUNTDOWNS[uid]
+        
+        key = (int(uid), sub[0])
+        if EDIT_CACHE.get(key) == (text, kb):
+            continue
+        edits.append((uid, key, text, kb))
+    
+    async def edit(uid, key, text, kb):
+        nonlocal newly_blocked
+        try:
+            await bot.edit_message_text(chat_id=key[0], message_id=key[1], text=text, reply_markup=kb)
+        except Forbidden:
+            stop_live_countdown(uid)
+            if mark_user_blocked(uid, save=False):
+                newly_blocked += 1
+            return False
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                # Сообщение удалено или слишком старое — подписка больше не нужна
+                stop_live_countdown(uid, key[1])
+                return False
+        remember_edit(key, text, kb)
+        return True
+    
+    batch_size = LANE_POOL_SIZES["broadcast"] * 4
+    ok = failed = 0
+    for i in range(0, len(edits), batch_size):
+        results = await asyncio.gather(
+            *(edit(*item) for item in edits[i:i + batch_size]),
+            return_exceptions=True
+        )
+        for result in results:
+            if result is True:
+                ok += 1
+            else:
+                failed += 1
+                if isinstance(result, Exception):
+                    logging.warning(f"Ошибка обновления отсчёта: {result}")
+    
+    if newly_blocked:
+        save_users()
+    if edits:
+        logging.info(f"⏳ Живые отсчёты: обновлено {ok}, ошибок {failed}, подписок {len(LIVE_COUNTDOWNS)}")
+
+# ---------------- USER EXPORT ----------------
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_FIELDS = (
+    "uid", "first_name", "username", "lang", "city", "remind_min",
+    "joined", "last_active", "push_sent", "is_blocked", "blocked_date", "unblocked_date"
+)
+EXPORT_CHUNK = 2000
+
+def parse_export_args(args):
+    """Разбирает аргументы /export: формат и фильтры status=, city=, lang="""
+    fmt = "csv"
+    filters_ = {}
+    for arg in args:
+        arg = arg.lower()
+        if arg in EXPORT_FORMATS:
+            fmt = arg
+            continue
+        key, sep, value = arg.partition("=")
+        if not sep or key not in ("status", "city", "lang") or not value:
+            raise ValueError(arg)
+        if key == "status" and value not in ("all", "active", "blocked"):
+            raise ValueError(arg)
+        filters_[key] = value
+    return fmt, filters_
+
+def export_user_ids(filters_):
+    """Id пользователей под фильтр (по индексам аудитории)"""
+    sets = []
+    if filters_.get("city"):
+        sets.append(audience.by_city.get(filters_["city"], set()))
+    if filters_.get("lang"):
+        sets.append(audience.by_lang.get(filters_["lang"], set()))
+    result = sets[0].intersection(*sets[1:]) if sets else set(audience.all)
+    
+    status = filters_.get("status", "all")
+    if status == "active":
+        result -= audience.blocked
+    elif status == "blocked":
+        result &= audience.blocked
+    return sorted(result, key=int)
+
+def describe_export_filters(filters_):
+    """Описание фильтров выгрузки"""
+    if not filters_:
+        return "все пользователи"
+    return ", ".join(f"{key}={value}" for key, value in filters_.items())
+
+def format_export_rows(records, fmt, header=False):
+    """Текст пачки выгрузки по парам (uid, запись)"""
+    buffer = StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(EXPORT_FIELDS)
+        writer.writerows(
+            [uid] + ["" if user.get(field) is None else user.get(field) for field in EXPORT_FIELDS[1:]]
+            for uid, user in records
+        )
+    else:
+        for uid, user in records:
+            buffer.write(json.dumps({"uid": uid, **user.to_dict()}, ensure_ascii=False) + "\n")
+    return buffer.getvalue()
+
+def open_export_file(fmt):
+    """Временный файл выгрузки (в потоке записи)"""
+    return tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="", suffix=f".{fmt}", delete=False)
+
+def read_file_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+async def write_users_export(f, uids, fmt):
+    """Пишет записи пачками: текст готовится в цикле событий, запись — в потоке; возвращает число строк"""
+    written = 0
+    for i in range(0, max(len(uids), 1), EXPORT_CHUNK):
+        records = [(uid, users[uid]) for uid in uids[i:i + EXPORT_CHUNK] if uid in users]
+        text = format_export_rows(records, fmt, header=i == 0)
+        if text:
+            await run_io(f.write, text)
+        written += len(records)
+    return written
+
+def export_filter_matches(user, filters_):
+    """Подходит ли запись под фильтры выгрузки (для архивных, которых нет в индексах)"""
+    if filters_.get("city") and user.city != filters_["city"]:
+        return False
+    if filters_.get("lang") and user.lang != filters_["lang"]:
+        return False
+    status = filters_.get("status", "all")
+    if status == "active":
+        return not user.is_blocked
+    if status == "blocked":
+        return bool(user.is_blocked)
+    return True
+
+def write_archived_export(f, wanted, in_flight, fmt, filters_):
+    """Дописывает архивных пользователей под фильтр (в потоке записи); возвращает число строк.
+
+    wanted — копия archived_uids, in_flight — перенесённые, но ещё не записанные в архив.
+    """
+    archive = load_archive()
+    archive.update(in_flight)
+    records = sorted(
+        ((uid, user) for uid, user in archive.items() if uid in wanted and export_filter_matches(user, filters_)),
+        key=lambda item: int(item[0])
+    )
+    for i in range(0, len(records), EXPORT_CHUNK):
+        f.write(format_export_rows(records[i:i + EXPORT_CHUNK], fmt))
+    return len(records)
+
+async def run_users_export(context: ContextTypes.DEFAULT_TYPE, chat_id, status_message, fmt, filters_):
+    """Фоновая выгрузка пользователей во временный файл и отправка документом"""
+    uids = export_user_ids(filters_)
+    path = None
+    try:
+        f = await run_io(open_export_file, fmt)
+        path = f.name
+        try:
+            written = await write_users_export(f, uids, fmt)
+            # Архивные (давно заблокировавшие) идут после активных, отдельным хвостом файла
+            archived = 0
+            if archived_uids or archive_in_flight:
+                archived = await run_io(
+                    write_archived_export, f, set(archived_uids), dict(archive_in_flight), fmt, filters_
+                )
+            written += archived
+        finally:
+            await run_io(f.close)
+        
+        stamp = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y%m%d_%H%M")
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=await run_io(read_file_bytes, path),
+            filename=f"users_{stamp}.{fmt}",
+            caption=(
+                f"📤 Выгрузка: {written} записей, из них из архива {archived} "
+                f"({describe_export_filters(filters_)})"
+            )
+        )
+        await status_message.edit_text(f"✅ Выгрузка готова: {written} записей")
+        logging.info(f"📤 Выгрузка пользователей: {written} записей, {fmt}, {describe_export_filters(filters_)}")
+    except Exception as e:
+        logging.error(f"Ошибка выгрузки пользователей: {e}")
+        try:
+            await status_message.edit_text(f"❌ Ошибка выгрузки: {e}")
+        except Exception:
+            pass
+    finally:
+        if path:
+            await run_io(remove_file, path)
+
+async def start_users_export(context, chat_id, status_message, fmt, filters_):
+    """Запускает выгрузку, если она ещё не идёт; False, если уже выполняется"""
+    if is_background_running("export"):
+        return False
+    start_background(context, "export", run_users_export(context, chat_id, status_message, fmt, filters_))
+    return True
+
+# ---------------- NEW: BLOCK CHECK FUNCTIONS ----------------
+async def check_user_blocked(bot, user_id: int) -> bool:
+    """Проверяет, заблокировал ли пользователь бота"""
+    try:
+        await bot.send_chat_action(chat_id=user_id, action="typing")
+        return False
+    except Forbidden:
+        return True
+    except Exception:
+        return False
+
+async def update_users_block_status(context: ContextTypes.DEFAULT_TYPE, progress=None):
+    """Обновляет статус блокировки для всех пользователей"""
+    blocked_count = 0
+    changed = False
+    bot = lane_bot(context, "broadcast")
+    uids = list(users.keys())
+    
+    for checked, uid in enumerate(uids, 1):
+        try:
+            is_blocked = await check_user_blocked(bot, int(uid))
+            if is_blocked:
+                changed |= mark_user_blocked(uid, save=False)
+                blocked_count += 1
+            else:
+                changed |= mark_user_unblocked(uid, save=False)
+        except Exception as e:
+            logging.error(f"Ошибка проверки пользователя {uid}: {e}")
+        
+        if progress and checked % BLOCK_CHECK_PROGRESS_EVERY == 0:
+            await progress(checked, len(uids), blocked_count)
+    
+    if changed:
+        save_users()
+    if blocked_count > 0:
         logging.info(f"Обнаружено {blocked_count} заблокировавших бота")
     
     return blocked_count
 
+async def run_block_check(context: ContextTypes.DEFAULT_TYPE, status_message):
+    """Фоновая проверка блокировок с отчётом о прогрессе"""
+    async def progress(checked, total, blocked):
+        try:
+            await status_message.edit_text(
+                f"🔄 Проверяю статусы пользователей...\n\n"
+                f"Проверено: {checked}/{total}\n"
+                f"🔴 Заблокировали: {blocked}"
+            )
+        except Exception as e:
+            logging.warning(f"Не удалось обновить прогресс проверки: {e}")
+    
+    await update_users_block_status(context, progress=progress)
+    
+    blocked_users = [uid for uid, data in users.items() if data.get("is_blocked")]
+    
+    text = (
+        f"✅ Проверка завершена!\n\n"
+        f"👥 Всего пользователей: {len(users)}\n"
+        f"🔴 Заблокировали бота: {len(blocked_users)}\n"
+        f"🟢 Активных: {len(users) - len(blocked_users)}"
+    )
+    
+    if blocked_users:
+        text += f"\n\n📋 Список заблокировавших ({min(10, len(blocked_users))} из {len(blocked_users)}):\n"
+        for uid in blocked_users[:10]:
+            user = users[uid]
+            blocked_date = user.get("blocked_date", "неизвестно")
+            name = user.get("first_name", "Unknown")
+            text += f"• {name} (ID: {uid}) - {blocked_date}\n"
+    
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("👥 Просмотреть пользователей", callback_data="admin_users_0_all")],
+        [InlineKeyboardButton("⬅️ В меню админа", callback_data="admin_back")]
+    ])
+    
+    await status_message.edit_text(text, reply_markup=kb)
+
 def get_user_status_info(user_data: dict) -> tuple:
     """Возвращает (эмодзи, текст_статуса, дата_блокировки)"""
     if user_data.get("is_blocked"):
@@ -310,31 +3010,65 @@ def get_user_status_info(user_data: dict) -> tuple:
     return "🟢", "Активен", None
 
 # ---------------- KEYBOARDS ----------------
+def main_kb_for_lang(lang):
+    """Главная клавиатура для языка (строится один раз)"""
+    key = ("main", lang)
+    kb = KEYBOARD_CACHE.get(key)
+    if kb is None:
+        kb = KEYBOARD_CACHE[key] = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(get_text_by_lang(lang, "today"), callback_data="day_today"),
+                InlineKeyboardButton(get_text_by_lang(lang, "tomorrow"), callback_data="day_tomorrow")
+            ],
+            [
+                InlineKeyboardButton(get_text_by_lang(lang, "countdown_iftar"), callback_data="run_countdown_iftar"),
+                InlineKeyboardButton(get_text_by_lang(lang, "countdown_suhoor"), callback_data="run_countdown_suhoor")
+            ],
+            [InlineKeyboardButton(get_text_by_lang(lang, "my_settings"), callback_data="show_settings")],
+            [InlineKeyboardButton(get_text_by_lang(lang, "settings"), callback_data="menu_settings")]
+        ])
+    return kb
+
 def main_kb(uid):
     """Главная клавиатура"""
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton(t(uid, "today"), callback_data="day_today"),
-            InlineKeyboardButton(t(uid, "tomorrow"), callback_data="day_tomorrow")
-        ],
-        [
-            InlineKeyboardButton(t(uid, "countdown_iftar"), callback_data="run_countdown_iftar"),
-            InlineKeyboardButton(t(uid, "countdown_suhoor"), callback_data="run_countdown_suhoor")
-        ],
-        [InlineKeyboardButton(t(uid, "my_settings"), callback_data="show_settings")],
-        [InlineKeyboardButton(t(uid, "settings"), callback_data="menu_settings")]
-    ])
+    return main_kb_for_lang(get_lang(uid))
 
 def settings_kb(uid):
     """Клавиатура настроек"""
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton(t(uid, "set_lang_btn"), callback_data="set_lang"),
-            InlineKeyboardButton(t(uid, "set_city_btn"), callback_data="set_city")
-        ],
-        [InlineKeyboardButton(t(uid, "set_remind_btn"), callback_data="set_remind")],
-        [InlineKeyboardButton(t(uid, "back_btn"), callback_data="back_main")]
-    ])
+    lang = get_lang(uid)
+    key = ("settings", lang)
+    kb = KEYBOARD_CACHE.get(key)
+    if kb is None:
+        kb = KEYBOARD_CACHE[key] = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(get_text_by_lang(lang, "set_lang_btn"), callback_data="set_lang"),
+                InlineKeyboardButton(get_text_by_lang(lang, "set_city_btn"), callback_data="set_city")
+            ],
+            [InlineKeyboardButton(get_text_by_lang(lang, "set_remind_btn"), callback_data="set_remind")],
+            [InlineKeyboardButton(get_text_by_lang(lang, "back_btn"), callback_data="back_main")]
+        ])
+    return kb
+
+def city_choice_kb(lang, onboarding=False):
+    """Выбор города: кнопки поддерживаемых городов и геолокация"""
+    prefix = "onb_city_" if onboarding else "city_"
+    rows = [
+        [InlineKeyboardButton(get_city_name(city, "uz"), callback_data=f"{prefix}{city}")]
+        for city in SUPPORTED_CITIES
+    ]
+    rows.append([InlineKeyboardButton(
+        get_text_by_lang(lang, "locate_city_btn"),
+        callback_data="onb_locate" if onboarding else "locate_city"
+    )])
+    return InlineKeyboardMarkup(rows)
+
+def location_request_kb(lang):
+    """Reply-клавиатура с запросом геолокации"""
+    return ReplyKeyboardMarkup(
+        [[KeyboardButton(get_text_by_lang(lang, "locate_btn"), request_location=True)]],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
 
 def admin_kb():
     """Админская клавиатура"""
@@ -345,7 +3079,9 @@ def admin_kb():
         [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton("📈 Рост бота", callback_data="admin_growth")],
         [InlineKeyboardButton("🔔 Напоминания", callback_data="admin_remind_stats")],
-        [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast")]
+        [InlineKeyboardButton("🧮 Аналитика", callback_data="admin_analytics")],
+        [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton("🗂 Прошлые рассылки", callback_data="admin_bcasts")]
     ])
 
 def admin_users_filter_kb(current_filter="all"):
@@ -374,20 +3110,45 @@ def cancel_broadcast_kb():
         [InlineKeyboardButton("❌ Отменить рассылку", callback_data="cancel_broadcast")]
     ])
 
-def confirm_broadcast_kb():
-    """Клавиатура подтверждения рассылки"""
-    return InlineKeyboardMarkup([
+def confirm_broadcast_kb(payload, segment, variants=None):
+    """Клавиатура подтверждения рассылки с выбором сегмента и языковых вариантов"""
+    variants = variants or {}
+    labels = describe_broadcast_segment(segment)
+    buttons = [
+        [
+            InlineKeyboardButton(
+                f"{'✅' if lang in variants else '✏️'} Вариант {lang.upper()}",
+                callback_data=f"bvar_{lang}"
+            )
+            for lang in BROADCAST_LANGS
+        ],
+        [
+            InlineKeyboardButton(f"🌍 Город: {labels['city']}", callback_data="bseg_city"),
+            InlineKeyboardButton(f"🌐 Язык: {labels['lang']}", callback_data="bseg_lang")
+        ],
         [
-            InlineKeyboardButton("✅ Отправить всем", callback_data="confirm_broadcast"),
+            InlineKeyboardButton(f"🔔 {labels['remind']}", callback_data="bseg_remind"),
+            InlineKeyboardButton(f"🔥 Активны: {labels['active']}", callback_data="bseg_active")
+        ],
+        [InlineKeyboardButton(f"🔴 Заблокировавшие: {labels['blocked']}", callback_data="bseg_blocked")],
+        [
+            InlineKeyboardButton("✅ Отправить", callback_data="confirm_broadcast"),
             InlineKeyboardButton("❌ Отмена", callback_data="cancel_broadcast")
         ]
-    ])
+    ]
+    if payload["kind"] != "text" or any(v["kind"] != "text" for v in variants.values()):
+        mode_name = "copy_message" if payload["mode"] == "copy" else "file_id"
+        buttons.insert(0, [
+            InlineKeyboardButton(f"🔁 Режим: {mode_name}", callback_data="toggle_broadcast_mode")
+        ])
+    return InlineKeyboardMarkup(buttons)
 
 # ---------------- COMMANDS ----------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start с onboarding"""
     uid = str(update.effective_chat.id)
     user_obj = update.effective_user
+    await restore_archived_user(uid)
     
     if uid in users:
         update_activity(user_obj, uid)
@@ -421,36 +3182,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def today_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /today"""
     uid = str(update.effective_chat.id)
+    await restore_archived_user(uid)
     
     if uid not in users:
         save_user_data(update.effective_user, uid)
     else:
         update_activity(update.effective_user, uid)
     
-    tz = get_tz(uid)
-    now = datetime.now(tz)
     city = users[uid]["city"]
-    times = get_city_times(city)
-    today = now.strftime("%Y-%m-%d")
+    now = clock.now(get_tz(uid))
+    text = day_response(city, get_lang(uid), now)
     
-    if today not in times:
+    if text is None:
         await update.message.reply_text(t(uid, "no_data"))
         return
     
-    res = times[today]
-    date_str = format_pretty_date(now, uid)
-    
-    text = (
-        f"📅 {date_str}\n\n"
-        f"{t(uid, 'suhoor_until')} {res['suhoor']}\n"
-        f"{t(uid, 'iftar_time')} {res['iftar']}"
-    )
-    
     await update.message.reply_text(text, reply_markup=main_kb(uid))
 
 async def settings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /settings"""
     uid = str(update.effective_chat.id)
+    await restore_archived_user(uid)
     
     if uid not in users:
         save_user_data(update.effective_user, uid)
@@ -480,19 +3232,14 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data[BROADCAST_MODE] = True
         await update.message.reply_text(
             "📢 РЕЖИМ РАССЫЛКИ\n\n"
-            "Отправьте текст сообщения для предпросмотра.\n"
+            "Отправьте текст, фото, видео, голосовое или документ для предпросмотра.\n"
             "Или нажмите «Отменить рассылку» для выхода.",
             reply_markup=cancel_broadcast_kb()
         )
         return
     
-    context.user_data[BROADCAST_PREVIEW] = msg
-    await update.message.reply_text(
-        f"📢 ПРЕДПРОСМОТР РАССЫЛКИ\n\n"
-        f"Сообщение:\n{'─' * 30}\n{msg}\n{'─' * 30}\n\n"
-        f"👥 Получателей: {len(users)}",
-        reply_markup=confirm_broadcast_kb()
-    )
+    context.user_data[BROADCAST_VARIANTS] = {}
+    await show_broadcast_preview(update, context, text_broadcast_payload(msg))
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin"""
@@ -507,6 +3254,79 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=admin_kb()
     )
 
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export [csv|jsonl] [status=all|active|blocked] [city=...] [lang=...] (только для админа)"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    
+    try:
+        fmt, filters_ = parse_export_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ Непонятный аргумент: {e}\n\n"
+            "Использование: /export [csv|jsonl] [status=all|active|blocked] [city=...] [lang=...]"
+        )
+        return
+    
+    status_message = await update.message.reply_text(
+        f"📤 Готовлю выгрузку ({fmt}, {describe_export_filters(filters_)})..."
+    )
+    if not await start_users_export(context, update.effective_chat.id, status_message, fmt, filters_):
+        await status_message.edit_text("⏳ Выгрузка уже выполняется")
+
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile [scheduler|buttons|broadcast|all] [секунды] (только для админа)"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    
+    args = [arg.lower() for arg in context.args]
+    target = args[0] if args else "all"
+    if target not in PROFILE_TARGETS + ("all",):
+        await update.message.reply_text(
+            "Использование: /profile [scheduler|buttons|broadcast|all] [секунды]"
+        )
+        return
+    try:
+        seconds = int(args[1]) if len(args) > 1 else 30
+    except ValueError:
+        seconds = 30
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    
+    if is_background_running("profile"):
+        await update.message.reply_text("⏳ Профилирование уже идёт")
+        return
+    
+    targets = set(PROFILE_TARGETS) if target == "all" else {target}
+    start_background(context, "profile", run_profiler(context, update.effective_chat.id, targets, seconds))
+    await update.message.reply_text(f"🔬 Профилирую {', '.join(sorted(targets))} {seconds} с...")
+
+async def memsnap_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /memsnap [stop]: снимок tracemalloc и размеры структур (только для админа)"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    
+    if context.args and context.args[0].lower() == "stop":
+        tracemalloc.stop()
+        memory_snapshots.clear()
+        await update.message.reply_text("🧠 Отслеживание памяти выключено")
+        return
+    
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+        await update.message.reply_text(
+            "🧠 Отслеживание памяти включено (учитываются выделения с этого момента).\n"
+            "Повторите /memsnap позже для отчёта, /memsnap stop — выключить."
+        )
+        return
+    
+    report = await asyncio.to_thread(memory_report)
+    stamp = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y%m%d_%H%M%S")
+    await update.message.reply_document(
+        document=BytesIO(report.encode("utf-8")),
+        filename=f"memory_{stamp}.txt",
+        caption="🧠 Снимок памяти"
+    )
+
 async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик сообщений в режиме рассылки или поиска"""
     uid = str(update.effective_chat.id)
@@ -521,7 +3341,7 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     if update.effective_user.id != ADMIN_ID:
         return
     
-    if context.user_data.get("admin_search_mode"):
+    if context.user_data.get("admin_search_mode") and update.message.text:
         search_query = update.message.text.strip()
         context.user_data["admin_search_mode"] = False
         
@@ -574,19 +3394,211 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
             )
         return
     
-    if context.user_data.get(BROADCAST_MODE):
-        msg = update.message.text
+    if context.user_data.get(BROADCAST_EDIT):
+        broadcast_id, lang_key = context.user_data.pop(BROADCAST_EDIT)
+        new_text = update.message.text or update.message.caption
+        if not new_text:
+            await update.message.reply_text("❌ Нужен текст. Начните изменение заново.", reply_markup=admin_kb())
+            return
         
-        context.user_data[BROADCAST_MODE] = False
-        context.user_data[BROADCAST_PREVIEW] = msg
+        if is_background_running("broadcast_job"):
+            await update.message.reply_text("⏳ Другая операция с рассылкой ещё идёт", reply_markup=admin_kb())
+            return
         
-        await update.message.reply_text(
-            f"📢 ПРЕДПРОСМОТР РАССЫЛКИ\n\n"
-            f"Сообщение:\n{'─' * 30}\n{msg}\n{'─' * 30}\n\n"
-            f"👥 Получателей: {len(users)}",
-            reply_markup=confirm_broadcast_kb()
+        status_message = await update.message.reply_text(f"⏳ Изменяю рассылку {broadcast_id}...")
+        start_background(
+            context, "broadcast_job",
+            run_broadcast_job(context, broadcast_id, "edit", status_message, lang_key, new_text)
         )
         return
+    
+    if context.user_data.get(BROADCAST_MODE):
+        received = extract_broadcast_payload(update.message)
+        variant_lang = context.user_data.pop(BROADCAST_VARIANT_LANG, None)
+        payload = context.user_data.get(BROADCAST_PREVIEW)
+        
+        if variant_lang and payload:
+            received["mode"] = payload["mode"]
+            context.user_data.setdefault(BROADCAST_VARIANTS, {})[variant_lang] = received
+        else:
+            context.user_data[BROADCAST_VARIANTS] = {}
+            payload = received
+        
+        await show_broadcast_preview(update, context, payload, received)
+        return
+
+# ---------------- BROADCAST PAYLOAD ----------------
+BROADCAST_MEDIA_KINDS = ("photo", "video", "voice", "document")
+BROADCAST_KIND_NAMES = {
+    "text": "📝 Текст",
+    "photo": "🖼 Фото",
+    "video": "🎬 Видео",
+    "voice": "🎙 Голосовое",
+    "document": "📎 Документ",
+}
+
+BROADCAST_SEGMENT = "broadcast_segment"
+BROADCAST_VARIANTS = "broadcast_variants"
+BROADCAST_VARIANT_LANG = "broadcast_variant_lang"
+BROADCAST_LANGS = ("uz", "ru")
+BROADCAST_EDIT = "broadcast_edit"
+SEGMENT_LANGS = (None, "uz", "ru")
+SEGMENT_REMINDS = (None, 5, 10, 15)
+SEGMENT_ACTIVE_DAYS = (None, 1, 7, 30)
+
+def default_broadcast_segment():
+    """Сегмент по умолчанию: все, кроме заблокировавших"""
+    return {"city": None, "lang": None, "remind": None, "active_days": None, "include_blocked": False}
+
+def next_segment_value(values, current):
+    """Следующее значение для кнопки-переключателя сегмента"""
+    values = list(values)
+    idx = values.index(current) if current in values else 0
+    return values[(idx + 1) % len(values)]
+
+def cycle_broadcast_segment(segment, field):
+    """Переключает одно поле сегмента по кругу"""
+    if field == "city":
+        segment["city"] = next_segment_value([None] + sorted(audience.by_city, key=str), segment["city"])
+    elif field == "lang":
+        segment["lang"] = next_segment_value(SEGMENT_LANGS, segment["lang"])
+    elif field == "remind":
+        segment["remind"] = next_segment_value(SEGMENT_REMINDS, segment["remind"])
+    elif field == "active":
+        segment["active_days"] = next_segment_value(SEGMENT_ACTIVE_DAYS, segment["active_days"])
+    elif field == "blocked":
+        segment["include_blocked"] = not segment["include_blocked"]
+
+def describe_broadcast_segment(segment):
+    """Подписи значений сегмента для кнопок и предпросмотра"""
+    return {
+        "city": get_city_name(segment["city"], "ru") if segment["city"] else "все",
+        "lang": get_lang_name(segment["lang"]) if segment["lang"] else "все",
+        "remind": f"{segment['remind']} мин" if segment["remind"] else "все",
+        "active": f"{segment['active_days']} дн." if segment["active_days"] else "все",
+        "blocked": "включены" if segment["include_blocked"] else "исключены",
+    }
+
+def extract_broadcast_payload(message):
+    """Формирует содержимое рассылки из сообщения админа.
+
+    Медиа уже загружено в Telegram вместе с сообщением админа, поэтому
+    сохраняем только его file_id и дальше рассылаем по нему без повторной
+    загрузки. Для режима copy_message запоминаем исходное сообщение.
+    """
+    kind, file_id = "text", None
+    if message.photo:
+        kind, file_id = "photo", message.photo[-1].file_id
+    elif message.video:
+        kind, file_id = "video", message.video.file_id
+    elif message.voice:
+        kind, file_id = "voice", message.voice.file_id
+    elif message.document:
+        kind, file_id = "document", message.document.file_id
+    
+    return {
+        "kind": kind,
+        "text": message.text or message.caption or "",
+        "file_id": file_id,
+        "source_chat": message.chat_id,
+        "source_message": message.message_id,
+        "mode": "file_id",
+    }
+
+def text_broadcast_payload(text):
+    """Содержимое текстовой рассылки (из аргументов /broadcast)"""
+    return {
+        "kind": "text",
+        "text": text,
+        "file_id": None,
+        "source_chat": None,
+        "source_message": None,
+        "mode": "file_id",
+    }
+
+def render_broadcast_payload(payload):
+    """Готовит запрос рассылки один раз: (метод бота, аргументы без chat_id)"""
+    if payload["mode"] == "copy" and payload["source_message"]:
+        return "copy_message", {
+            "from_chat_id": payload["source_chat"],
+            "message_id": payload["source_message"],
+        }
+    
+    text = f"📢 {payload['text']}" if payload["text"] else "📢"
+    kind = payload["kind"]
+    if kind in BROADCAST_MEDIA_KINDS:
+        return f"send_{kind}", {kind: payload["file_id"], "caption": text}
+    return "send_message", {"text": text}
+
+async def send_rendered_broadcast(bot, chat_id, rendered):
+    """Отправляет заранее подготовленный запрос рассылки одному получателю"""
+    method, kwargs = rendered
+    return await getattr(bot, method)(chat_id=chat_id, **kwargs)
+
+async def send_broadcast_payload(bot, chat_id, payload):
+    """Отправляет содержимое рассылки одному получателю (одним запросом)"""
+    return await send_rendered_broadcast(bot, chat_id, render_broadcast_payload(payload))
+
+def broadcast_language_groups(recipients):
+    """Разбивает получателей по языку: [(lang, отсортированные uid)]"""
+    groups = []
+    for lang, bucket in sorted(audience.by_lang.items(), key=lambda item: str(item[0])):
+        uids = recipients & bucket
+        if uids:
+            groups.append((lang, sorted(uids)))
+    return groups
+
+def broadcast_preview_text(payload, segment, variants=None):
+    """Текст предпросмотра рассылки"""
+    variants = variants or {}
+    text = payload["text"] or "(без подписи)"
+    labels = describe_broadcast_segment(segment)
+    recipients = audience.select(segment)
+    preview = (
+        f"📢 ПРЕДПРОСМОТР РАССЫЛКИ\n\n"
+        f"Тип: {BROADCAST_KIND_NAMES[payload['kind']]}\n"
+        f"Сообщение:\n{'─' * 30}\n{text}\n{'─' * 30}\n\n"
+    )
+    for lang, variant in variants.items():
+        preview += (
+            f"{get_lang_name(lang)} ({BROADCAST_KIND_NAMES[variant['kind']]}):\n"
+            f"{'─' * 30}\n{variant['text'] or '(без подписи)'}\n{'─' * 30}\n\n"
+        )
+    
+    preview += "🌐 По языкам:\n"
+    for lang, uids in broadcast_language_groups(recipients):
+        source = "свой вариант" if lang in variants else "общий текст"
+        name = get_lang_name(lang) if lang else "без языка"
+        preview += f"  {name}: {len(uids)} — {source}\n"
+    
+    preview += (
+        f"\n🎯 Сегмент: город — {labels['city']}, язык — {labels['lang']}, "
+        f"напоминание — {labels['remind']}, активность — {labels['active']}, "
+        f"заблокировавшие — {labels['blocked']}\n"
+        f"👥 Получателей: {len(recipients)}"
+    )
+    if payload["kind"] != "text" or any(v["kind"] != "text" for v in variants.values()):
+        preview += (
+            "\n\n🔁 file_id — медиа с подписью «📢 ...» без повторной загрузки\n"
+            "🔁 copy_message — точная копия вашего сообщения"
+        )
+    return preview
+
+async def show_broadcast_preview(update, context, payload, received=None):
+    """Показывает админу предпросмотр рассылки с подтверждением"""
+    context.user_data[BROADCAST_MODE] = False
+    context.user_data[BROADCAST_PREVIEW] = payload
+    segment = context.user_data.setdefault(BROADCAST_SEGMENT, default_broadcast_segment())
+    variants = context.user_data.setdefault(BROADCAST_VARIANTS, {})
+    
+    received = received or payload
+    if received["kind"] != "text":
+        await send_broadcast_payload(context.bot, update.effective_chat.id, received)
+    
+    await update.message.reply_text(
+        broadcast_preview_text(payload, segment, variants),
+        reply_markup=confirm_broadcast_kb(payload, segment, variants)
+    )
 
 # ---------------- NEW: SHOW USERS LIST FUNCTION ----------------
 async def show_users_list(q, context, page: int, filter_type: str = "all"):
@@ -640,6 +3652,7 @@ async def show_users_list(q, context, page: int, filter_type: str = "all"):
         buttons.append(nav)
     
     buttons.append([InlineKeyboardButton("🔧 Фильтры", callback_data=f"admin_filter_{filter_type}")])
+    buttons.append([InlineKeyboardButton("📤 Выгрузить CSV", callback_data=f"admin_export_{filter_type}")])
     buttons.append([
         InlineKeyboardButton("⬅️ В меню админа", callback_data="admin_back")
     ])
@@ -655,19 +3668,42 @@ async def show_users_list(q, context, page: int, filter_type: str = "all"):
     )
 
 # ---------------- HANDLERS ----------------
+@profiled("buttons")
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопок"""
     q = update.callback_query
+    # На callback можно ответить только один раз, поэтому ответ (с алертом,
+    # если обработчик его задал) отправляется после обработки
+    answer = {}
+    try:
+        await handle_button(update, context, answer)
+    finally:
+        try:
+            await q.answer(answer.get("alert"), show_alert="alert" in answer)
+        except BadRequest as e:
+            # Обычно callback устарел — ответ уже не нужен
+            logging.debug(f"Не удалось ответить на callback: {e}")
+        except TelegramError as e:
+            # Сетевые ошибки и таймауты не должны подменять исключение обработчика
+            logging.warning(f"Не удалось ответить на callback: {e}")
+
+async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE, answer):
+    """Обработка нажатия; текст алерта кладётся в answer["alert"]"""
+    q = update.callback_query
     uid = str(q.message.chat.id)
-    await q.answer()
+    await restore_archived_user(uid)
     
     if q.data == "cancel_broadcast":
         if update.effective_user.id != ADMIN_ID:
-            await q.answer("❌ Нет доступа", show_alert=True)
+            answer["alert"] = "❌ Нет доступа"
             return
         
         context.user_data[BROADCAST_MODE] = False
         context.user_data[BROADCAST_PREVIEW] = None
+        context.user_data.pop(BROADCAST_SEGMENT, None)
+        context.user_data.pop(BROADCAST_VARIANTS, None)
+        context.user_data.pop(BROADCAST_VARIANT_LANG, None)
+        context.user_data.pop(BROADCAST_EDIT, None)
         context.user_data["admin_search_mode"] = False
         
         await q.edit_message_text(
@@ -676,23 +3712,98 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
+    if q.data == "toggle_broadcast_mode":
+        if update.effective_user.id != ADMIN_ID:
+            answer["alert"] = "❌ Нет доступа"
+            return
+        
+        payload = context.user_data.get(BROADCAST_PREVIEW)
+        if not payload:
+            await q.edit_message_text(
+                "❌ Сообщение не найдено. Начните заново.",
+                reply_markup=admin_kb()
+            )
+            return
+        
+        payload["mode"] = "file_id" if payload["mode"] == "copy" else "copy"
+        variants = context.user_data.setdefault(BROADCAST_VARIANTS, {})
+        for variant in variants.values():
+            variant["mode"] = payload["mode"]
+        segment = context.user_data.setdefault(BROADCAST_SEGMENT, default_broadcast_segment())
+        await q.edit_message_reply_markup(reply_markup=confirm_broadcast_kb(payload, segment, variants))
+        return
+    
+    if q.data.startswith("bvar_"):
+        if update.effective_user.id != ADMIN_ID:
+            answer["alert"] = "❌ Нет доступа"
+            return
+        
+        if not context.user_data.get(BROADCAST_PREVIEW):
+            await q.edit_message_text(
+                "❌ Сообщение не найдено. Начните заново.",
+                reply_markup=admin_kb()
+            )
+            return
+        
+        lang = q.data.split("_", 1)[1]
+        context.user_data[BROADCAST_MODE] = True
+        context.user_data[BROADCAST_VARIANT_LANG] = lang
+        await q.edit_message_text(
+            f"✏️ ВАРИАНТ ДЛЯ ЯЗЫКА {get_lang_name(lang)}\n\n"
+            f"Отправьте текст или медиа, которое получат пользователи с этим языком.\n"
+            f"Остальные получат общий текст.",
+            reply_markup=cancel_broadcast_kb()
+        )
+        return
+    
+    if q.data.startswith("bseg_"):
+        if update.effective_user.id != ADMIN_ID:
+            answer["alert"] = "❌ Нет доступа"
+            return
+        
+        payload = context.user_data.get(BROADCAST_PREVIEW)
+        if not payload:
+            await q.edit_message_text(
+                "❌ Сообщение не найдено. Начните заново.",
+                reply_markup=admin_kb()
+            )
+            return
+        
+        segment = context.user_data.setdefault(BROADCAST_SEGMENT, default_broadcast_segment())
+        variants = context.user_data.setdefault(BROADCAST_VARIANTS, {})
+        cycle_broadcast_segment(segment, q.data.split("_", 1)[1])
+        await q.edit_message_text(
+            broadcast_preview_text(payload, segment, variants),
+            reply_markup=confirm_broadcast_kb(payload, segment, variants)
+        )
+        return
+    
     if q.data == "confirm_broadcast":
         if update.effective_user.id != ADMIN_ID:
-            await q.answer("❌ Нет доступа", show_alert=True)
+            answer["alert"] = "❌ Нет доступа"
             return
         
-        msg = context.user_data.get(BROADCAST_PREVIEW)
-        if not msg:
+        payload = context.user_data.get(BROADCAST_PREVIEW)
+        if not payload:
             await q.edit_message_text(
                 "❌ Сообщение не найдено. Начните заново.",
                 reply_markup=admin_kb()
             )
             return
         
+        if is_background_running("broadcast"):
+            answer["alert"] = "⏳ Предыдущая рассылка ещё идёт"
+            return
+        
         context.user_data[BROADCAST_PREVIEW] = None
+        segment = context.user_data.pop(BROADCAST_SEGMENT, None)
+        variants = context.user_data.pop(BROADCAST_VARIANTS, None)
         
         await q.edit_message_text("⏳ Начинаю рассылку...")
-        await execute_broadcast(context, msg, q.message)
+        start_background(
+            context, "broadcast",
+            execute_broadcast(context, payload, q.message, segment, variants)
+        )
         return
     
     if uid in users:
@@ -702,7 +3813,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if q.data.startswith("onb_lang_"):
         if context.user_data.get("onboarding") != ONBOARD_LANG:
-            await q.answer("⚠️ Действие устарело. Начните заново.", show_alert=True)
+            answer["alert"] = "⚠️ Действие устарело. Начните заново."
             return
         
         lang = q.data.split("_")[2]
@@ -711,53 +3822,35 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         city_text = "Shaharni tanlang:" if lang == "uz" else "Выберите город:"
         
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Tashkent 🇺🇿", callback_data="onb_city_tashkent")],
-            [InlineKeyboardButton("Bremen 🇩🇪", callback_data="onb_city_bremen")]
-        ])
+        await q.edit_message_text(city_text, reply_markup=city_choice_kb(lang, onboarding=True))
+        return
+    
+    if q.data in ("onb_locate", "locate_city"):
+        if q.data == "onb_locate" and context.user_data.get("onboarding") != ONBOARD_CITY:
+            answer["alert"] = "⚠️ Действие устарело. Начните заново."
+            return
         
-        await q.edit_message_text(city_text, reply_markup=kb)
+        lang = context.user_data.get("new_lang", "uz") if q.data == "onb_locate" else get_lang(uid)
+        await q.message.reply_text(
+            get_text_by_lang(lang, "locate_prompt"),
+            reply_markup=location_request_kb(lang)
+        )
         return
     
     if q.data.startswith("onb_city_"):
         if context.user_data.get("onboarding") != ONBOARD_CITY:
-            await q.answer("⚠️ Действие устарело. Начните заново.", show_alert=True)
+            answer["alert"] = "⚠️ Действие устарело. Начните заново."
             return
         
         city = q.data.split("_")[2]
         lang = context.user_data.get("new_lang", "uz")
         
-        tashkent_tz = ZoneInfo("Asia/Tashkent")
-        now = datetime.now(tashkent_tz).strftime("%Y-%m-%d %H:%M:%S")
-        
-        users[uid] = {
-            "lang": lang,
-            "city": city,
-            "remind_min": 10,
-            "first_name": update.effective_user.first_name,
-            "username": update.effective_user.username,
-            "joined": now,
-            "last_active": now,
-            "push_sent": False
-        }
-        save_users()
-        
+        register_user(uid, update.effective_user, lang, city)
         context.user_data.clear()
         
         welcome_text = get_text_by_lang(lang, "welcome_message")
         
-        kb = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(get_text_by_lang(lang, "today"), callback_data="day_today"),
-                InlineKeyboardButton(get_text_by_lang(lang, "tomorrow"), callback_data="day_tomorrow")
-            ],
-            [
-                InlineKeyboardButton(get_text_by_lang(lang, "countdown_iftar"), callback_data="run_countdown_iftar"),
-                InlineKeyboardButton(get_text_by_lang(lang, "countdown_suhoor"), callback_data="run_countdown_suhoor")
-            ],
-            [InlineKeyboardButton(get_text_by_lang(lang, "my_settings"), callback_data="show_settings")],
-            [InlineKeyboardButton(get_text_by_lang(lang, "settings"), callback_data="menu_settings")]
-        ])
+        kb = main_kb_for_lang(lang)
         
         await q.edit_message_text(
             welcome_text,
@@ -774,113 +3867,74 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     tz = get_tz(uid)
-    now = datetime.now(tz)
+    now = clock.now(tz)
     city = users[uid]["city"]
-    times = get_city_times(city)
+    
+    # Любая другая кнопка на сообщении с живым отсчётом останавливает его
+    if q.data not in LIVE_COUNTDOWN_CALLBACKS:
+        stop_live_countdown(uid, q.message.message_id)
     
     if q.data == "show_settings":
         user = users[uid]
-        lang = user.get("lang", "uz")
-        city_code = user.get("city", "tashkent")
-        remind = user.get("remind_min", 10)
-        
-        text = (
-            f"⚙️ {t(uid, 'my_settings_title')}\n\n"
-            f"🌍 {t(uid, 'set_city_btn')}: {get_city_name(city_code, lang)}\n"
-            f"🌐 {t(uid, 'set_lang_btn')}: {get_lang_name(lang)}\n"
-            f"🔔 {t(uid, 'set_remind_btn')}: {remind} {t(uid, 'minute')}"
+        text = my_settings_response(
+            user.get("lang", "uz"),
+            user.get("city", "tashkent"),
+            user.get("remind_min", 10)
         )
         
-        await q.edit_message_text(text, reply_markup=main_kb(uid))
+        await edit_message_cached(q, text, reply_markup=main_kb(uid))
         return
     
-    if q.data == "run_countdown_iftar":
-        today = now.strftime("%Y-%m-%d")
-        if today not in times:
-            await q.edit_message_text(t(uid, "no_data"), reply_markup=main_kb(uid))
+    if q.data in ("run_countdown_iftar", "run_countdown_suhoor"):
+        event = q.data.rsplit("_", 1)[1]
+        render = lambda tap: show_countdown(uid, tap, event)
+        if not coalesce_tap(uid, q, render):
+            await render(q)
+        return
+    
+    if q.data in ("live_countdown_iftar", "live_countdown_suhoor"):
+        event = q.data.rsplit("_", 1)[1]
+        text, event_ts = countdown_text(uid, event, now)
+        if event_ts is None or (uid not in LIVE_COUNTDOWNS and len(LIVE_COUNTDOWNS) >= LIVE_COUNTDOWN_LIMIT):
+            await edit_message_cached(q, text, reply_markup=main_kb(uid))
             return
         
-        iftar_time = times[today]['iftar']
-        iftar_dt = datetime.strptime(
-            f"{today} {iftar_time}", 
-            "%Y-%m-%d %H:%M"
-        ).replace(tzinfo=tz)
-        
-        diff = iftar_dt - now
-        
-        if diff.total_seconds() <= 0:
-            text = t(uid, "iftar_time_now")
-        else:
-            total_seconds = int(diff.total_seconds())
-            hours = total_seconds // 3600
-            minutes = (total_seconds % 3600) // 60
-            
-            text = (
-                f"{t(uid, 'iftar_left')}\n\n"
-                f"⏳ {hours} {t(uid, 'hour')} {minutes} {t(uid, 'minute')}\n"
-                f"🕰 {iftar_time}"
-            )
-        
-        await q.edit_message_text(text, reply_markup=main_kb(uid))
+        # Одна подписка на пользователя: новая заменяет старую
+        sub = LIVE_COUNTDOWNS[uid] = [q.message.message_id, event, event_ts]
+        text, kb, _ = live_countdown_render(uid, sub, clock.time())
+        await edit_message_cached(q, text, reply_markup=kb)
         return
     
-    if q.data == "run_countdown_suhoor":
-        today = now.strftime("%Y-%m-%d")
-        if today not in times:
-            await q.edit_message_text(t(uid, "no_data"), reply_markup=main_kb(uid))
+    if q.data == "live_countdown_stop":
+        sub = live_countdown_of(uid, q.message.message_id)
+        stop_live_countdown(uid, q.message.message_id)
+        if sub is None:
+            await edit_message_cached(q, t(uid, "start"), reply_markup=main_kb(uid))
             return
         
-        suhoor_time = times[today]['suhoor']
-        suhoor_dt = datetime.strptime(
-            f"{today} {suhoor_time}", 
-            "%Y-%m-%d %H:%M"
-        ).replace(tzinfo=tz)
-        
-        diff = suhoor_dt - now
-        
-        if diff.total_seconds() <= 0:
-            text = t(uid, "suhoor_time_now")
-        else:
-            total_seconds = int(diff.total_seconds())
-            hours = total_seconds // 3600
-            minutes = (total_seconds % 3600) // 60
-            
-            text = (
-                f"{t(uid, 'suhoor_left')}\n\n"
-                f"⏳ {hours} {t(uid, 'hour')} {minutes} {t(uid, 'minute')}\n"
-                f"🕰 {suhoor_time}"
-            )
-        
-        await q.edit_message_text(text, reply_markup=main_kb(uid))
+        text, event_ts = countdown_text(uid, sub[1], now)
+        kb = countdown_kb(uid, sub[1], False) if event_ts else main_kb(uid)
+        await edit_message_cached(q, text, reply_markup=kb)
         return
     
     if q.data.startswith("day_"):
         target = now if q.data == "day_today" else now + timedelta(days=1)
-        date_str = target.strftime("%Y-%m-%d")
-        
-        if date_str in times:
-            res = times[date_str]
-            pretty_date = format_pretty_date(target, uid)
-            text = (
-                f"📅 {pretty_date}\n\n"
-                f"{t(uid, 'suhoor_until')} {res['suhoor']}\n"
-                f"{t(uid, 'iftar_time')} {res['iftar']}"
-            )
-        else:
-            text = t(uid, "no_data")
+        text = day_response(city, get_lang(uid), target) or t(uid, "no_data")
         
-        await q.edit_message_text(text, reply_markup=main_kb(uid))
+        await edit_message_cached(q, text, reply_markup=main_kb(uid))
         return
     
     if q.data == "menu_settings":
-        await q.edit_message_text(
+        await edit_message_cached(
+            q,
             t(uid, "settings_title"), 
             reply_markup=settings_kb(uid)
         )
         return
     
     if q.data == "back_main":
-        await q.edit_message_text(
+        await edit_message_cached(
+            q,
             t(uid, "start"), 
             reply_markup=main_kb(uid)
         )
@@ -893,7 +3947,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 InlineKeyboardButton("🇺🇿 O'zbekcha", callback_data="lang_uz")
             ]
         ])
-        await q.edit_message_text(
+        await edit_message_cached(
+            q,
             "Выберите язык / Tilni tanlang:", 
             reply_markup=kb
         )
@@ -902,27 +3957,26 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if q.data.startswith("lang_"):
         new_lang = q.data.split("_")[1]
         update_user(uid, lang=new_lang)
-        await q.edit_message_text(
+        await edit_message_cached(
+            q,
             t(uid, "lang_changed"), 
             reply_markup=main_kb(uid)
         )
         return
     
     if q.data == "set_city":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Tashkent 🇺🇿", callback_data="city_tashkent")],
-            [InlineKeyboardButton("Bremen 🇩🇪", callback_data="city_bremen")]
-        ])
-        await q.edit_message_text(
+        await edit_message_cached(
+            q,
             t(uid, "choose_city"), 
-            reply_markup=kb
+            reply_markup=city_choice_kb(get_lang(uid))
         )
         return
     
     if q.data.startswith("city_"):
         new_city = q.data.split("_")[1]
         update_user(uid, city=new_city)
-        await q.edit_message_text(
+        await edit_message_cached(
+            q,
             t(uid, "city_changed"), 
             reply_markup=main_kb(uid)
         )
@@ -947,7 +4001,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ],
             [InlineKeyboardButton(t(uid, "back_btn"), callback_data="menu_settings")]
         ])
-        await q.edit_message_text(
+        await edit_message_cached(
+            q,
             t(uid, "choose_rem"), 
             reply_markup=kb
         )
@@ -956,7 +4011,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if q.data.startswith("rem_"):
         minutes = int(q.data.split("_")[1])
         update_user(uid, remind_min=minutes)
-        await q.edit_message_text(
+        await edit_message_cached(
+            q,
             t(uid, "remind_changed"), 
             reply_markup=main_kb(uid)
         )
@@ -967,37 +4023,31 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if update.effective_user.id != ADMIN_ID:
-        await q.answer("❌ Нет доступа", show_alert=True)
+        answer["alert"] = "❌ Нет доступа"
         return
     
     # Проверка блокировок
     if q.data == "admin_check_blocks":
-        await q.edit_message_text("🔄 Проверяю статусы пользователей...\nЭто может занять некоторое время.")
-        blocked_count = await update_users_block_status(context)
+        if is_background_running("check_blocks"):
+            answer["alert"] = "⏳ Проверка уже выполняется"
+            return
         
-        blocked_users = [uid for uid, data in users.items() if data.get("is_blocked")]
+        await q.edit_message_text("🔄 Проверяю статусы пользователей...\nЭто может занять некоторое время.")
+        start_background(context, "check_blocks", run_block_check(context, q.message))
+        return
+
+    # Выгрузка пользователей по текущему фильтру
+    if q.data.startswith("admin_export_"):
+        status = q.data.split("_")[2]
+        filters_ = {} if status == "all" else {"status": status}
+        if is_background_running("export"):
+            answer["alert"] = "⏳ Выгрузка уже выполняется"
+            return
         
-        text = (
-            f"✅ Проверка завершена!\n\n"
-            f"👥 Всего пользователей: {len(users)}\n"
-            f"🔴 Заблокировали бота: {len(blocked_users)}\n"
-            f"🟢 Активных: {len(users) - len(blocked_users)}"
+        status_message = await q.message.reply_text(
+            f"📤 Готовлю выгрузку (csv, {describe_export_filters(filters_)})..."
         )
-        
-        if blocked_users:
-            text += f"\n\n📋 Список заблокировавших ({min(10, len(blocked_users))} из {len(blocked_users)}):\n"
-            for uid in blocked_users[:10]:
-                user = users[uid]
-                date = user.get("blocked_date", "неизвестно")
-                name = user.get("first_name", "Unknown")
-                text += f"• {name} (ID: {uid}) - {date}\n"
-        
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("👥 Просмотреть пользователей", callback_data="admin_users_0_all")],
-            [InlineKeyboardButton("⬅️ В меню админа", callback_data="admin_back")]
-        ])
-        
-        await q.edit_message_text(text, reply_markup=kb)
+        await start_users_export(context, q.message.chat.id, status_message, "csv", filters_)
         return
 
     # Фильтр пользователей
@@ -1078,23 +4128,20 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if q.data == "admin_growth":
         total_users = len(users)
-        today_str = datetime.now().strftime("%Y-%m-%d")
+        today_str = clock.now().strftime("%Y-%m-%d")
         
         new_today = sum(
             1 for u in users.values() 
             if u.get("joined", "").startswith(today_str)
         )
         
-        week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+        week_ago = (clock.now() - timedelta(days=7)).strftime("%Y-%m-%d")
         new_week = sum(
             1 for u in users.values() 
             if u.get("joined", "") >= week_ago
         )
         
-        active_today = sum(
-            1 for u in users.values() 
-            if u.get("last_active", "").startswith(today_str)
-        )
+        active_today = activity.active(today_ordinal())
         
         blocked_count = sum(1 for u in users.values() if u.get("is_blocked"))
         
@@ -1108,9 +4155,30 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🔥 Активны сегодня: {active_today}\n"
             f"📈 Новые сегодня: {new_today}\n"
             f"📈 Новые за 7 дней: {new_week}\n\n"
-            f"📊 Конверсия активности: {conversion:.1f}%"
+            f"📊 Конверсия активности: {conversion:.1f}%\n"
+            f"{describe_activity()}"
         )
         
+        if daily_stats:
+            days = min(len(daily_stats), GROWTH_CHART_DAYS)
+            totals = [row["total"] for row in daily_stats[-days:]]
+            new = metric_series("new", days)
+            active = metric_series("active", days)
+            blocked = metric_series("blocked", days)
+            reminders = metric_series("reminders", days)
+            shares = [a / t if a is not None and t else None for a, t in zip(active, totals)]
+            recorded = [share for share in shares if share is not None]
+            active_max = max((value for value in active if value is not None), default="—")
+            last_share = f"{recorded[-1]:.1%}" if recorded else "—"
+            text += (
+                f"\n\n📅 За {days} дн. ({daily_stats[-days]['date']} — {daily_stats[-1]['date']}):\n"
+                f"📈 Новые: {sparkline(new)} Σ {series_total(new)}\n"
+                f"🔥 Активные: {sparkline(active)} макс {active_max}\n"
+                f"🔁 Доля активных: {sparkline(shares)} {last_share}\n"
+                f"🔴 Блокировки: {sparkline(blocked)} Σ {series_total(blocked)}\n"
+                f"🔔 Напоминания: {sparkline(reminders)} Σ {series_total(reminders)}"
+            )
+        
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("⬅️ В меню админа", callback_data="admin_back")]
         ])
@@ -1118,6 +4186,37 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_text(text, reply_markup=kb)
         return
     
+    if q.data == "admin_analytics":
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⬅️ В меню админа", callback_data="admin_back")]
+        ])
+        if analytics is None:
+            await q.edit_message_text("🧮 Аналитика недоступна: не установлен numpy", reply_markup=kb)
+            return
+        
+        # Строки снимаются пачками в цикле, столбцы строятся в отдельном потоке
+        state = await users_rows_chunked(users)
+        last = today_ordinal() - 1
+        await preload_activity(
+            range(last - max(RETENTION_DAYS) - RETENTION_COHORTS + 1, last + 1),
+            (ACTIVITY_SUFFIX, COHORT_SUFFIX),
+        )
+        retention = [(n, *activity.retention(last, n)) for n in RETENTION_DAYS]
+        report = await asyncio.to_thread(
+            lambda: analytics.report(
+                analytics.load_columns(state, ROW_LAYOUT),
+                today_ordinal() - EPOCH_ORDINAL,
+                lambda city: get_city_name(city, "ru"),
+                retention=retention,
+            )
+        )
+        await q.edit_message_text(
+            f"🧮 АНАЛИТИКА\n\n<pre>{html.escape(report)}</pre>",
+            parse_mode="HTML",
+            reply_markup=kb
+        )
+        return
+    
     if q.data == "admin_remind_stats":
         remind_stats = {5: 0, 10: 0, 15: 0, "other": 0}
         
@@ -1156,12 +4255,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if q.data == "admin_stats":
         total_users = len(users)
-        today_str = datetime.now().strftime("%Y-%m-%d")
-        
-        active_today = sum(
-            1 for u in users.values() 
-            if u.get("last_active", "").startswith(today_str)
-        )
+        active_today = activity.active(today_ordinal())
         
         blocked_count = sum(1 for u in users.values() if u.get("is_blocked"))
         
@@ -1179,7 +4273,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"👥 Всего пользователей: {total_users}\n"
             f"🟢 Активных: {total_users - blocked_count}\n"
             f"🔴 Заблокировали: {blocked_count}\n"
-            f"🔥 Активны сегодня: {active_today}\n\n"
+            f"🔥 Активны сегодня: {active_today}\n"
+            f"🗄 В архиве: {len(archived_uids)}\n"
+            f"⏱ Задержка цикла: {describe_loop_lag()}\n\n"
             f"🌐 Языки:\n"
         )
         
@@ -1204,16 +4300,118 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data[BROADCAST_PREVIEW] = None
         
         await q.edit_message_text(
-            "📢 РЕЖИМ РАССЫЛКИ\n\n"
-            "Отправьте текст сообщения для предпросмотра.\n"
-            "Или нажмите «Отменить рассылку» для выхода.",
+            "📢 РЕЖИМ РАССЫЛКИ\n\n"
+            "Отправьте текст, фото, видео, голосовое или документ для предпросмотра.\n"
+            "Или нажмите «Отменить рассылку» для выхода.",
+            reply_markup=cancel_broadcast_kb()
+        )
+        return
+    
+    if q.data == "admin_bcasts":
+        broadcasts = await run_io(list_broadcasts)
+        if not broadcasts:
+            await q.edit_message_text(
+                "🗂 Сохранённых рассылок пока нет",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("⬅️ В меню админа", callback_data="admin_back")]
+                ])
+            )
+            return
+        
+        buttons = []
+        for meta in broadcasts:
+            first = next(iter(meta["langs"].values()), {})
+            label = (first.get("text") or BROADCAST_KIND_NAMES.get(first.get("kind"), ""))[:30]
+            status = "🗑" if meta.get("deleted") else "📢"
+            buttons.append([
+                InlineKeyboardButton(
+                    f"{status} {meta['created'][:16]} · {meta['sent']} · {label}"[:64],
+                    callback_data=f"admin_bcast_{meta['id']}"
+                )
+            ])
+        buttons.append([InlineKeyboardButton("⬅️ В меню админа", callback_data="admin_back")])
+        
+        await q.edit_message_text("🗂 ПРОШЛЫЕ РАССЫЛКИ", reply_markup=InlineKeyboardMarkup(buttons))
+        return
+    
+    if q.data.startswith("admin_bcast_"):
+        broadcast_id = q.data[len("admin_bcast_"):]
+        meta = await run_io(load_broadcast_meta, broadcast_id)
+        if not meta:
+            await q.edit_message_text("❌ Рассылка не найдена", reply_markup=admin_kb())
+            return
+        
+        text = (
+            f"🗂 РАССЫЛКА {broadcast_id}\n\n"
+            f"📅 Отправлена: {meta['created']}\n"
+            f"📤 Доставлено: {meta['sent']}\n"
+        )
+        if meta.get("edited"):
+            text += f"✏️ Изменена: {meta['edited']}\n"
+        if meta.get("deleted"):
+            deleted_at = f": {meta['deleted_at']}" if meta.get("deleted_at") else ""
+            text += f"🗑 Удалена у получателей{deleted_at}\n"
+        for lang_key, lang_meta in meta["langs"].items():
+            name = get_lang_name(lang_key) if lang_key != "none" else "без языка"
+            text += (
+                f"\n{name} ({BROADCAST_KIND_NAMES.get(lang_meta['kind'], lang_meta['kind'])}):\n"
+                f"{lang_meta['text'] or '(без подписи)'}\n"
+            )
+        
+        buttons = []
+        if not meta.get("deleted"):
+            buttons.append([
+                InlineKeyboardButton(f"✏️ {lang_key.upper()}", callback_data=f"admin_bcedit_{lang_key}_{broadcast_id}")
+                for lang_key in meta["langs"]
+            ] + [InlineKeyboardButton("✏️ Все", callback_data=f"admin_bcedit_all_{broadcast_id}")])
+            buttons.append([InlineKeyboardButton("🗑 Удалить у всех", callback_data=f"admin_bcdel_{broadcast_id}")])
+        buttons.append([InlineKeyboardButton("⬅️ К рассылкам", callback_data="admin_bcasts")])
+        
+        await q.edit_message_text(text[:4000], reply_markup=InlineKeyboardMarkup(buttons))
+        return
+    
+    if q.data.startswith("admin_bcedit_"):
+        lang_key, broadcast_id = q.data[len("admin_bcedit_"):].split("_", 1)
+        context.user_data[BROADCAST_EDIT] = (broadcast_id, lang_key)
+        await q.edit_message_text(
+            f"✏️ ИЗМЕНЕНИЕ РАССЫЛКИ {broadcast_id}\n\n"
+            f"Отправьте новый текст. Он заменит текст (или подпись к медиа) "
+            f"во всех доставленных сообщениях{'' if lang_key == 'all' else f' на языке {lang_key.upper()}'}.",
             reply_markup=cancel_broadcast_kb()
         )
         return
     
+    if q.data.startswith("admin_bcdel_"):
+        broadcast_id = q.data[len("admin_bcdel_"):]
+        await q.edit_message_text(
+            f"🗑 Удалить рассылку {broadcast_id} у всех получателей?\n\n"
+            f"Telegram позволяет удалять сообщения бота только в течение 48 часов.",
+            reply_markup=InlineKeyboardMarkup([
+                [
+                    InlineKeyboardButton("✅ Удалить", callback_data=f"admin_bcdelok_{broadcast_id}"),
+                    InlineKeyboardButton("❌ Отмена", callback_data=f"admin_bcast_{broadcast_id}")
+                ]
+            ])
+        )
+        return
+    
+    if q.data.startswith("admin_bcdelok_"):
+        broadcast_id = q.data[len("admin_bcdelok_"):]
+        if is_background_running("broadcast_job"):
+            answer["alert"] = "⏳ Другая операция с рассылкой ещё идёт"
+            return
+        
+        await q.edit_message_text(f"⏳ Удаляю рассылку {broadcast_id}...")
+        start_background(
+            context, "broadcast_job",
+            run_broadcast_job(context, broadcast_id, "delete", q.message)
+        )
+        return
+    
     if q.data == "admin_back":
         context.user_data[BROADCAST_MODE] = False
         context.user_data[BROADCAST_PREVIEW] = None
+        context.user_data.pop(BROADCAST_EDIT, None)
         context.user_data["admin_search_mode"] = False
         
         await q.edit_message_text(
@@ -1222,12 +4420,31 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-async def execute_broadcast(context: ContextTypes.DEFAULT_TYPE, msg: str, status_message=None):
-    """Выполняет рассылку сообщения всем пользователям"""
-    sent = 0
-    failed = 0
-    blocked = 0
-    total = len(users)
+@profiled("broadcast")
+async def execute_broadcast(context: ContextTypes.DEFAULT_TYPE, payload: dict, status_message=None, segment=None, variants=None):
+    """Выполняет рассылку пользователям сегмента, отдельными пачками по языкам"""
+    variants = variants or {}
+    groups = broadcast_language_groups(audience.select(segment or default_broadcast_segment()))
+    total = sum(len(uids) for _, uids in groups)
+    stats = {}
+    sent = failed = blocked = 0
+    
+    broadcast_id = await run_io(new_broadcast_id)
+    meta = {
+        "id": broadcast_id,
+        "created": clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d %H:%M:%S"),
+        "langs": {
+            receipt_lang_key(lang): {
+                "kind": variants.get(lang, payload)["kind"],
+                "mode": variants.get(lang, payload)["mode"],
+                "text": variants.get(lang, payload)["text"],
+            }
+            for lang, _ in groups
+        },
+        "sent": 0,
+        "deleted": False,
+    }
+    await run_io(save_broadcast_meta, meta)
     
     if status_message:
         await status_message.edit_text(f"⏳ Начинаю рассылку...\nВсего пользователей: {total}")
@@ -1237,125 +4454,413 @@ async def execute_broadcast(context: ContextTypes.DEFAULT_TYPE, msg: str, status
             text=f"⏳ Начинаю рассылку...\nВсего пользователей: {total}"
         )
     
-    tashkent_tz = ZoneInfo("Asia/Tashkent")
+    bot = lane_bot(context, "broadcast")
+    remaining = 0
     
-    for uid in list(users.keys()):
-        try:
-            await context.bot.send_message(
-                chat_id=int(uid),
-                text=f"📢 {msg}"
-            )
-            sent += 1
-            
-            # Если раньше был заблокирован, а сейчас отправилось - снимаем блокировку
-            if users[uid].get("is_blocked"):
-                users[uid]["is_blocked"] = False
-                users[uid]["unblocked_date"] = datetime.now(tashkent_tz).strftime("%Y-%m-%d %H:%M:%S")
-                save_users()
+    for lang, uids in groups:
+        if is_shutting_down():
+            remaining += len(uids)
+            continue
+        
+        # Текст/медиа для языка готовим один раз на всю пачку
+        rendered = render_broadcast_payload(variants.get(lang, payload))
+        lang_stats = stats[lang] = {"total": len(uids), "sent": 0, "blocked": 0, "failed": 0}
+        receipts = array("q")
+        
+        for i, uid in enumerate(uids):
+            if is_shutting_down():
+                # Бот останавливается: рассылка уступает напоминаниям
+                remaining += len(uids) - i
+                break
+            if uid not in users:
+                continue
+            try:
+                result = await send_rendered_broadcast(bot, int(uid), rendered)
+                sent += 1
+                lang_stats["sent"] += 1
+                
+                receipts.extend((int(uid), result.message_id))
+                if len(receipts) >= RECEIPTS_FLUSH_EVERY * 2:
+                    await run_io(append_broadcast_receipts, broadcast_id, lang, receipts)
+                    receipts = array("q")
+                
+                # Если раньше был заблокирован, а сейчас отправилось - снимаем блокировку
+                mark_user_unblocked(uid)
+                
+                if sent % 10 == 0:
+                    await status_message.edit_text(
+                        f"⏳ Рассылка идет...\n"
+                        f"Язык: {get_lang_name(lang) if lang else 'без языка'}\n"
+                        f"Отправлено: {sent}/{total}\n"
+                        f"Заблокировали: {blocked}\n"
+                        f"Ошибок: {failed}"
+                    )
+                
+            except Forbidden:
+                blocked += 1
+                lang_stats["blocked"] += 1
+                # Помечаем как заблокировавшего
+                mark_user_blocked(uid)
+                logging.warning(f"Пользователь {uid} заблокировал бота")
+                
+            except Exception as e:
+                failed += 1
+                lang_stats["failed"] += 1
+                logging.error(f"Ошибка отправки {uid}: {e}")
+        
+        await run_io(append_broadcast_receipts, broadcast_id, lang, receipts)
+    
+    meta["sent"] = sent
+    if remaining:
+        meta["interrupted"] = remaining
+        shutdown_state["broadcasts"].append({"id": broadcast_id, "sent": sent, "remaining": remaining})
+    await run_io(save_broadcast_meta, meta)
+    
+    if remaining:
+        title = f"⏸ Рассылка прервана остановкой бота, не отправлено: {remaining}"
+    else:
+        title = "✅ Рассылка завершена!"
+    report = (
+        f"{title}\n\n"
+        f"📤 Отправлено: {sent}\n"
+        f"🔴 Заблокировали: {blocked}\n"
+        f"❌ Других ошибок: {failed}\n"
+        f"🎯 Получателей в сегменте: {total}\n"
+        f"👥 Всего в базе: {len(users)}\n\n"
+        f"🌐 По языкам:\n"
+    )
+    for lang, lang_stats in stats.items():
+        source = "свой вариант" if lang in variants else "общий текст"
+        name = get_lang_name(lang) if lang else "без языка"
+        report += (
+            f"{name} ({source}): 📤 {lang_stats['sent']}/{lang_stats['total']}, "
+            f"🔴 {lang_stats['blocked']}, ❌ {lang_stats['failed']}\n"
+        )
+    report += f"\n🗂 Квитанции сохранены: {broadcast_id}"
+    
+    await status_message.edit_text(report)
+
+# ---------------- BROADCAST RECEIPTS ----------------
+# Для каждой рассылки хранится <id>.json (метаданные) и по файлу квитанций
+# на язык: <id>.<lang>.rcpt — пары int64 (chat_id, message_id) подряд.
+# Все функции этого раздела работают с диском и вызываются через run_io.
+# Идентификаторы, выданные в этом запуске (их метаданные могут быть ещё не записаны)
+ISSUED_BROADCAST_IDS = set()
+
+def new_broadcast_id():
+    """Идентификатор рассылки по времени запуска.
+
+    Вторая рассылка в ту же секунду получает суффикс _2, _3, ...
+    """
+    base = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y%m%d_%H%M%S")
+    broadcast_id, n = base, 1
+    while broadcast_id in ISSUED_BROADCAST_IDS or os.path.exists(broadcast_meta_path(broadcast_id)):
+        n += 1
+        broadcast_id = f"{base}_{n}"
+    ISSUED_BROADCAST_IDS.add(broadcast_id)
+    return broadcast_id
+
+def receipt_lang_key(lang):
+    return lang or "none"
+
+def broadcast_meta_path(broadcast_id):
+    return os.path.join(BROADCASTS_DIR, f"{broadcast_id}.json")
+
+def save_broadcast_meta(meta):
+    """Атомарно сохраняет метаданные рассылки"""
+    path = broadcast_meta_path(meta["id"])
+    temp_file = f"{path}.tmp"
+    try:
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, path)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения рассылки {meta['id']}: {e}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+def load_broadcast_meta(broadcast_id):
+    try:
+        with open(broadcast_meta_path(broadcast_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.error(f"Ошибка загрузки рассылки {broadcast_id}: {e}")
+        return None
+
+def list_broadcasts(limit=10):
+    """Последние рассылки (новые первыми)"""
+    ids = sorted(
+        (name[:-5] for name in os.listdir(BROADCASTS_DIR) if name.endswith(".json")),
+        reverse=True
+    )
+    return [meta for meta in map(load_broadcast_meta, ids[:limit]) if meta]
+
+def append_broadcast_receipts(broadcast_id, lang, receipts):
+    """Дописывает пачку квитанций (chat_id, message_id) в файл языка"""
+    if not receipts:
+        return
+    path = os.path.join(BROADCASTS_DIR, f"{broadcast_id}.{receipt_lang_key(lang)}.rcpt")
+    try:
+        with open(path, "ab") as f:
+            receipts.tofile(f)
+    except OSError as e:
+        logging.error(f"Ошибка записи квитанций {broadcast_id}: {e}")
+
+def load_broadcast_receipts(broadcast_id, lang_key):
+    """Читает квитанции языка как плоский массив chat_id, message_id, ..."""
+    path = os.path.join(BROADCASTS_DIR, f"{broadcast_id}.{lang_key}.rcpt")
+    receipts = array("q")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            receipts.frombytes(f.read())
+    return receipts
+
+async def run_broadcast_job(context: ContextTypes.DEFAULT_TYPE, broadcast_id, action, status_message, lang_key=None, new_text=None):
+    """Массово изменяет или удаляет сообщения прошлой рассылки по квитанциям"""
+    meta = await run_io(load_broadcast_meta, broadcast_id)
+    if not meta:
+        await status_message.edit_text("❌ Рассылка не найдена", reply_markup=admin_kb())
+        return
+    
+    lang_keys = [lang_key] if lang_key and lang_key != "all" else list(meta["langs"])
+    work = [(key, await run_io(load_broadcast_receipts, broadcast_id, key)) for key in lang_keys]
+    total = sum(len(receipts) // 2 for _, receipts in work)
+    done = ok = failed = 0
+    bot = lane_bot(context, "broadcast")
+    action_name = "Удаление" if action == "delete" else "Изменение"
+    
+    for key, receipts in work:
+        lang_meta = meta["langs"].get(key, {})
+        is_media = lang_meta.get("kind", "text") != "text"
+        if action == "edit":
+            text = new_text if lang_meta.get("mode") == "copy" else f"📢 {new_text}"
+        
+        for i in range(0, len(receipts), 2):
+            chat_id, message_id = receipts[i], receipts[i + 1]
+            try:
+                if action == "delete":
+                    await bot.delete_message(chat_id=chat_id, message_id=message_id)
+                elif is_media:
+                    await bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=text)
+                else:
+                    await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+                ok += 1
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    ok += 1
+                else:
+                    failed += 1
+                    logging.warning(f"{action_name} {broadcast_id} для {chat_id}: {e}")
+            except Exception as e:
+                failed += 1
+                logging.warning(f"{action_name} {broadcast_id} для {chat_id}: {e}")
             
-            if sent % 10 == 0:
+            done += 1
+            if done % BROADCAST_JOB_PROGRESS_EVERY == 0:
                 await status_message.edit_text(
-                    f"⏳ Рассылка идет...\n"
-                    f"Отправлено: {sent}/{total}\n"
-                    f"Заблокировали: {blocked}\n"
-                    f"Ошибок: {failed}"
+                    f"⏳ {action_name} рассылки {broadcast_id}...\n"
+                    f"Обработано: {done}/{total}\n"
+                    f"✅ Успешно: {ok}\n"
+                    f"❌ Ошибок: {failed}"
                 )
-            await asyncio.sleep(0.05)
-            
-        except Forbidden:
-            blocked += 1
-            # Помечаем как заблокировавшего
-            if not users[uid].get("is_blocked"):
-                users[uid]["is_blocked"] = True
-                users[uid]["blocked_date"] = datetime.now(tashkent_tz).strftime("%Y-%m-%d %H:%M:%S")
-                save_users()
-            logging.warning(f"Пользователь {uid} заблокировал бота")
-            
-        except Exception as e:
-            failed += 1
-            logging.error(f"Ошибка отправки {uid}: {e}")
+        
+        if action == "edit" and key in meta["langs"]:
+            meta["langs"][key]["text"] = new_text
+    
+    stamp = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d %H:%M:%S")
+    if action == "delete":
+        meta["deleted"] = True
+        meta["deleted_at"] = stamp
+    else:
+        meta["edited"] = stamp
+    await run_io(save_broadcast_meta, meta)
     
     await status_message.edit_text(
-        f"✅ Рассылка завершена!\n\n"
-        f"📤 Отправлено: {sent}\n"
-        f"🔴 Заблокировали: {blocked}\n"
-        f"❌ Других ошибок: {failed}\n"
-        f"👥 Всего в базе: {total}"
+        f"✅ {action_name} рассылки {broadcast_id} завершено!\n\n"
+        f"Обработано: {done}/{total}\n"
+        f"✅ Успешно: {ok}\n"
+        f"❌ Ошибок: {failed}",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("⬅️ К рассылкам", callback_data="admin_bcasts")]
+        ])
     )
 
 # ---------------- SCHEDULER ----------------
-async def send_notification_with_retry(context: ContextTypes.DEFAULT_TYPE, uid: str, msg: str, event: str, date_str: str, max_retries: int = 3):
-    """Отправка уведомления с повторными попытками при flood limit"""
-    global notification_tracker
-    
+async def send_notification_with_retry(context: ContextTypes.DEFAULT_TYPE, uid: str, msg: str, event: str, date_str: str):
+    """Отправка уведомления; RetryAfter повторяет LaneRateLimiter (до OUTBOUND_MAX_RETRIES раз)"""
     chat_id = int(uid)
-    tashkent_tz = ZoneInfo("Asia/Tashkent")
+    bot = lane_bot(context, "reminder")
+    task = asyncio.current_task()
+    SENDS_IN_FLIGHT[task] = [uid, event, date_str, "queued"]
+    try:
+        return await _send_notification(bot, chat_id, uid, msg, event, date_str)
+    finally:
+        SENDS_IN_FLIGHT.pop(task, None)
+
+async def _send_notification(bot, chat_id, uid, msg, event, date_str):
+    """Отправка напоминания (отслеживается для корректной остановки)"""
+    try:
+        await bot.send_message(
+            chat_id=chat_id,
+            text=msg,
+            parse_mode="HTML"
+        )
+    except Forbidden:
+        # Пользователь заблокировал бота
+        mark_user_blocked(uid)
+        logging.warning(f"Пользователь {uid} заблокировал бота (Forbidden)")
+        return False
+    except RetryAfter as e:
+        # Полоса уже ждала и повторяла запрос — больше не пытаемся
+        logging.error(f"❌ Исчерпаны попытки для {uid} после {OUTBOUND_MAX_RETRIES} попыток: {e}")
+        return False
+    except Exception as e:
+        logging.error(f"❌ Ошибка отправки {event} для {uid}: {e}")
+        return False
     
-    for attempt in range(max_retries):
-        try:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=msg,
-                parse_mode="HTML"
-            )
-            
-            # Если отправилось успешно и раньше был заблокирован - снимаем статус
-            if users[uid].get("is_blocked"):
-                users[uid]["is_blocked"] = False
-                users[uid]["unblocked_date"] = datetime.now(tashkent_tz).strftime("%Y-%m-%d %H:%M:%S")
-                save_users()
-            
-            mark_notification_sent(notification_tracker, uid, event, date_str)
-            logging.info(f"✅ Напоминание {event} отправлено: {uid} (попытка {attempt + 1})")
-            return True
-            
-        except Forbidden:
-            # Пользователь заблокировал бота
-            if not users[uid].get("is_blocked"):
-                users[uid]["is_blocked"] = True
-                users[uid]["blocked_date"] = datetime.now(tashkent_tz).strftime("%Y-%m-%d %H:%M:%S")
-                save_users()
-            logging.warning(f"Пользователь {uid} заблокировал бота (Forbidden)")
-            return False
-            
-        except Exception as e:
-            error_str = str(e)
-            
-            if "RetryAfter" in error_str or "Flood control exceeded" in error_str:
-                retry_after = 5
-                
-                try:
-                    if "RetryAfter" in error_str:
-                        import re
-                        match = re.search(r'RetryAfter\((\d+)\)', error_str)
-                        if match:
-                            retry_after = int(match.group(1))
-                        else:
-                            if hasattr(e, 'retry_after'):
-                                retry_after = e.retry_after
-                except:
-                    pass
-                
-                if attempt < max_retries - 1:
-                    logging.warning(f"⏳ Flood limit для {uid}, ждём {retry_after}с (попытка {attempt + 1}/{max_retries})")
-                    await asyncio.sleep(retry_after + 1)
-                    continue
-                else:
-                    logging.error(f"❌ Исчерпаны попытки для {uid} после {max_retries} попыток")
-                    return False
-            else:
-                logging.error(f"❌ Ошибка отправки {event} для {uid}: {e}")
-                return False
+    # Если отправилось успешно и раньше был заблокирован - снимаем статус
+    mark_user_unblocked(uid)
     
-    return False
+    mark_notification_sent(notification_tracker, uid, event, date_str)
+    city = users[uid].get("city", "tashkent") if uid in users else "?"
+    event_log.record(
+        "sent", (event, city), "✅ Напоминание %s отправлено: %s",
+        event, uid, uid=uid, event=event, city=city
+    )
+    return True
+
+# ---------------- REMINDER PLAN ----------------
+# Запланированные напоминания: job_name -> (uid, event, date, remind_ts, event_ts, remind_min)
+pending_reminders = {}
+pending_reminders_dirty = False
+REMINDER_EVENTS = ("suhoor", "iftar")
+
+def reminder_job_name(uid, event, date_str):
+    """Имя задачи напоминания в job_queue"""
+    return f"rem_{uid}_{event}_{date_str}"
+
+def build_reminder_text(uid, event, date_str, remind_min, event_time):
+    """Собирает текст напоминания с дуа"""
+    pretty_date = format_pretty_date(datetime.strptime(date_str, "%Y-%m-%d"), uid)
+    return (
+        f"📅 {pretty_date}\n\n"
+        f"⏳ {t(uid, event+'_rem_text')} {remind_min} {t(uid, 'minute')}!\n"
+        f"🕰 {t(uid, 'open_time' if event=='iftar' else 'close_time')}: {event_time}\n\n"
+        f"{t(uid, event+'_dua_title')}\n"
+        f"<i>{t(uid, event+'_dua')}</i>"
+    )
+
+def schedule_reminder(job_queue, uid, event, date_str, remind_ts, event_ts, remind_min):
+    """Ставит напоминание в job_queue и добавляет его в сохраняемый план"""
+    global pending_reminders_dirty
+    
+    job_name = reminder_job_name(uid, event, date_str)
+    when = max(datetime.fromtimestamp(remind_ts, ZoneInfo("UTC")), clock.now(ZoneInfo("UTC")))
+    
+    job_queue.run_once(
+        send_scheduled_notification,
+        when=when,
+        user_id=int(uid),
+        data={
+            "uid": uid,
+            "event": event,
+            "date": date_str,
+            "remind_min": remind_min,
+            "event_ts": event_ts,
+        },
+        name=job_name
+    )
+    
+    pending_reminders[job_name] = (uid, event, date_str, remind_ts, event_ts, remind_min)
+    pending_reminders_dirty = True
+
+def save_reminder_plan():
+    """Сохраняет план напоминаний в компактном колоночном виде"""
+    global pending_reminders_dirty
+    
+    today = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d")
+    yesterday = (clock.now(ZoneInfo("Asia/Tashkent")) - timedelta(days=1)).strftime("%Y-%m-%d")
+    for job_name, entry in list(pending_reminders.items()):
+        if entry[2] not in (today, yesterday):
+            del pending_reminders[job_name]
+    
+    schedule_save("schedule", lambda: list(pending_reminders.values()), write_reminder_plan)
+    pending_reminders_dirty = False
+
+def write_reminder_plan(entries):
+    """Пишет снимок плана в колоночном виде (в потоке записи)"""
+    dates = sorted({entry[2] for entry in entries})
+    date_index = {value: idx for idx, value in enumerate(dates)}
+    
+    write_snapshot(SCHEDULE_FILE, [
+        marshal.dumps(tuple(dates)),
+        marshal.dumps([int(entry[0]) for entry in entries]),
+        marshal.dumps(bytes(REMINDER_EVENTS.index(entry[1]) for entry in entries)),
+        marshal.dumps(bytes(date_index[entry[2]] for entry in entries)),
+        marshal.dumps([entry[3] for entry in entries]),
+        marshal.dumps([entry[4] for entry in entries]),
+        marshal.dumps(bytes(entry[5] for entry in entries)),
+    ])
+
+def load_reminder_plan():
+    """Читает сохранённый план напоминаний"""
+    sections = read_snapshot(SCHEDULE_FILE)
+    if sections is None:
+        return []
+    
+    try:
+        dates, uids, events, date_idx, remind_ts, event_ts, remind_min = sections
+        return [
+            (str(uid), REMINDER_EVENTS[ev], dates[di], rts, ets, rm)
+            for uid, ev, di, rts, ets, rm in zip(uids, events, date_idx, remind_ts, event_ts, remind_min)
+        ]
+    except Exception as e:
+        logging.error(f"Ошибка чтения плана напоминаний: {e}")
+        return []
+
+def restore_reminder_plan(job_queue):
+    """Восстанавливает план напоминаний после перезапуска без обхода всех пользователей"""
+    now_ts = clock.now(ZoneInfo("UTC")).timestamp()
+    today = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d")
+    restored = caught_up = dropped = 0
+    
+    for uid, event, date_str, remind_ts, event_ts, remind_min in load_reminder_plan():
+        prefs = users.get(uid)
+        if not prefs or prefs.get("is_blocked"):
+            continue
+        if is_notification_sent(notification_tracker, uid, event, date_str):
+            continue
+        
+        if remind_ts > now_ts:
+            restored += 1
+        elif REMINDER_CATCHUP == "all" and date_str == today:
+            caught_up += 1
+        elif REMINDER_CATCHUP == "before" and event_ts > now_ts:
+            caught_up += 1
+        else:
+            dropped += 1
+            continue
+        
+        schedule_reminder(job_queue, uid, event, date_str, remind_ts, event_ts, remind_min)
+    
+    logging.info(
+        f"♻️ План напоминаний восстановлен: {restored} запланировано, "
+        f"{caught_up} догоняем ({REMINDER_CATCHUP}), {dropped} пропущено"
+    )
 
+@profiled("scheduler")
 async def run_scheduler(context: ContextTypes.DEFAULT_TYPE):
     """Планировщик напоминаний"""
     global notification_tracker
     
-    tashkent_now = datetime.now(ZoneInfo("Asia/Tashkent"))
+    if is_shutting_down():
+        return
+    
+    tashkent_now = clock.now(ZoneInfo("Asia/Tashkent"))
     today = tashkent_now.strftime("%Y-%m-%d")
-    now_utc = datetime.now(ZoneInfo("UTC"))
+    now_utc = clock.now(ZoneInfo("UTC"))
+    # город -> {событие: (время "HH:MM", datetime события)}; разбираем один раз за тик
+    city_events = {}
     
     for uid, prefs in list(users.items()):
         # Пропускаем заблокировавших пользователей
@@ -1363,24 +4868,30 @@ async def run_scheduler(context: ContextTypes.DEFAULT_TYPE):
             continue
             
         tz = get_tz(uid)
-        now_local = datetime.now(tz)
+        now_local = clock.now(tz)
         city = prefs.get("city", "tashkent")
         times = get_city_times(city)
         
         if today not in times:
             continue
         
+        events = city_events.get(city)
+        if events is None:
+            events = city_events[city] = {
+                event: (
+                    times[today][event],
+                    datetime.strptime(f"{today} {times[today][event]}", "%Y-%m-%d %H:%M").replace(tzinfo=tz),
+                )
+                for event in REMINDER_EVENTS
+            }
+        
         remind_min = prefs.get("remind_min", 10)
         
-        for event in ["suhoor", "iftar"]:
+        for event in REMINDER_EVENTS:
             if is_notification_sent(notification_tracker, uid, event, today):
                 continue
             
-            event_time = times[today][event]
-            event_dt_local = datetime.strptime(
-                f"{today} {event_time}", 
-                "%Y-%m-%d %H:%M"
-            ).replace(tzinfo=tz)
+            event_time, event_dt_local = events[event]
             
             remind_dt_local = event_dt_local - timedelta(minutes=remind_min)
             remind_dt_utc = remind_dt_local.astimezone(ZoneInfo("UTC"))
@@ -1388,55 +4899,32 @@ async def run_scheduler(context: ContextTypes.DEFAULT_TYPE):
             time_until_remind = (remind_dt_utc - now_utc).total_seconds()
             
             if time_until_remind > 0:
-                job_name = f"rem_{uid}_{event}_{today}"
-                
-                if not context.job_queue.get_jobs_by_name(job_name):
-                    pretty_date = format_pretty_date(now_local, uid)
-                    msg = (
-                        f"📅 {pretty_date}\n\n"
-                        f"⏳ {t(uid, event+'_rem_text')} {remind_min} {t(uid, 'minute')}!\n"
-                        f"🕰 {t(uid, 'open_time' if event=='iftar' else 'close_time')}: {event_time}\n\n"
-                        f"{t(uid, event+'_dua_title')}\n"
-                        f"<i>{t(uid, event+'_dua')}</i>"
+                # План зеркалит job_queue: запись есть, пока задача не сработала
+                if reminder_job_name(uid, event, today) not in pending_reminders:
+                    schedule_reminder(
+                        context.job_queue, uid, event, today,
+                        int(remind_dt_utc.timestamp()), int(event_dt_local.timestamp()), remind_min
                     )
                     
-                    context.job_queue.run_once(
-                        send_scheduled_notification,
-                        when=remind_dt_utc,
-                        user_id=int(uid),
-                        data={
-                            "msg": msg,
-                            "uid": uid,
-                            "event": event,
-                            "date": today
-                        },
-                        name=job_name
+                    event_log.record(
+                        "scheduled", (event, city), "📅 Запланировано %s для %s (%s) на %s",
+                        event, uid, city, remind_dt_utc, uid=uid, event=event, city=city
                     )
-                    
-                    logging.info(f"📅 Запланировано {event} для {uid} ({city}) на {remind_dt_utc}")
             
             elif -LATE_WINDOW_SECONDS <= time_until_remind <= 0:
-                logging.warning(f"⚠️ ОПОЗДАНИЕ: {event} для {uid} прошло {abs(time_until_remind):.0f}с назад, отправляем сейчас!")
-                
-                pretty_date = format_pretty_date(now_local, uid)
-                msg = (
-                    f"📅 {pretty_date}\n\n"
-                    f"⏳ {t(uid, event+'_rem_text')} {remind_min} {t(uid, 'minute')}!\n"
-                    f"🕰 {t(uid, 'open_time' if event=='iftar' else 'close_time')}: {event_time}\n\n"
-                    f"{t(uid, event+'_dua_title')}\n"
-                    f"<i>{t(uid, event+'_dua')}</i>"
+                event_log.record(
+                    "late", (event, city), "⚠️ ОПОЗДАНИЕ: %s для %s прошло %.0fс назад, отправляем сейчас!",
+                    event, uid, abs(time_until_remind), level=logging.WARNING, uid=uid, event=event, city=city
                 )
                 
+                msg = build_reminder_text(uid, event, today, remind_min, event_time)
+                
                 asyncio.create_task(
                     send_notification_with_retry(context, uid, msg, event, today)
                 )
         
-        for event in ["suhoor", "iftar"]:
-            event_time = times[today][event]
-            event_dt = datetime.strptime(
-                f"{today} {event_time}", 
-                "%Y-%m-%d %H:%M"
-            ).replace(tzinfo=tz)
+        for event in REMINDER_EVENTS:
+            event_dt = events[event][1]
             
             diff = (now_local - event_dt).total_seconds()
             if 0 <= diff <= 120:
@@ -1456,37 +4944,466 @@ async def run_scheduler(context: ContextTypes.DEFAULT_TYPE):
                         )
                     
                     try:
-                        await context.bot.send_message(
+                        await lane_bot(context, "reminder").send_message(
                             chat_id=int(uid),
                             text=congrats_msg
                         )
                         update_user(uid, **{congrats_key: True})
-                        logging.info(f"🎉 Поздравление {event} для {uid}")
+                        event_log.record(
+                            "congrats", (event, city), "🎉 Поздравление %s для %s",
+                            event, uid, uid=uid, event=event, city=city
+                        )
                     except Forbidden:
                         # Помечаем как заблокировавшего
-                        if not users[uid].get("is_blocked"):
-                            users[uid]["is_blocked"] = True
-                            users[uid]["blocked_date"] = datetime.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d %H:%M:%S")
-                            save_users()
+                        mark_user_blocked(uid)
                     except Exception as e:
                         logging.error(f"Ошибка поздравления {uid}: {e}")
+    
+    if pending_reminders_dirty:
+        save_reminder_plan()
+    event_log.flush()
 
 async def send_scheduled_notification(context: ContextTypes.DEFAULT_TYPE):
     """Отправка запланированного уведомления"""
+    global pending_reminders_dirty
+    
     job = context.job
     data = job.data
     
     uid = data["uid"]
     event = data["event"]
     date_str = data["date"]
-    msg = data["msg"]
+    
+    if is_shutting_down():
+        # Остаётся в плане и будет восстановлено после перезапуска
+        return
+    
+    if pending_reminders.pop(job.name, None):
+        pending_reminders_dirty = True
     
     if is_notification_sent(notification_tracker, uid, event, date_str):
-        logging.info(f"⏭ Пропускаем {event} для {uid} - уже отправлено")
+        event_log.record(
+            "skipped", (event,), "⏭ Пропускаем %s для %s - уже отправлено",
+            event, uid, uid=uid, event=event
+        )
         return
     
+    if uid not in users:
+        return
+    
+    event_time = datetime.fromtimestamp(data["event_ts"], get_tz(uid)).strftime("%H:%M")
+    msg = build_reminder_text(uid, event, date_str, data["remind_min"], event_time)
+    
     await send_notification_with_retry(context, uid, msg, event, date_str)
 
+# ---------------- INLINE MODE ----------------
+# Псевдонимы городов в inline-запросе -> (город, язык ответа)
+CITY_ALIASES = {
+    "tashkent": ("tashkent", "uz"),
+    "toshkent": ("tashkent", "uz"),
+    "ташкент": ("tashkent", "ru"),
+    "тошкент": ("tashkent", "uz"),
+    "bremen": ("bremen", "uz"),
+    "бремен": ("bremen", "ru"),
+}
+SUPPORTED_CITIES = ("tashkent", "bremen")
+INLINE_MIN_CACHE_TIME = 60
+
+# (город, язык, дата) -> готовые результаты inline-запроса
+INLINE_RESULTS_CACHE = {}
+
+def seconds_until_local_midnight(city):
+    """Сколько секунд осталось до полуночи по времени города"""
+    now = clock.now(get_city_tz(city))
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int((midnight - now).total_seconds())
+
+def build_inline_results(city, lang, date_str):
+    """Готовит статьи «сегодня» и «завтра» для города на нужном языке"""
+    times = get_city_times(city)
+    today = datetime.strptime(date_str, "%Y-%m-%d")
+    city_name = get_city_name(city, lang)
+    results = []
+    
+    for key, day in (("today", today), ("tomorrow", today + timedelta(days=1))):
+        day_str = day.strftime("%Y-%m-%d")
+        res = times.get(day_str)
+        if not res:
+            continue
+        
+        pretty_date = format_pretty_date_lang(day, lang)
+        text = (
+            f"📍 {city_name}\n"
+            f"📅 {pretty_date}\n\n"
+            f"{get_text_by_lang(lang, 'suhoor_until')} {res['suhoor']}\n"
+            f"{get_text_by_lang(lang, 'iftar_time')} {res['iftar']}"
+        )
+        results.append(InlineQueryResultArticle(
+            id=f"{city}_{lang}_{day_str}",
+            title=f"{get_text_by_lang(lang, key)} — {city_name}",
+            description=f"🌅 {res['suhoor']}  ·  🕰 {res['iftar']}  ·  {pretty_date}",
+            input_message_content=InputTextMessageContent(text),
+        ))
+    return results
+
+def get_inline_results(city, lang):
+    """Результаты для (город, язык, сегодняшняя дата города) из кэша"""
+    date_str = clock.now(get_city_tz(city)).strftime("%Y-%m-%d")
+    key = (city, lang, date_str)
+    results = INLINE_RESULTS_CACHE.get(key)
+    if results is None:
+        # Вчерашние наборы больше не понадобятся
+        for old_key in [k for k in INLINE_RESULTS_CACHE if k[0] == city and k[2] != date_str]:
+            del INLINE_RESULTS_CACHE[old_key]
+        results = INLINE_RESULTS_CACHE[key] = build_inline_results(city, lang, date_str)
+    return results
+
+def warm_inline_cache():
+    """Заранее готовит inline-результаты для всех городов и языков"""
+    for city in SUPPORTED_CITIES:
+        for lang in ("uz", "ru"):
+            get_inline_results(city, lang)
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Inline-режим: время сухура и ифтара для города"""
+    query = update.inline_query
+    text = query.query.strip().lower()
+    
+    matches = []
+    if text:
+        matches = [value for alias, value in CITY_ALIASES.items() if alias.startswith(text)]
+    
+    if matches:
+        # Ответ зависит только от текста запроса — Telegram кэширует его для всех
+        pairs = list(dict.fromkeys(matches))
+        is_personal = False
+    else:
+        user = users.get(str(query.from_user.id))
+        if user:
+            pairs = [(user.get("city", "tashkent"), user.get("lang", "uz"))]
+        else:
+            lang = "ru" if (query.from_user.language_code or "").startswith("ru") else "uz"
+            pairs = [(city, lang) for city in SUPPORTED_CITIES]
+        is_personal = True
+    
+    results = []
+    for city, lang in pairs:
+        results.extend(get_inline_results(city, lang))
+    
+    cache_time = max(
+        INLINE_MIN_CACHE_TIME,
+        min(seconds_until_local_midnight(city) for city, _ in pairs)
+    )
+    await query.answer(results[:50], cache_time=cache_time, is_personal=is_personal)
+
+# ---------------- NEAREST CITY ----------------
+# Координаты городов поставляются с кодом в CITIES_FILE. Из поддерживаемых
+# городов при запуске строится k-d дерево по точкам на единичной сфере
+# (x, y, z): хорда монотонна по расстоянию по дуге, а долгота 180° не
+# требует особой обработки. Поиск ближайшего — O(log n).
+CITIES_FILE = os.path.join(BASE_DIR, "cities.json")
+EARTH_RADIUS_KM = 6371.0
+# Дальше этого ближайший город не подставляется автоматически
+LOCATION_MAX_KM = float(os.getenv("LOCATION_MAX_KM", "300"))
+
+def to_unit_vector(lat, lon):
+    """Широта/долгота в градусах -> точка на единичной сфере"""
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+class CityIndex:
+    """k-d дерево городов; узлы — кортежи (точка, город, ось, левый, правый)"""
+
+    def __init__(self, cities):
+        self.nodes = []
+        points = [(to_unit_vector(lat, lon), city) for city, lat, lon in cities]
+        self.root = self._build(points, 0)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _build(self, points, depth):
+        if not points:
+            return -1
+        axis = depth % 3
+        points.sort(key=lambda item: item[0][axis])
+        mid = len(points) // 2
+        index = len(self.nodes)
+        self.nodes.append(None)
+        left = self._build(points[:mid], depth + 1)
+        right = self._build(points[mid + 1:], depth + 1)
+        self.nodes[index] = (points[mid][0], points[mid][1], axis, left, right)
+        return index
+
+    def nearest(self, lat, lon):
+        """(город, расстояние в км) или (None, None) для пустого индекса"""
+        if self.root < 0:
+            return None, None
+        target = to_unit_vector(lat, lon)
+        nodes = self.nodes
+        best_city, best = None, float("inf")
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node < 0:
+                continue
+            point, city, axis, left, right = nodes[node]
+            dist = (
+                (point[0] - target[0]) ** 2
+                + (point[1] - target[1]) ** 2
+                + (point[2] - target[2]) ** 2
+            )
+            if dist < best:
+                best_city, best = city, dist
+            diff = target[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            # Дальнюю ветку проверяем, только если плоскость разбиения ближе лучшего
+            if diff * diff < best:
+                stack.append(far)
+            stack.append(near)
+        chord = math.sqrt(best)
+        return best_city, 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+def load_city_index():
+    """Индекс поддерживаемых городов из CITIES_FILE"""
+    try:
+        with open(CITIES_FILE, "r", encoding="utf-8") as f:
+            dataset = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.error(f"Ошибка загрузки {CITIES_FILE}: {e}")
+        dataset = {}
+    
+    missing = [city for city in SUPPORTED_CITIES if city not in dataset]
+    if missing:
+        logging.warning(f"📍 Нет координат для городов: {', '.join(missing)}")
+    return CityIndex(
+        (city, dataset[city]["lat"], dataset[city]["lon"])
+        for city in SUPPORTED_CITIES if city in dataset
+    )
+
+city_index = load_city_index()
+
+def register_user(uid, tg_user, lang, city):
+    """Создаёт пользователя по итогам onboarding"""
+    now = clock.now(ZoneInfo("Asia/Tashkent")).strftime("%Y-%m-%d %H:%M:%S")
+    users[uid] = UserRecord({
+        "lang": lang,
+        "city": city,
+        "remind_min": 10,
+        "first_name": tg_user.first_name,
+        "username": tg_user.username,
+        "joined": now,
+        "last_active": now,
+        "push_sent": False
+    })
+    audience.add(uid, users[uid])
+    activity.touch(uid, users[uid].last_active, new=True)
+    save_users()
+
+async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выбор ближайшего города по присланной геолокации"""
+    uid = str(update.effective_chat.id)
+    location = update.message.location
+    await restore_archived_user(uid)
+    
+    onboarding = context.user_data.get("onboarding") == ONBOARD_CITY and uid not in users
+    if not onboarding and uid not in users:
+        await update.message.reply_text(
+            "👋 Добро пожаловать! Отправьте /start для начала работы.\n\n"
+            "👋 Xush kelibsiz! Ishni boshlash uchun /start yuboring.",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return
+    
+    lang = context.user_data.get("new_lang", "uz") if onboarding else get_lang(uid)
+    city, km = city_index.nearest(location.latitude, location.longitude)
+    
+    if city is None or km > LOCATION_MAX_KM:
+        if city is not None:
+            text = get_text_by_lang(lang, "location_too_far").format(city=get_city_name(city, lang), km=round(km))
+        else:
+            text = "📍"
+        await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+        await update.message.reply_text(
+            get_text_by_lang(lang, "choose_city"),
+            reply_markup=city_choice_kb(lang, onboarding=onboarding)
+        )
+        return
+    
+    await update.message.reply_text(
+        get_text_by_lang(lang, "location_city").format(city=get_city_name(city, lang), km=round(km)),
+        reply_markup=ReplyKeyboardRemove()
+    )
+    
+    if onboarding:
+        register_user(uid, update.effective_user, lang, city)
+        context.user_data.clear()
+        await update.message.reply_text(
+            get_text_by_lang(lang, "welcome_message"),
+            reply_markup=main_kb_for_lang(lang)
+        )
+    else:
+        update_activity(update.effective_user, uid)
+        update_user(uid, city=city)
+        await update.message.reply_text(t(uid, "city_changed"), reply_markup=main_kb(uid))
+
+# ---------------- SHUTDOWN ----------------
+# Порядок остановки по SIGTERM/SIGINT: перестаём брать новую работу,
+# даём отправкам SHUTDOWN_DEADLINE секунд, отменяем оставшиеся, сохраняем
+# план, пользователей и трекер и пишем запись для восстановления.
+SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE", "20"))
+# задача -> [uid, событие, дата, "queued" | "sending"]
+SENDS_IN_FLIGHT = {}
+shutdown_state = {"stopping": False, "broadcasts": []}
+
+def is_shutting_down():
+    """Идёт ли остановка бота"""
+    return shutdown_state["stopping"]
+
+def reminder_plan_entry(uid, event, date_str):
+    """Запись плана для напоминания, отменённого при остановке (или None)"""
+    prefs = users.get(uid)
+    if not prefs:
+        return None
+    day = get_city_times(prefs.get("city", "tashkent")).get(date_str)
+    if not day:
+        return None
+    
+    remind_min = prefs.get("remind_min", 10)
+    event_dt = datetime.strptime(f"{date_str} {day[event]}", "%Y-%m-%d %H:%M").replace(tzinfo=get_tz(uid))
+    remind_ts = int((event_dt - timedelta(minutes=remind_min)).timestamp())
+    return (uid, event, date_str, remind_ts, int(event_dt.timestamp()), remind_min)
+
+def write_recovery_record(record):
+    """Пишет запись для восстановления после перезапуска (в потоке записи)"""
+    temp_file = f"{RECOVERY_FILE}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(record, f, ensure_ascii=False)
+        fsync_file(f)
+    os.replace(temp_file, RECOVERY_FILE)
+
+async def graceful_shutdown(app):
+    """Останавливает бота, дожидаясь или сохраняя незавершённые отправки"""
+    global pending_reminders_dirty
+    
+    if is_shutting_down():
+        # Повторный сигнал — выходим без ожидания
+        app.stop_running()
+        return
+    shutdown_state["stopping"] = True
+    started = time.monotonic()
+    logging.info(f"🛑 Остановка: ждём отправки до {SHUTDOWN_DEADLINE:.0f}с")
+    
+    # Рассылки сами прерываются по флагу; остальная работа — до дедлайна
+    tasks = set(SENDS_IN_FLIGHT) | {
+        task for name, task in BACKGROUND_TASKS.items()
+        if name != "loop_lag" and not task.done()
+    }
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_DEADLINE)
+    else:
+        pending = set()
+    
+    # Что не успело — отменяем; неотправленные напоминания возвращаем в план
+    uncertain = []
+    requeued = 0
+    for task in pending:
+        in_flight = SENDS_IN_FLIGHT.get(task)
+        if in_flight:
+            uid, event, date_str, state = in_flight
+            if state == "sending":
+                uncertain.append([uid, event, date_str])
+            else:
+                entry = reminder_plan_entry(uid, event, date_str)
+                if entry:
+                    pending_reminders[reminder_job_name(uid, event, date_str)] = entry
+                    requeued += 1
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    
+    pending_reminders_dirty = True
+    save_reminder_plan()
+    save_users(with_json=True)
+    await flush_saves()
+    event_log.flush()
+    
+    record = {
+        "stopped_at": clock.now(ZoneInfo("Asia/Tashkent")).strftime(TS_FORMAT),
+        "drained": not pending,
+        "requeued": requeued,
+        "uncertain": uncertain,
+        "broadcasts": shutdown_state["broadcasts"],
+    }
+    try:
+        await run_io(write_recovery_record, record)
+    except Exception as e:
+        logging.error(f"Ошибка записи {RECOVERY_FILE}: {e}")
+    
+    logging.info(
+        f"🛑 Остановка за {time.monotonic() - started:.1f}с: отменено {len(pending)}, "
+        f"возвращено в план {requeued}, под вопросом {len(uncertain)}, "
+        f"прервано рассылок {len(shutdown_state['broadcasts'])}"
+    )
+    app.stop_running()
+
+def install_shutdown_handlers(app):
+    """Перехватывает SIGTERM/SIGINT для корректной остановки"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lambda: app.create_task(graceful_shutdown(app)))
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка только через Ctrl+C без ожидания отправок
+            return False
+    return True
+
+def take_recovery_record():
+    """Читает и удаляет запись о прошлой остановке (в потоке записи); None, если её нет"""
+    if not os.path.exists(RECOVERY_FILE):
+        return None
+    with open(RECOVERY_FILE, "r", encoding="utf-8") as f:
+        record = json.load(f)
+    os.remove(RECOVERY_FILE)
+    return record
+
+async def apply_recovery_record(app):
+    """Разбирает запись о прошлой остановке"""
+    try:
+        record = await run_io(take_recovery_record)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.error(f"Ошибка чтения {RECOVERY_FILE}: {e}")
+        return
+    if record is None:
+        return
+    
+    # Запрос мог дойти до Telegram — второй раз не отправляем
+    for uid, event, date_str in record.get("uncertain", []):
+        notification_tracker[f"{uid}_{event}_{date_str}"] = True
+    if record.get("uncertain"):
+        save_tracker(notification_tracker)
+    
+    logging.info(
+        f"♻️ Прошлая остановка {record.get('stopped_at')}: "
+        f"{'всё отправлено' if record.get('drained') else 'не всё успели'}, "
+        f"в план возвращено {record.get('requeued', 0)}, "
+        f"под вопросом {len(record.get('uncertain', []))}"
+    )
+    
+    broadcasts = record.get("broadcasts", [])
+    if broadcasts:
+        lines = [
+            f"• {item['id']}: отправлено {item['sent']}, не отправлено {item['remaining']}"
+            for item in broadcasts
+        ]
+        try:
+            await app.bot.send_message(
+                chat_id=ADMIN_ID,
+                text="⏸ Рассылки, прерванные перезапуском:\n" + "\n".join(lines)
+            )
+        except Exception as e:
+            logging.error(f"Не удалось сообщить о прерванных рассылках: {e}")
+
 # ---------------- MAIN ----------------
 async def set_bot_commands(app):
     """Установка команд бота"""
@@ -1505,15 +5422,48 @@ async def set_bot_commands(app):
     await app.bot.set_my_commands(ru_commands, language_code="ru")
     await app.bot.set_my_commands(uz_commands, language_code="uz")
 
+async def post_init(app):
+    """Инициализация после запуска приложения"""
+    for lane in ("reminder", "broadcast"):
+        LANE_BOTS[lane] = build_lane_bot(lane)
+        await LANE_BOTS[lane].initialize()
+    
+    BACKGROUND_TASKS["loop_lag"] = app.create_task(monitor_loop_lag())
+    install_shutdown_handlers(app)
+    await set_bot_commands(app)
+    for problem in await refresh_timetables():
+        logging.error(problem)
+    await apply_recovery_record(app)
+    await rollup_daily_stats()
+    restore_reminder_plan(app.job_queue)
+    warm_inline_cache()
+
+async def post_shutdown(app):
+    """Освобождение ресурсов после остановки приложения"""
+    save_users(with_json=True)
+    await flush_saves()
+    for bot in LANE_BOTS.values():
+        await bot.shutdown()
+    LANE_BOTS.clear()
+    await outbound.stop()
+    IO_EXECUTOR.shutdown(wait=True)
+
 def main():
     """Точка входа"""
     if not TOKEN:
         logging.error("❌ BOT_TOKEN не найден в переменных окружения!")
         return
     
-    app = ApplicationBuilder().token(TOKEN).build()
-    
-    app.post_init = set_bot_commands
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .connection_pool_size(LANE_POOL_SIZES["interactive"])
+        .rate_limiter(LaneRateLimiter(outbound, "interactive"))
+        .concurrent_updates(PerChatUpdateProcessor(UPDATE_WORKERS))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Обработчики команд
     app.add_handler(CommandHandler("start", start))
@@ -1521,16 +5471,31 @@ def main():
     app.add_handler(CommandHandler("settings", settings_cmd))
     app.add_handler(CommandHandler("broadcast", broadcast))
     app.add_handler(CommandHandler("admin", admin_panel))
+    app.add_handler(CommandHandler("export", export_cmd))
+    app.add_handler(CommandHandler("profile", profile_cmd))
+    app.add_handler(CommandHandler("memsnap", memsnap_cmd))
     
     # Обработчики сообщений и кнопок
     app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_message_handler))
+    app.add_handler(InlineQueryHandler(inline_query_handler))
+    app.add_handler(MessageHandler(filters.LOCATION, location_handler))
+    app.add_handler(MessageHandler(
+        (filters.TEXT & ~filters.COMMAND)
+        | filters.PHOTO | filters.VIDEO | filters.VOICE | filters.Document.ALL,
+        admin_message_handler
+    ))
     
     # Планировщик
     app.job_queue.run_repeating(run_scheduler, interval=60, first=5)
+    app.job_queue.run_daily(timetable_job, time=dt_time(TIMETABLE_HOUR, 0, tzinfo=ZoneInfo("Asia/Tashkent")))
+    app.job_queue.run_daily(daily_stats_job, time=dt_time(DAILY_STATS_HOUR, DAILY_STATS_MINUTE, tzinfo=ZoneInfo("Asia/Tashkent")))
+    app.job_queue.run_daily(archive_job, time=dt_time(ARCHIVE_HOUR, 0, tzinfo=ZoneInfo("Asia/Tashkent")))
+    # Тик живых отсчётов — в начале каждой минуты
+    app.job_queue.run_repeating(live_countdown_tick, interval=60, first=61 - time.time() % 60)
     
     logging.info("🚀 БОТ ЗАПУЩЕН")
-    app.run_polling()
+    # Сигналы остановки обрабатывает graceful_shutdown (см. post_init)
+    app.run_polling(stop_signals=None)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
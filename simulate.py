@@ -0,0 +1,367 @@
+"""Симуляция сезона напоминаний на виртуальных часах.
+
+Прокручивает виртуальное время через весь сезон расписания: run_scheduler,
+задачи напоминаний и поздравления работают как в боте, но с фейковыми Bot
+и JobQueue и без ожидания. В конце печатает сравнение расчётного и
+фактического (виртуального) времени каждого напоминания и скорость
+симуляции.
+
+    python simulate.py [--users N] [--start ГГГГ-ММ-ДД] [--end ГГГГ-ММ-ДД]
+                       [--timetables КАТАЛОГ] [--every-minute] [--csv ФАЙЛ]
+
+Данные пишутся во временный DATA_DIR; --timetables добавляет сезоны
+(формат как в DATA_DIR/timetables), например с переходом на летнее время.
+"""
+import argparse
+import asyncio
+import csv
+import heapq
+import itertools
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+SCHEDULER_INTERVAL = 60
+SCHEDULER_FIRST = 5
+REMIND_CHOICES = (5, 10, 15)
+# Сколько худших отклонений печатать
+WORST_SHOWN = 10
+
+class FakeBot:
+    """Bot, который только запоминает отправленное и виртуальное время отправки"""
+
+    def __init__(self, main):
+        self.main = main
+        self.reminders = {}   # (uid, event, date) -> [время отправки, ...]
+        self.congrats = 0
+        self.other = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        sending = self.main.SENDS_IN_FLIGHT.get(asyncio.current_task())
+        if sending is not None:
+            uid, event, date_str = sending[:3]
+            self.reminders.setdefault((uid, event, date_str), []).append(self.main.clock.time())
+        elif text.startswith(("🌅", "🌙")):
+            self.congrats += 1
+        else:
+            self.other += 1
+        return SimpleNamespace(message_id=self.congrats + self.other + len(self.reminders), chat_id=chat_id)
+
+class FakeJob:
+    __slots__ = ("callback", "data", "name", "removed")
+
+    def __init__(self, callback, data, name):
+        self.callback = callback
+        self.data = data
+        self.name = name
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+class FakeJobQueue:
+    """Очередь разовых задач по виртуальному времени"""
+
+    def __init__(self, main):
+        self.main = main
+        self.heap = []
+        self.by_name = {}
+        self.counter = itertools.count()
+
+    def run_once(self, callback, when, data=None, name=None, **kwargs):
+        if isinstance(when, datetime):
+            ts = when.timestamp()
+        elif isinstance(when, timedelta):
+            ts = self.main.clock.time() + when.total_seconds()
+        else:
+            ts = self.main.clock.time() + when
+        job = FakeJob(callback, data, name)
+        heapq.heappush(self.heap, (ts, next(self.counter), job))
+        self.by_name.setdefault(name, []).append(job)
+        return job
+
+    def get_jobs_by_name(self, name):
+        return tuple(job for job in self.by_name.get(name, ()) if not job.removed)
+
+    def next_due(self, until):
+        """Следующая задача со временем не позже until или None"""
+        while self.heap and self.heap[0][0] <= until:
+            ts, _, job = heapq.heappop(self.heap)
+            jobs = self.by_name.get(job.name)
+            if jobs is not None:
+                jobs.remove(job)
+                if not jobs:
+                    del self.by_name[job.name]
+            if not job.removed:
+                return ts, job
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Симуляция сезона напоминаний")
+    parser.add_argument("--users", type=int, default=200, help="число синтетических пользователей")
+    parser.add_argument("--start", type=date.fromisoformat, help="первый день (по умолчанию — начало сезона)")
+    parser.add_argument("--end", type=date.fromisoformat, help="последний день (по умолчанию — конец сезона)")
+    parser.add_argument("--timetables", help="каталог с дополнительными сезонами <город>/<дата>.json")
+    parser.add_argument("--every-minute", action="store_true", help="запускать планировщик каждую минуту, а не только у событий")
+    parser.add_argument("--csv", help="записать все напоминания (расчёт/факт) в CSV")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+def import_bot(args):
+    """Импортирует main с временным DATA_DIR (боевые данные не трогаются)"""
+    data_dir = tempfile.mkdtemp(prefix="ramadan-sim-")
+    if args.timetables:
+        shutil.copytree(args.timetables, os.path.join(data_dir, "timetables"))
+    os.environ["DATA_DIR"] = data_dir
+    os.environ.setdefault("LOG_FORMAT", "text")
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    return main, data_dir
+
+def season_range(main, args):
+    """Дни симуляции: заданные или последний начавшийся (иначе ближайший) сезон"""
+    today = date.today().toordinal()
+    asyncio.run(main.refresh_timetables())
+    seasons = []
+    for city in main.SUPPORTED_CITIES:
+        timetable = main.get_city_times(city)
+        # Бот держит в памяти только текущий и следующий сезон — симуляции нужны все
+        for start in timetable.starts:
+            season = timetable.loaded.get(start) or timetable.read(start)
+            if season is not None:
+                timetable.add(season)
+                seasons.append((season.start, season.end - 1))
+    if not seasons:
+        sys.exit("Нет ни одного сезона расписания")
+
+    started = [season for season in seasons if season[0] <= today]
+    first = max(started)[0] if started else min(seasons)[0]
+    last = max(end for start, end in seasons if start <= first + 31 and end >= first)
+    first = args.start.toordinal() if args.start else first
+    last = args.end.toordinal() if args.end else last
+    return date.fromordinal(first), date.fromordinal(last)
+
+def create_users(main, count, seed, joined_before):
+    """Синтетические пользователи по всем поддерживаемым городам"""
+    rng = random.Random(seed)
+    joined = joined_before.strftime(main.TS_FORMAT)
+    for i in range(count):
+        uid = str(100000000 + i)
+        main.users[uid] = main.UserRecord({
+            "lang": rng.choice(("uz", "ru")),
+            "city": main.SUPPORTED_CITIES[i % len(main.SUPPORTED_CITIES)],
+            "remind_min": rng.choice(REMIND_CHOICES),
+            "first_name": f"sim{i}",
+            "joined": joined,
+            "last_active": joined,
+            "push_sent": False,
+        })
+        main.audience.add(uid, main.users[uid])
+
+def intended_reminders(main, first, last, start_ts, end_ts):
+    """Расчётное время напоминаний по местному календарю каждого города"""
+    intended = {}
+    for uid, user in main.users.items():
+        tz = main.get_city_tz(user.city)
+        times = main.get_city_times(user.city)
+        for ordinal in range(first.toordinal(), last.toordinal() + 1):
+            date_str = date.fromordinal(ordinal).isoformat()
+            day = times.get(date_str)
+            if day is None:
+                continue
+            for event in main.REMINDER_EVENTS:
+                event_dt = datetime.strptime(f"{date_str} {day[event]}", "%Y-%m-%d %H:%M").replace(tzinfo=tz)
+                remind_ts = event_dt.timestamp() - user.remind_min * 60
+                if start_ts <= remind_ts <= end_ts:
+                    intended[(uid, event, date_str)] = remind_ts
+    return intended
+
+def scheduler_ticks(main, first, last, start_ts, end_ts, every_minute):
+    """Моменты запуска run_scheduler на сетке SCHEDULER_INTERVAL.
+
+    Без --every-minute берутся только тики, где планировщику есть что
+    делать: после полуночи по Ташкенту (планирование дня), перед
+    событиями (окно опозданий) и сразу после них (поздравления).
+    """
+    grid_start = start_ts + SCHEDULER_FIRST
+    if every_minute:
+        return [grid_start + i * SCHEDULER_INTERVAL for i in range(int((end_ts - grid_start) // SCHEDULER_INTERVAL) + 1)]
+
+    lead = max(REMIND_CHOICES) * 60 + main.LATE_WINDOW_SECONDS + SCHEDULER_INTERVAL
+    windows = []
+    tashkent = ZoneInfo("Asia/Tashkent")
+    for ordinal in range(first.toordinal(), last.toordinal() + 2):
+        midnight = datetime.combine(date.fromordinal(ordinal), datetime.min.time(), tashkent).timestamp()
+        windows.append((midnight, midnight + 2 * SCHEDULER_INTERVAL))
+    for city in main.SUPPORTED_CITIES:
+        tz = main.get_city_tz(city)
+        times = main.get_city_times(city)
+        for ordinal in range(first.toordinal(), last.toordinal() + 1):
+            date_str = date.fromordinal(ordinal).isoformat()
+            day = times.get(date_str)
+            if day is None:
+                continue
+            for event in main.REMINDER_EVENTS:
+                event_ts = datetime.strptime(f"{date_str} {day[event]}", "%Y-%m-%d %H:%M").replace(tzinfo=tz).timestamp()
+                windows.append((event_ts - lead, event_ts + 3 * SCHEDULER_INTERVAL))
+
+    ticks = set()
+    for begin, end in windows:
+        k = max(0, -int(-(begin - grid_start) // SCHEDULER_INTERVAL))
+        tick = grid_start + k * SCHEDULER_INTERVAL
+        while tick <= min(end, end_ts):
+            ticks.add(tick)
+            tick += SCHEDULER_INTERVAL
+    return sorted(ticks)
+
+async def settle():
+    """Дожидается задач, созданных планировщиком (отправка опоздавших)"""
+    current = asyncio.current_task()
+    while True:
+        tasks = [task for task in asyncio.all_tasks() if task is not current and not task.done()]
+        if not tasks:
+            return
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def run(main, ticks, end_ts, bot, job_queue):
+    """Прогоняет тики планировщика и задачи напоминаний по порядку времени"""
+    sim_clock = main.clock
+    context = SimpleNamespace(bot=bot, job_queue=job_queue, job=None, application=None, bot_data={})
+    for tick in ticks + [end_ts]:
+        while (due := job_queue.next_due(tick)) is not None:
+            ts, job = due
+            sim_clock.set(ts)
+            context.job = job
+            await job.callback(context)
+            await settle()
+        context.job = None
+        sim_clock.set(tick)
+        if tick != end_ts:
+            await main.run_scheduler(context)
+            await settle()
+    await main.flush_saves()
+
+def offset_changes(main, first, last):
+    """Смены смещения UTC (переход на летнее время) внутри симуляции по городам"""
+    changes = []
+    for city in main.SUPPORTED_CITIES:
+        tz = main.get_city_tz(city)
+        previous = None
+        for ordinal in range(first.toordinal(), last.toordinal() + 2):
+            offset = datetime.combine(date.fromordinal(ordinal), datetime.min.time(), tz).replace(hour=12).utcoffset()
+            if previous is not None and offset != previous:
+                changes.append(f"{city}: {date.fromordinal(ordinal)} {previous} → {offset}")
+            previous = offset
+    return changes
+
+def report(main, intended, bot, ticks, first, last, start_ts, end_ts, wall, args):
+    """Печатает итоги и при необходимости пишет CSV"""
+    rows = []
+    for key, remind_ts in sorted(intended.items(), key=lambda item: item[1]):
+        sent = bot.reminders.get(key, [])
+        rows.append((key, remind_ts, sent[0] if sent else None, len(sent)))
+    unexpected = [key for key in bot.reminders if key not in intended]
+    delays = [sent - remind_ts for _, remind_ts, sent, _ in rows if sent is not None]
+    missing = [row for row in rows if row[2] is None]
+    duplicates = [row for row in rows if row[3] > 1]
+    sent_total = sum(len(times) for times in bot.reminders.values())
+
+    tz = ZoneInfo("Asia/Tashkent")
+    fmt = lambda ts: datetime.fromtimestamp(ts, tz).strftime("%m-%d %H:%M:%S") if ts is not None else "—"
+    print(f"Период: {first} — {last} ({(end_ts - start_ts) / 86400:.1f} вирт. суток), пользователей: {len(main.users)}")
+    for change in offset_changes(main, first, last):
+        print(f"Смена UTC-смещения: {change}")
+    print(f"Тиков планировщика: {len(ticks)}{' (каждую минуту)' if args.every_minute else ''}")
+    print()
+    print(f"Напоминаний по расчёту: {len(intended)}")
+    print(f"Отправлено: {sent_total}, не отправлено: {len(missing)}, дублей: {len(duplicates)}, лишних: {len(unexpected)}")
+    if delays:
+        print(
+            f"Отклонение от расчёта, с: мин {min(delays):+.0f}, медиана {statistics.median(delays):+.0f}, "
+            f"макс {max(delays):+.0f}; больше минуты: {sum(1 for d in delays if abs(d) > 60)}"
+        )
+    for city in main.SUPPORTED_CITIES:
+        city_delays = [
+            sent - remind_ts for key, remind_ts, sent, _ in rows
+            if sent is not None and main.users[key[0]].city == city
+        ]
+        city_missing = sum(1 for key, *_ in missing if main.users[key[0]].city == city)
+        if city_delays or city_missing:
+            print(
+                f"  {city}: отправлено {len(city_delays)}, не отправлено {city_missing}, "
+                f"макс. отклонение {max((abs(d) for d in city_delays), default=0):.0f} с"
+            )
+    print(f"Поздравлений: {bot.congrats}, прочих сообщений: {bot.other}")
+
+    worst = sorted(
+        (row for row in rows if row[2] is None or abs(row[2] - row[1]) > 1),
+        key=lambda row: float("inf") if row[2] is None else abs(row[2] - row[1]),
+        reverse=True
+    )[:WORST_SHOWN]
+    if worst or unexpected:
+        print("\nХудшие случаи (время по Ташкенту):")
+        for (uid, event, date_str), remind_ts, sent, _ in worst:
+            delta = "не отправлено" if sent is None else f"{sent - remind_ts:+.0f} с"
+            print(f"  {uid} {event} {date_str}: расчёт {fmt(remind_ts)}, факт {fmt(sent)} ({delta})")
+        for uid, event, date_str in unexpected[:WORST_SHOWN]:
+            print(f"  {uid} {event} {date_str}: отправлено без расчёта в {fmt(bot.reminders[(uid, event, date_str)][0])}")
+
+    print(
+        f"\nСимуляция: {wall:.2f} с реального времени, "
+        f"{(end_ts - start_ts) / wall:,.0f}× быстрее реального, "
+        f"{sent_total / wall:,.0f} напоминаний/с, {len(ticks) / wall:,.0f} тиков/с"
+    )
+
+    if args.csv:
+        with open(args.csv, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["uid", "city", "event", "date", "intended", "sent", "delay_s", "sends"])
+            for (uid, event, date_str), remind_ts, sent, count in rows:
+                writer.writerow([
+                    uid, main.users[uid].city, event, date_str,
+                    datetime.fromtimestamp(remind_ts, ZoneInfo("UTC")).isoformat(),
+                    datetime.fromtimestamp(sent, ZoneInfo("UTC")).isoformat() if sent is not None else "",
+                    f"{sent - remind_ts:.0f}" if sent is not None else "",
+                    count,
+                ])
+        print(f"CSV: {args.csv}")
+
+def main_cli():
+    args = parse_args()
+    main, data_dir = import_bot(args)
+    try:
+        first, last = season_range(main, args)
+        tashkent = ZoneInfo("Asia/Tashkent")
+        # С полуночи первого дня по Ташкенту до конца последнего дня по самому западному городу
+        start_ts = datetime.combine(first, datetime.min.time(), tashkent).timestamp() - SCHEDULER_INTERVAL
+        end_ts = max(
+            datetime.combine(last + timedelta(days=1), datetime.min.time(), main.get_city_tz(city)).timestamp()
+            for city in main.SUPPORTED_CITIES
+        )
+
+        main.set_clock(main.SimulatedClock(start_ts))
+        create_users(main, args.users, args.seed, datetime.fromtimestamp(start_ts, tashkent) - timedelta(days=1))
+        intended = intended_reminders(main, first, last, start_ts, end_ts)
+        ticks = scheduler_ticks(main, first, last, start_ts, end_ts, args.every_minute)
+        bot = FakeBot(main)
+        job_queue = FakeJobQueue(main)
+
+        started = time.perf_counter()
+        asyncio.run(run(main, ticks, end_ts, bot, job_queue))
+        wall = time.perf_counter() - started
+
+        main.event_log.flush()
+        report(main, intended, bot, ticks, first, last, start_ts, end_ts, wall, args)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,9 @@
+"""Общая настройка тестов: main импортируется с пустым временным DATA_DIR"""
+import os
+import sys
+import tempfile
+
+# main читает окружение и данные при импорте — настраиваем до него
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="ramadan-bot-tests-")
+os.environ.setdefault("LOG_FORMAT", "text")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,92 @@
+"""Битовые карты активности: когорты и retention"""
+import marshal
+
+import pytest
+
+import main
+
+DAY = 740000
+TS = (DAY - main.EPOCH_ORDINAL) * 86400 + 12 * 3600
+
+
+def ts(day):
+    return TS + (day - DAY) * 86400
+
+
+@pytest.fixture
+def bitmaps(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ACTIVITY_INDEX_FILE", str(tmp_path / "ordinals.snap"))
+    # touch() только планирует запись — в тестах пишем явно через persist()
+    monkeypatch.setattr(main.ActivityBitmaps, "save", lambda self: None)
+    return main.ActivityBitmaps(str(tmp_path))
+
+
+def persist(bitmaps):
+    bitmaps.write(bitmaps.snapshot())
+
+
+def test_cohort_holds_only_new_users(bitmaps):
+    bitmaps.touch("1", ts(DAY), new=True)
+    bitmaps.touch("2", ts(DAY), new=True)
+    # Восстановленный из архива получает ordinal после новичков, но не входит в их когорту
+    bitmaps.touch("3", ts(DAY))
+    bitmaps.touch("4", ts(DAY + 1), new=True)
+    
+    assert bitmaps.cohort(DAY).bit_count() == 2
+    assert not bitmaps.cohort(DAY) & (1 << bitmaps.ordinals["3"])
+    assert bitmaps.cohort(DAY + 1) == 1 << bitmaps.ordinals["4"]
+    assert bitmaps.active(DAY) == 3
+    assert bitmaps.active(DAY + 1, window=2) == 4
+
+
+def test_retention(bitmaps):
+    for uid in "123":
+        bitmaps.touch(uid, ts(DAY), new=True)
+    bitmaps.touch("9", ts(DAY))
+    bitmaps.touch("1", ts(DAY + 1))
+    bitmaps.touch("9", ts(DAY + 1))
+    bitmaps.touch("2", ts(DAY + 7))
+    
+    assert bitmaps.retention(DAY + 1, 1) == (3, 1)
+    assert bitmaps.retention(DAY + 7, 7) == (3, 1)
+    # День 30 для когорты ещё не наступил
+    assert bitmaps.retention(DAY + 7, 30) == (0, 0)
+
+
+def test_reload_from_disk(bitmaps, tmp_path):
+    bitmaps.touch("1", ts(DAY), new=True)
+    bitmaps.touch("2", ts(DAY + 1))
+    persist(bitmaps)
+    
+    loaded = main.ActivityBitmaps(str(tmp_path))
+    assert loaded.load()
+    assert loaded.ordinals == {"1": 0, "2": 1}
+    assert loaded.cohort(DAY) == 1
+    assert loaded.cohort(DAY + 1) == 0
+    assert loaded.active(DAY + 1) == 1
+
+
+def test_legacy_index_rebuilds_cohorts(bitmaps, tmp_path):
+    # Старый формат: id по ordinal'ам и начала когорт-диапазонов
+    main.write_snapshot(main.ACTIVITY_INDEX_FILE, [marshal.dumps([1, 2, 3]), marshal.dumps({DAY: 0})])
+    assert bitmaps.load() and bitmaps.legacy_cohorts
+    
+    bitmaps.rebuild_cohorts({
+        "1": main.UserRecord(joined=main.ts_to_str(ts(DAY))),
+        "2": main.UserRecord(joined=main.ts_to_str(ts(DAY - 5))),
+        "3": main.UserRecord(),
+    })
+    assert bitmaps.cohort(DAY) == 1
+    assert bitmaps.cohort(DAY - 5) == 2
+    persist(bitmaps)
+    assert len(main.read_snapshot(main.ACTIVITY_INDEX_FILE)) == 1
+
+
+def test_bootstrap_uses_join_days(bitmaps):
+    bitmaps.bootstrap({
+        "5": main.UserRecord(joined=main.ts_to_str(ts(DAY + 1)), last_active=main.ts_to_str(ts(DAY + 3))),
+        "6": main.UserRecord(joined=main.ts_to_str(ts(DAY))),
+    })
+    assert bitmaps.uids == [6, 5]
+    assert bitmaps.cohort(DAY) == 1 and bitmaps.cohort(DAY + 1) == 2
+    assert bitmaps.active(DAY + 3) == 1
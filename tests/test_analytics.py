@@ -0,0 +1,44 @@
+"""Столбцы аналитики из строк снапшота"""
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import analytics
+import main
+
+
+def make_users():
+    return {
+        "1": main.UserRecord({"lang": "uz", "city": "tashkent", "remind_min": 10,
+                              "joined": "2026-02-18 12:00:00"}),
+        "2": main.UserRecord({"lang": "ru", "city": "bremen", "remind_min": 5,
+                              "joined": "2026-02-20 23:00:00", "last_active": "2026-03-01 08:00:00",
+                              "is_blocked": True, "blocked_date": "2026-03-02 10:00:00"}),
+        "3": main.UserRecord(),
+    }
+
+
+def day(text):
+    return main.ts_to_int(text) // 86400
+
+
+def test_columns_from_snapshot_rows():
+    columns = analytics.load_columns(main.users_rows(make_users()), main.ROW_LAYOUT)
+    assert columns.size == 3
+    assert columns.joined.tolist() == [day("2026-02-18 00:00:00"), day("2026-02-20 00:00:00"), analytics.MISSING]
+    assert columns.blocked.tolist() == [False, True, False]
+    assert columns.blocked_day.tolist() == [analytics.MISSING, day("2026-03-02 00:00:00"), analytics.MISSING]
+    assert columns.remind.tolist() == [10, 5, analytics.MISSING]
+    assert [columns.cities[code] for code in columns.city] == ["tashkent", "bremen", None]
+    assert [columns.langs[code] for code in columns.lang] == ["uz", "ru", None]
+
+
+def test_empty_snapshot():
+    assert analytics.load_columns(main.users_rows({}), main.ROW_LAYOUT).size == 0
+
+
+def test_report_shows_bitmap_retention():
+    columns = analytics.load_columns(main.users_rows(make_users()), main.ROW_LAYOUT)
+    text = analytics.report(columns, day("2026-03-10 00:00:00"), retention=[(1, 4, 1), (7, 0, 0)])
+    assert "День 1: 25% (1/4)" in text
+    assert "День 7: — (0/0)" in text
@@ -0,0 +1,88 @@
+"""Архивация заблокировавших и восстановление из архива"""
+import asyncio
+
+import pytest
+
+import main
+
+LONG_AGO = "2020-01-01 00:00:00"
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ARCHIVE_FILE", str(tmp_path / "archive.snap"))
+    monkeypatch.setattr(main, "_archive_rows", None)
+    monkeypatch.setattr(main, "SAVE_COALESCE_DELAY", 0)
+    main.users.clear()
+    main.archived_uids.clear()
+    main.audience.rebuild(main.users)
+    main.users.update({
+        "1": main.UserRecord({"lang": "uz", "city": "tashkent", "remind_min": 10,
+                              "is_blocked": True, "blocked_date": LONG_AGO, "note": {"a": 1}}),
+        "2": main.UserRecord({"lang": "ru", "city": "bremen", "remind_min": 5,
+                              "joined": LONG_AGO, "last_active": LONG_AGO}),
+        "3": main.UserRecord({"lang": "uz", "city": "tashkent", "is_blocked": True,
+                              "blocked_date": main.clock.now().strftime(main.TS_FORMAT)}),
+    })
+    main.audience.rebuild(main.users)
+    yield
+    main.users.clear()
+    main.archived_uids.clear()
+    main.audience.rebuild(main.users)
+
+
+def run(coro_factory):
+    async def scenario():
+        try:
+            return await coro_factory()
+        finally:
+            await main.flush_saves()
+    return asyncio.run(scenario())
+
+
+def test_only_long_blocked_users_are_archived(archive):
+    assert run(main.archive_users) == 1
+    assert main.archived_uids == {"1"}
+    # Давно неактивный, но не заблокировавший продолжает получать напоминания
+    assert set(main.users) == {"2", "3"}
+    assert "1" not in main.audience.all
+
+
+def test_restore_round_trip(archive):
+    expected = main.users["1"].to_dict()
+    run(main.archive_users)
+    
+    assert run(lambda: main.restore_archived_user(1))
+    assert main.users["1"].to_dict() == expected
+    assert "1" not in main.archived_uids and "1" in main.audience.all
+    assert not run(lambda: main.restore_archived_user(1))
+
+
+def test_restore_failure_keeps_user_archived(archive, monkeypatch):
+    run(main.archive_users)
+    
+    def broken(uid):
+        raise OSError("диск недоступен")
+    
+    with monkeypatch.context() as patch:
+        patch.setattr(main, "load_archived_user", broken)
+        assert not run(lambda: main.restore_archived_user(1))
+    assert "1" in main.archived_uids and "1" not in main.users
+    # Следующая попытка удаётся
+    assert run(lambda: main.restore_archived_user(1))
+
+
+def test_unreadable_archive_is_an_error(archive):
+    run(main.archive_users)
+    with open(main.ARCHIVE_FILE, "wb") as f:
+        f.write(b"broken")
+    main._archive_rows = None
+    with pytest.raises(OSError):
+        main.load_archived_user("1")
+
+
+def test_failed_write_rolls_back(archive, monkeypatch):
+    monkeypatch.setattr(main, "write_archive", lambda moved, hot: False)
+    assert run(main.archive_users) == 0
+    assert "1" in main.users and not main.archived_uids
+    assert "1" in main.audience.all
@@ -0,0 +1,83 @@
+"""Индексы аудитории рассылок"""
+import itertools
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import main
+
+NOW = datetime(2026, 3, 10, 12, 0, tzinfo=ZoneInfo("Asia/Tashkent"))
+
+
+def make_users():
+    users = {}
+    for i in range(60):
+        user = main.UserRecord({
+            "lang": ("uz", "ru")[i % 2],
+            "city": ("tashkent", "bremen", "samarkand")[i % 3],
+            "remind_min": (5, 10, 15, 20)[i % 4],
+        })
+        user.last_active = main.ts_to_int(NOW.strftime(main.TS_FORMAT)) - (i % 10) * 86400
+        if i % 5 == 0:
+            user["is_blocked"] = True
+        users[str(1000 + i)] = user
+    return users
+
+
+def expected(users, segment):
+    today = main.ts_to_int(NOW.strftime(main.TS_FORMAT)) // 86400
+    result = set()
+    for uid, user in users.items():
+        if segment["city"] and user.city != segment["city"]:
+            continue
+        if segment["lang"] and user.lang != segment["lang"]:
+            continue
+        if segment["remind"] and user.remind_min != segment["remind"]:
+            continue
+        if segment["active_days"] and today - user.last_active // 86400 >= segment["active_days"]:
+            continue
+        if user.is_blocked and not segment["include_blocked"]:
+            continue
+        result.add(uid)
+    return result
+
+
+@pytest.fixture
+def index(monkeypatch):
+    monkeypatch.setattr(main, "clock", main.SimulatedClock(NOW.timestamp()))
+    users = make_users()
+    audience = main.AudienceIndex()
+    audience.rebuild(users)
+    return audience, users
+
+
+def test_segment_counts_match_full_scan(index):
+    audience, users = index
+    for city, lang, remind, active_days, include_blocked in itertools.product(
+        (None, "bremen"), (None, "ru"), (None, 10), (None, 1, 7), (False, True)
+    ):
+        segment = {"city": city, "lang": lang, "remind": remind,
+                   "active_days": active_days, "include_blocked": include_blocked}
+        assert audience.select(segment) == expected(users, segment), segment
+    assert len(audience.select(main.default_broadcast_segment())) == 48
+
+
+def test_changed_and_removed_users_are_reindexed(index):
+    audience, users = index
+    user = users["1001"]
+    user["city"] = "bremen"
+    user["is_blocked"] = True
+    audience.add("1001", user)
+    assert "1001" not in audience.by_city["tashkent"]
+    assert "1001" in audience.by_city["bremen"]
+    assert "1001" in audience.blocked
+    
+    audience.remove("1002")
+    assert "1002" not in audience.all
+    segment = dict(main.default_broadcast_segment(), include_blocked=True)
+    assert "1002" not in audience.select(segment)
+    # Пустые корзины удаляются, а не копятся
+    for uid in [uid for uid, u in users.items() if u.remind_min == 20]:
+        audience.remove(uid)
+    assert 20 not in audience.by_remind
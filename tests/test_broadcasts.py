@@ -0,0 +1,49 @@
+"""Идентификаторы рассылок и квитанции"""
+from array import array
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import main
+
+NOW = datetime(2026, 3, 10, 12, 0, 5, tzinfo=ZoneInfo("Asia/Tashkent"))
+
+
+@pytest.fixture
+def broadcasts(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "BROADCASTS_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "ISSUED_BROADCAST_IDS", set())
+    monkeypatch.setattr(main, "clock", main.SimulatedClock(NOW.timestamp()))
+    return tmp_path
+
+
+def test_ids_in_one_second_are_unique(broadcasts):
+    assert main.new_broadcast_id() == "20260310_120005"
+    # Метаданные первой ещё не записаны — повтор всё равно получает суффикс
+    assert main.new_broadcast_id() == "20260310_120005_2"
+    main.save_broadcast_meta({"id": "20260310_120005_3", "langs": {}})
+    main.ISSUED_BROADCAST_IDS.clear()
+    assert main.new_broadcast_id() == "20260310_120005"
+    assert main.new_broadcast_id() == "20260310_120005_2"
+    assert main.new_broadcast_id() == "20260310_120005_4"
+
+
+def test_receipts_round_trip_per_language(broadcasts):
+    broadcast_id = main.new_broadcast_id()
+    main.append_broadcast_receipts(broadcast_id, "uz", array("q", [1, 10, 2, 20]))
+    main.append_broadcast_receipts(broadcast_id, "uz", array("q", [3, 30]))
+    main.append_broadcast_receipts(broadcast_id, None, array("q", [4, 40]))
+    main.append_broadcast_receipts(broadcast_id, "ru", array("q"))
+    
+    assert main.load_broadcast_receipts(broadcast_id, "uz").tolist() == [1, 10, 2, 20, 3, 30]
+    assert main.load_broadcast_receipts(broadcast_id, main.receipt_lang_key(None)).tolist() == [4, 40]
+    assert len(main.load_broadcast_receipts(broadcast_id, "ru")) == 0
+    assert not (broadcasts / f"{broadcast_id}.ru.rcpt").exists()
+
+
+def test_list_broadcasts_newest_first(broadcasts):
+    for broadcast_id in ("20260301_100000", "20260310_090000", "20260305_100000"):
+        main.save_broadcast_meta({"id": broadcast_id, "langs": {}})
+    (broadcasts / "20260311_000000.json").write_text("{broken")
+    assert [meta["id"] for meta in main.list_broadcasts(limit=3)] == ["20260310_090000", "20260305_100000"]
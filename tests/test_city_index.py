@@ -0,0 +1,54 @@
+"""Поиск ближайшего города по k-d дереву"""
+import math
+import random
+
+import main
+
+CITIES = [
+    ("tashkent", 41.2995, 69.2401),
+    ("bremen", 53.0793, 8.8017),
+    ("samarkand", 39.6542, 66.9597),
+    ("anadyr", 64.7337, 177.5089),
+    ("apia", -13.8333, -171.7667),
+    ("ushuaia", -54.8019, -68.3030),
+    ("longyearbyen", 78.2232, 15.6267),
+]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * main.EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def brute_force(lat, lon):
+    return min((haversine(lat, lon, c_lat, c_lon), city) for city, c_lat, c_lon in CITIES)
+
+
+def test_nearest_matches_brute_force():
+    index = main.CityIndex(CITIES)
+    assert len(index) == len(CITIES)
+    rng = random.Random(1)
+    for _ in range(2000):
+        lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        distance, city = brute_force(lat, lon)
+        found, found_distance = index.nearest(lat, lon)
+        assert found == city
+        assert math.isclose(found_distance, distance, rel_tol=1e-6, abs_tol=1e-6)
+
+
+def test_nearest_across_antimeridian():
+    index = main.CityIndex(CITIES)
+    # Точка по другую сторону 180° от Анадыря
+    city, distance = index.nearest(65.0, -179.0)
+    assert city == "anadyr"
+    assert distance < 300
+
+
+def test_empty_index():
+    assert main.CityIndex([]).nearest(41.3, 69.2) == (None, None)
+
+
+def test_supported_cities_have_coordinates():
+    assert len(main.city_index) == len(main.SUPPORTED_CITIES)
+    assert main.city_index.nearest(41.31, 69.28)[0] == "tashkent"
@@ -0,0 +1,82 @@
+"""Дневные агрегаты: активные из карт активности, без выдуманных метрик"""
+import asyncio
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import main
+
+TODAY = date(2026, 3, 10).toordinal()
+
+
+def ts(day, hour=12):
+    return (day - main.EPOCH_ORDINAL) * 86400 + hour * 3600
+
+
+@pytest.fixture
+def stats(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ACTIVITY_INDEX_FILE", str(tmp_path / "ordinals.snap"))
+    monkeypatch.setattr(main.ActivityBitmaps, "save", lambda self: None)
+    bitmaps = main.ActivityBitmaps(str(tmp_path))
+    monkeypatch.setattr(main, "activity", bitmaps)
+    now = datetime.fromordinal(TODAY).replace(hour=12, tzinfo=ZoneInfo("Asia/Tashkent"))
+    monkeypatch.setattr(main, "clock", main.SimulatedClock(now.timestamp()))
+    monkeypatch.setattr(main, "notification_tracker", {})
+    main.users.clear()
+    main.archived_uids.clear()
+    main.users.update({
+        "1": main.UserRecord({"lang": "uz", "city": "tashkent"}),
+        "2": main.UserRecord({"lang": "ru", "city": "bremen"}),
+    })
+    main.users["1"].joined = ts(TODAY - 3)
+    main.users["1"].last_active = ts(TODAY - 1)
+    main.users["2"].joined = ts(TODAY - 3)
+    main.users["2"].last_active = ts(TODAY - 2)
+    yield bitmaps
+    main.users.clear()
+
+
+def test_active_counts_come_from_bitmaps(stats):
+    # Пользователь 1 был активен три дня подряд, хотя last_active помнит только последний
+    for day in (TODAY - 3, TODAY - 2, TODAY - 1):
+        stats.touch("1", ts(day), new=day == TODAY - 3)
+    stats.touch("2", ts(TODAY - 3), new=True)
+    # Вторая карта — только на диске
+    stats.touch("2", ts(TODAY - 2))
+    stats.write(stats.snapshot())
+    del stats.days[(main.ACTIVITY_SUFFIX, TODAY - 2)]
+    
+    first, last = TODAY - 3, TODAY - 1
+    asyncio.run(main.preload_activity(range(first, last + 1)))
+    rows = main.compute_daily_stats(first, last)
+    assert [row["active"] for row in rows] == [
+        {"tashkent/uz": 1, "bremen/ru": 1},
+        {"tashkent/uz": 1, "bremen/ru": 1},
+        {"tashkent/uz": 1},
+    ]
+    assert rows[0]["new"] == {"tashkent/uz": 1, "bremen/ru": 1}
+
+
+def test_unrecorded_metrics_are_not_backfilled(stats):
+    stats.touch("1", ts(TODAY - 1))
+    main.notification_tracker[f"1_iftar_{date.fromordinal(TODAY - 1)}"] = True
+    
+    first, last = TODAY - 4, TODAY - 1
+    asyncio.run(main.preload_activity(range(first, last + 1)))
+    rows = main.compute_daily_stats(first, last)
+    # Карт активности за старые дни нет, трекер помнит только вчера
+    assert ["active" in row for row in rows] == [False, False, False, True]
+    assert ["reminders" in row for row in rows] == [False, False, False, True]
+    assert rows[-1]["reminders"] == {"tashkent/uz": 1}
+    assert all("new" in row and "blocked" in row for row in rows)
+
+
+def test_sparkline_leaves_gaps_for_missing_days(monkeypatch):
+    monkeypatch.setattr(main, "daily_stats", [
+        {"date": "2026-03-01", "total": 2, "new": {"a": 1}},
+        {"date": "2026-03-02", "total": 2, "new": {"a": 2}, "active": {"a": 2}},
+    ])
+    assert main.metric_series("active", 2) == [None, 2]
+    assert main.sparkline(main.metric_series("active", 2)) == " █"
+    assert main.series_total(main.metric_series("new", 2)) == 3
@@ -0,0 +1,77 @@
+"""Выгрузка пользователей: активные и архивные"""
+import asyncio
+import csv
+import io
+
+import pytest
+
+import main
+
+LONG_AGO = "2020-01-01 00:00:00"
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_document(self, chat_id, document, filename, caption):
+        self.sent.append((document, caption))
+
+
+class FakeMessage:
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+
+
+@pytest.fixture
+def export(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ARCHIVE_FILE", str(tmp_path / "archive.snap"))
+    monkeypatch.setattr(main, "_archive_rows", None)
+    monkeypatch.setattr(main, "SAVE_COALESCE_DELAY", 0)
+    main.users.clear()
+    main.archived_uids.clear()
+    main.users.update({
+        "1": main.UserRecord({"lang": "uz", "city": "tashkent"}),
+        "2": main.UserRecord({"lang": "ru", "city": "bremen", "is_blocked": True,
+                              "blocked_date": LONG_AGO}),
+        "3": main.UserRecord({"lang": "uz", "city": "bremen", "is_blocked": True,
+                              "blocked_date": LONG_AGO}),
+    })
+    main.audience.rebuild(main.users)
+
+    async def archive():
+        await main.archive_users()
+        await main.flush_saves()
+
+    asyncio.run(archive())
+    assert main.archived_uids == {"2", "3"}
+    yield
+    main.users.clear()
+    main.archived_uids.clear()
+    main.audience.rebuild(main.users)
+
+
+def run_export(filters_):
+    bot = FakeBot()
+    context = type("Context", (), {"bot": bot})()
+
+    async def scenario():
+        await main.run_users_export(context, 1, FakeMessage(), "csv", filters_)
+        await main.flush_saves()
+
+    asyncio.run(scenario())
+    document, caption = bot.sent[0]
+    rows = list(csv.DictReader(io.StringIO(document.decode("utf-8"))))
+    return [row["uid"] for row in rows], caption
+
+
+def test_export_includes_archived_users(export):
+    uids, caption = run_export({})
+    assert uids == ["1", "2", "3"]
+    assert "3 записей, из них из архива 2" in caption
+
+
+def test_archived_users_follow_filters(export):
+    assert run_export({"city": "bremen", "lang": "ru"})[0] == ["2"]
+    assert run_export({"status": "active"})[0] == ["1"]
+    assert run_export({"status": "blocked"})[0] == ["2", "3"]
@@ -0,0 +1,79 @@
+"""Планировщик исходящих запросов: веса полос и повторы RetryAfter"""
+import asyncio
+from collections import Counter
+
+import pytest
+from telegram.error import RetryAfter
+
+import main
+
+
+def picks(scheduler, lanes, count):
+    """Какие полосы выберет планировщик за count шагов при непустых очередях lanes"""
+    for lane in lanes:
+        scheduler.queues[lane].append(object())
+    return Counter(scheduler._pick_lane() for _ in range(count))
+
+
+def test_lanes_share_rate_by_weight():
+    scheduler = main.OutboundScheduler(1000, main.LANE_WEIGHTS)
+    assert picks(scheduler, ("interactive", "reminder"), 90) == {"interactive": 60, "reminder": 30}
+
+
+def test_broadcast_gets_its_weight_without_reminders():
+    scheduler = main.OutboundScheduler(1000, main.LANE_WEIGHTS)
+    assert picks(scheduler, ("interactive", "broadcast"), 70) == {"interactive": 60, "broadcast": 10}
+
+
+def test_broadcast_yields_to_reminders():
+    scheduler = main.OutboundScheduler(1000, main.LANE_WEIGHTS)
+    assert picks(scheduler, ("reminder", "broadcast"), 20) == {"reminder": 20}
+    scheduler.queues["reminder"].clear()
+    assert scheduler._pick_lane() == "broadcast"
+
+
+def limited_call(failures):
+    """Запрос через LaneRateLimiter, который failures раз получает RetryAfter"""
+    calls = []
+
+    async def callback():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise RetryAfter(0)
+        return "ok"
+
+    async def scenario():
+        scheduler = main.OutboundScheduler(1000, main.LANE_WEIGHTS)
+        limiter = main.LaneRateLimiter(scheduler, "reminder")
+        try:
+            return await limiter.process_request(callback, (), {}, "sendMessage", {}, None)
+        finally:
+            await scheduler.stop()
+
+    return calls, scenario
+
+
+def test_limiter_retries_retry_after():
+    calls, scenario = limited_call(main.OUTBOUND_MAX_RETRIES - 1)
+    assert asyncio.run(scenario()) == "ok"
+    assert len(calls) == main.OUTBOUND_MAX_RETRIES
+
+
+def test_limiter_gives_up_after_max_retries():
+    calls, scenario = limited_call(main.OUTBOUND_MAX_RETRIES)
+    with pytest.raises(RetryAfter):
+        asyncio.run(scenario())
+    assert len(calls) == main.OUTBOUND_MAX_RETRIES
+
+
+def test_reminder_is_not_retried_again_by_caller():
+    class Bot:
+        calls = 0
+
+        async def send_message(self, **kwargs):
+            Bot.calls += 1
+            raise RetryAfter(0)
+
+    sent = asyncio.run(main._send_notification(Bot(), 1, "1", "text", "iftar", "2026-03-01"))
+    assert sent is False
+    assert Bot.calls == 1
@@ -0,0 +1,149 @@
+"""Снапшоты и отложенная запись"""
+import asyncio
+import sys
+
+import pytest
+
+import main
+
+
+def make_users():
+    return {
+        "1": main.UserRecord({
+            "lang": "uz", "city": "tashkent", "remind_min": 10,
+            "first_name": "Ali", "username": None,
+            "joined": "2026-02-18 12:00:00", "last_active": "2026-03-01 08:30:00",
+            "push_sent": False, "suhoor_congrats_sent_2026-02-19": True,
+        }),
+        "2": main.UserRecord({
+            "lang": "ru", "city": "bremen", "remind_min": 5, "first_name": "Мария",
+            "is_blocked": True, "blocked_date": "2026-03-02 10:00:00", "note": "x",
+        }),
+        "3": main.UserRecord(),
+    }
+
+
+def test_snapshot_round_trip(tmp_path):
+    users = make_users()
+    path = str(tmp_path / "users.snap")
+    assert main.write_snapshot(path, main.encode_users_snapshot(users))
+    
+    restored = main.decode_users_snapshot(main.read_snapshot(path))
+    assert {uid: user.to_dict() for uid, user in restored.items()} == {
+        uid: user.to_dict() for uid, user in users.items()
+    }
+    # Строки lang/city интернируются при чтении
+    assert restored["1"].city is sys.intern("tashkent")
+
+
+def test_compressed_snapshot_round_trip(tmp_path):
+    users = make_users()
+    path = str(tmp_path / "archive.snap")
+    assert main.write_snapshot(path, main.encode_users_snapshot(users), compress=True)
+    assert main.read_snapshot(path) is None
+    
+    restored = main.decode_users_snapshot(main.read_snapshot(path, compressed=True))
+    assert restored["2"].to_dict() == users["2"].to_dict()
+
+
+def test_damaged_snapshot_is_rejected(tmp_path):
+    path = str(tmp_path / "users.snap")
+    main.write_snapshot(path, main.encode_users_snapshot(make_users()))
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 10)
+    assert main.read_snapshot(path) is None
+    assert not (tmp_path / "users.snap.tmp").exists()
+
+
+def test_snapshot_older_than_json_is_ignored(tmp_path):
+    path = str(tmp_path / "users.snap")
+    json_path = tmp_path / "users.json"
+    main.write_snapshot(path, main.encode_users_snapshot(make_users()))
+    json_path.write_text("{}")
+    main.os.utime(path, (0, 0))
+    assert main.read_snapshot(path, newer_than=str(json_path)) is None
+
+
+def test_schedule_save_coalesces(monkeypatch):
+    monkeypatch.setattr(main, "SAVE_COALESCE_DELAY", 0.05)
+    written = []
+    
+    async def scenario():
+        for i in range(5):
+            main.schedule_save("test", lambda i=i: i, written.append)
+        assert written == []
+        await asyncio.sleep(0.2)
+        await main.flush_saves()
+    
+    asyncio.run(scenario())
+    # Пять вызовов — одна запись, со снимком последнего
+    assert written == [4]
+    # Завершённая запись не держится до следующего flush_saves (и другого цикла событий)
+    assert "test" not in main._save_futures
+
+
+def test_flush_saves_writes_pending_immediately(monkeypatch):
+    monkeypatch.setattr(main, "SAVE_COALESCE_DELAY", 60)
+    written = []
+    
+    async def scenario():
+        main.schedule_save("test", lambda: "first", written.append)
+        main.schedule_save("test", lambda: "second", written.append)
+        await main.flush_saves()
+        assert not main._save_pending
+    
+    asyncio.run(scenario())
+    assert written == ["second"]
+
+
+def test_schedule_save_outside_loop_writes_now():
+    written = []
+    main.schedule_save("test", lambda: "now", written.append)
+    assert written == ["now"]
+
+
+def test_chunked_snapshot_matches_full_and_skips_removed(monkeypatch):
+    monkeypatch.setattr(main, "USERS_SNAPSHOT_CHUNK", 1)
+    users = make_users()
+    assert asyncio.run(main.users_rows_chunked(users)) == main.users_rows(users)
+    
+    async def scenario():
+        task = asyncio.ensure_future(main.users_rows_chunked(users))
+        await asyncio.sleep(0)
+        # Пользователь ушёл в архив между пачками
+        del users["3"]
+        return await task
+    
+    strings, uids, rows = asyncio.run(scenario())
+    assert uids == [1, 2]
+
+
+def test_saves_of_one_name_are_written_in_order(monkeypatch):
+    monkeypatch.setattr(main, "SAVE_COALESCE_DELAY", 0)
+    written = []
+    
+    async def scenario():
+        released = asyncio.Event()
+        
+        async def slow_snapshot():
+            await released.wait()
+            return "old"
+        
+        main.schedule_save("test", slow_snapshot, written.append)
+        await asyncio.sleep(0.01)
+        # Первый снимок ещё не готов, а второе сохранение уже запущено
+        main.schedule_save("test", lambda: "new", written.append)
+        await asyncio.sleep(0.01)
+        assert written == []
+        released.set()
+        await main.flush_saves()
+    
+    asyncio.run(scenario())
+    assert written == ["old", "new"]
+
+
+def test_snapshot_with_other_row_layout_is_rejected(tmp_path):
+    path = str(tmp_path / "users.snap")
+    main.write_snapshot(path, [main.marshal.dumps(s) for s in (("uz",), [1], [(0,) * 14])])
+    with pytest.raises(ValueError):
+        main.decode_users_snapshot(main.read_snapshot(path))
@@ -0,0 +1,82 @@
+"""План напоминаний: запись, чтение и догон после перезапуска"""
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import main
+
+TZ = ZoneInfo("Asia/Tashkent")
+NOW = datetime(2026, 3, 1, 12, 0, tzinfo=TZ).timestamp()
+TODAY = "2026-03-01"
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, name, **kwargs):
+        self.jobs.append(name)
+
+
+@pytest.fixture
+def plan(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "SCHEDULE_FILE", str(tmp_path / "schedule.snap"))
+    monkeypatch.setattr(main, "clock", main.SimulatedClock(NOW))
+    monkeypatch.setattr(main, "notification_tracker", {})
+    monkeypatch.setattr(main, "pending_reminders", {})
+    main.users.clear()
+    main.users.update({
+        "1": main.UserRecord({"city": "tashkent", "remind_min": 10}),
+        "2": main.UserRecord({"city": "tashkent", "is_blocked": True}),
+        "3": main.UserRecord({"city": "bremen", "remind_min": 10}),
+    })
+    yield
+    main.users.clear()
+
+
+def entry(uid, event, remind_offset, event_offset, date_str=TODAY):
+    return (uid, event, date_str, int(NOW + remind_offset), int(NOW + event_offset), 10)
+
+
+def test_plan_round_trip(plan):
+    entries = [
+        entry("1", "suhoor", 60, 660),
+        entry("1", "iftar", -60, 540, "2026-02-28"),
+        entry("2", "iftar", 3600, 4200),
+    ]
+    main.write_reminder_plan(entries)
+    assert main.load_reminder_plan() == entries
+
+
+def test_missing_or_damaged_plan_is_empty(plan):
+    assert main.load_reminder_plan() == []
+    with open(main.SCHEDULE_FILE, "wb") as f:
+        f.write(b"garbage")
+    assert main.load_reminder_plan() == []
+
+
+@pytest.mark.parametrize("mode, expected", [
+    ("skip", ["future"]),
+    ("before", ["future", "event_ahead"]),
+    ("all", ["future", "event_ahead", "event_passed"]),
+])
+def test_restore_catches_up_by_mode(plan, monkeypatch, mode, expected):
+    monkeypatch.setattr(main, "REMINDER_CATCHUP", mode)
+    cases = {
+        "future": entry("3", "suhoor", 60, 660),
+        "event_ahead": entry("1", "iftar", -60, 540, TODAY),
+        "event_passed": entry("1", "suhoor", -900, -300, TODAY),
+    }
+    # Уже отправленное и заблокировавший пользователь не восстанавливаются
+    main.notification_tracker["1_suhoor_2026-02-28"] = True
+    skipped = [entry("1", "suhoor", -60, 60, "2026-02-28"), entry("2", "iftar", 60, 660)]
+    main.write_reminder_plan(list(cases.values()) + skipped)
+
+    job_queue = FakeJobQueue()
+    main.restore_reminder_plan(job_queue)
+
+    names = {main.reminder_job_name(*cases[case][:3]): case for case in cases}
+    assert sorted(names[name] for name in job_queue.jobs) == sorted(expected)
+    # Восстановленное снова в плане — планировщик не поставит его повторно
+    assert set(main.pending_reminders) == set(job_queue.jobs)
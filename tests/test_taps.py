@@ -0,0 +1,47 @@
+"""Слияние частых нажатий кнопки отсчёта"""
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+
+def tap(number):
+    return SimpleNamespace(message=SimpleNamespace(message_id=7), data="run_countdown_iftar", number=number)
+
+
+def test_repeated_taps_end_with_one_trailing_edit(monkeypatch):
+    monkeypatch.setattr(main, "COUNTDOWN_DEBOUNCE", 0.05)
+    main.COUNTDOWN_TAPS.clear()
+    rendered = []
+    
+    async def render(q):
+        rendered.append(q.number)
+    
+    async def scenario():
+        handled = [not main.coalesce_tap("1", tap(n), render) for n in range(4)]
+        assert handled == [True, False, False, False]
+        await asyncio.sleep(0.07)
+        # Новое окно открывается отложенной правкой
+        assert main.coalesce_tap("1", tap(4), render)
+        await asyncio.sleep(0.1)
+    
+    asyncio.run(scenario())
+    # Промежуточные нажатия не теряются: последнее состояние доходит до сообщения
+    assert rendered == [3, 4]
+
+
+def test_single_tap_has_no_trailing_edit(monkeypatch):
+    monkeypatch.setattr(main, "COUNTDOWN_DEBOUNCE", 0.05)
+    main.COUNTDOWN_TAPS.clear()
+    rendered = []
+    
+    async def render(q):
+        rendered.append(q.number)
+    
+    async def scenario():
+        assert not main.coalesce_tap("1", tap(0), render)
+        await asyncio.sleep(0.1)
+        assert not main.coalesce_tap("1", tap(1), render)
+    
+    asyncio.run(scenario())
+    assert rendered == []
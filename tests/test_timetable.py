@@ -0,0 +1,145 @@
+"""CityTimetable: поиск сезонов, подмена состояния и предзагрузка"""
+import asyncio
+import json
+from datetime import date, datetime
+
+import pytest
+
+import main
+
+
+def write_season(directory, start, days=3, suhoor="05:00", iftar="18:00"):
+    city_dir = directory / "bremen"
+    city_dir.mkdir(parents=True, exist_ok=True)
+    path = city_dir / f"{start}.json"
+    path.write_text(json.dumps({"start": start, "suhoor": [suhoor] * days, "iftar": [iftar] * days}))
+    return str(path)
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    """Два каталога расписаний (второй главнее) и пустой BASE_DIR"""
+    first, second = tmp_path / "base", tmp_path / "data"
+    monkeypatch.setattr(main, "BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "TIMETABLE_DIRS", (str(first), str(second)))
+    monkeypatch.setattr(main, "TIMES_CACHE", {})
+    return first, second
+
+
+def ordinal(day):
+    return date.fromisoformat(day).toordinal()
+
+
+def load_all(city="bremen"):
+    """Расписание со всеми сезонами, как после refresh_timetables, но без отбора по дате"""
+    timetable = main.CityTimetable(city)
+    timetable.apply(*timetable.scan())
+    for start in timetable.starts:
+        season = timetable.read(start)
+        if season is not None:
+            timetable.add(season)
+    return timetable
+
+
+def test_scan_finds_seasons_without_changing_state(dirs):
+    first, second = dirs
+    timetable = main.CityTimetable("bremen")
+    a = write_season(first, "2026-02-19")
+    b = write_season(second, "2027-02-08")
+    (first / "bremen" / "notes.json").write_text("{}")
+    
+    paths, seasons = timetable.scan()
+    assert paths == {ordinal("2026-02-19"): a, ordinal("2027-02-08"): b}
+    assert seasons == {}
+    assert timetable.starts == [] and timetable.paths == {}
+
+
+def test_scan_reads_legacy_file(dirs, tmp_path):
+    (tmp_path / "times_bremen.json").write_text(json.dumps({
+        "2026-02-19": {"suhoor": "05:39", "iftar": "17:49"},
+        "2026-02-20": {"suhoor": "05:37", "iftar": "17:51"},
+    }))
+    timetable = main.CityTimetable("bremen")
+    paths, seasons = timetable.scan()
+    timetable.apply(paths, seasons)
+    assert timetable.starts == [ordinal("2026-02-19")]
+    assert timetable.get("2026-02-20") == {"suhoor": "05:37", "iftar": "17:51"}
+
+
+def test_apply_drops_only_changed_seasons(dirs):
+    first, second = dirs
+    write_season(first, "2026-02-19")
+    write_season(first, "2027-02-08")
+    timetable = load_all()
+    kept = timetable.loaded[ordinal("2026-02-19")]
+    
+    # Файл во втором каталоге перекрывает сезон 2027 года
+    write_season(second, "2027-02-08", suhoor="04:00")
+    timetable.apply(*timetable.scan())
+    assert timetable.loaded == {ordinal("2026-02-19"): kept}
+    # Выгруженный сезон не читается с диска при обращении
+    assert timetable.get("2027-02-08") is None
+    timetable.add(timetable.read(ordinal("2027-02-08")))
+    assert timetable.get("2027-02-08") == {"suhoor": "04:00", "iftar": "18:00"}
+
+
+def test_get_by_date(dirs):
+    first, _ = dirs
+    write_season(first, "2026-02-19", days=2)
+    timetable = load_all()
+    assert timetable["2026-02-20"] == {"suhoor": "05:00", "iftar": "18:00"}
+    assert "2026-02-21" not in timetable
+    assert timetable.get("2026-02-18", "нет") == "нет"
+    assert timetable.get("не дата") is None
+    with pytest.raises(KeyError):
+        timetable["2026-02-21"]
+
+
+def test_invalid_season_is_not_loaded(dirs):
+    first, _ = dirs
+    write_season(first, "2026-02-19", suhoor="19:00")
+    timetable = load_all()
+    assert timetable.starts == [ordinal("2026-02-19")]
+    assert timetable.read(ordinal("2026-02-19")) is None
+    assert timetable.get("2026-02-19") is None
+
+
+def test_get_does_not_touch_disk(dirs, monkeypatch):
+    first, _ = dirs
+    write_season(first, "2026-02-19")
+    timetable = main.get_city_times("bremen")
+    assert timetable.starts == [] and timetable.get("2026-02-19") is None
+    
+    timetable.apply(*timetable.scan())
+    monkeypatch.setattr(main, "open", lambda *args, **kwargs: pytest.fail("чтение с диска в get()"), raising=False)
+    assert timetable.get("2026-02-19") is None
+
+
+def run_refresh(now):
+    previous = main.clock
+    main.set_clock(main.SimulatedClock(datetime(*now, tzinfo=main.get_city_tz("bremen")).timestamp()))
+    try:
+        return asyncio.run(main.refresh_timetables())
+    finally:
+        main.set_clock(previous)
+
+
+def test_refresh_preloads_next_season(dirs):
+    first, _ = dirs
+    write_season(first, "2026-02-19")
+    write_season(first, "2027-02-08")
+    timetable = main.get_city_times("bremen")
+    
+    assert run_refresh((2027, 1, 20, 12)) == []
+    assert ordinal("2027-02-08") in timetable.loaded
+    # Новый файл подхватывается при следующем обновлении
+    write_season(first, "2028-01-28")
+    run_refresh((2027, 12, 20, 12))
+    assert ordinal("2028-01-28") in timetable.loaded
+
+
+def test_refresh_reports_broken_next_season(dirs):
+    first, _ = dirs
+    write_season(first, "2027-02-08", suhoor="19:00")
+    problems = run_refresh((2027, 1, 20, 12))
+    assert len(problems) == 1 and "2027-02-08" in problems[0]
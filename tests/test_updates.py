@@ -0,0 +1,35 @@
+"""Порядок обработки апдейтов внутри чата"""
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+import main
+
+
+def chat_update(update_id, chat_id):
+    message = Message(update_id, datetime.now(), Chat(chat_id, Chat.PRIVATE))
+    return Update(update_id, message=message)
+
+
+def test_updates_of_one_chat_run_in_order_across_chats_in_parallel():
+    processor = main.PerChatUpdateProcessor(8)
+    log = []
+
+    async def handle(name, delay):
+        log.append(f"{name}+")
+        await asyncio.sleep(delay)
+        log.append(f"{name}-")
+
+    async def scenario():
+        await asyncio.gather(
+            processor.process_update(chat_update(1, 1), handle("a1", 0.02)),
+            processor.process_update(chat_update(2, 1), handle("a2", 0)),
+            processor.process_update(chat_update(3, 2), handle("b1", 0)),
+        )
+
+    asyncio.run(scenario())
+    # Второй апдейт чата 1 ждёт первого, чат 2 его не ждёт
+    assert log.index("a2+") > log.index("a1-")
+    assert log.index("b1-") < log.index("a1-")
+    assert not processor._chat_locks
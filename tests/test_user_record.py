@@ -0,0 +1,116 @@
+"""UserRecord: преобразование в dict и обратно, явные None, старые строки снапшота"""
+import pytest
+
+import main
+
+FULL = {
+    "lang": "ru", "city": "bremen", "remind_min": 15,
+    "first_name": "Мария", "username": "maria",
+    "joined": "2026-02-18 12:00:00", "last_active": "2026-03-01 08:30:00",
+    "push_sent": True, "is_blocked": True,
+    "blocked_date": "2026-03-02 10:00:00", "unblocked_date": "2026-03-03 11:00:00",
+    "suhoor_congrats_sent_2026-02-19": True, "iftar_congrats_sent_2026-02-20": True,
+    "custom": [1, 2],
+}
+
+
+def row_round_trip(record):
+    strings = []
+    row = record.to_row(lambda value: strings.append(value) or len(strings) - 1)
+    return main.UserRecord.from_row(row, strings)
+
+
+def test_dict_round_trip():
+    record = main.UserRecord(FULL)
+    assert record.to_dict() == FULL
+    assert row_round_trip(record).to_dict() == FULL
+
+
+def test_absent_fields_behave_like_missing_keys():
+    record = main.UserRecord({"lang": "uz"})
+    assert "city" not in record
+    assert record.get("city", "tashkent") == "tashkent"
+    with pytest.raises(KeyError):
+        record["joined"]
+    assert record.to_dict() == {"lang": "uz"}
+
+
+def test_aware_timestamp_is_converted_to_tashkent():
+    assert main.ts_to_int("2026-02-18T07:00:00+00:00") == main.ts_to_int("2026-02-18 12:00:00")
+    record = main.UserRecord({"last_active": "2026-02-18T08:00:00+01:00"})
+    assert record["last_active"] == "2026-02-18 12:00:00"
+
+
+def test_out_of_range_timestamp_is_dropped():
+    assert main.ts_to_int("1969-12-31 23:59:59") is None
+    assert main.ts_to_int("2107-01-01 00:00:00") is None
+    assert main.ts_to_int(-1) is None
+    assert main.ts_to_int(main.TS_MASK + 1) is None
+    # Соседнее поле в упакованных times не портится
+    record = main.UserRecord({"joined": "2026-02-18 12:00:00", "last_active": "1900-01-01 00:00:00"})
+    assert record.to_dict() == {"joined": "2026-02-18 12:00:00"}
+
+
+@pytest.mark.parametrize("key", ["username", "first_name", "city", "remind_min", "blocked_date"])
+def test_explicit_none_is_kept(key):
+    record = main.UserRecord({"lang": "uz", key: None})
+    assert key in record
+    assert record[key] is None
+    assert record.get(key, "default") is None
+    assert record.to_dict() == {"lang": "uz", key: None}
+    assert row_round_trip(record).to_dict() == {"lang": "uz", key: None}
+
+
+def test_overwriting_explicit_none():
+    record = main.UserRecord({"city": None, "username": None})
+    record["city"] = "tashkent"
+    record["username"] = "ali"
+    assert record.to_dict() == {"city": "tashkent", "username": "ali"}
+    assert record.extra is None
+
+
+def test_packed_fields():
+    record = main.UserRecord(FULL)
+    assert record.first_name == "Мария"
+    assert record.joined == main.ts_to_int(FULL["joined"])
+    assert record.last_active == main.ts_to_int(FULL["last_active"])
+    assert record.push_sent and record.is_blocked
+    
+    record["push_sent"] = False
+    record["last_active"] = "2026-03-05 09:00:00"
+    assert record["push_sent"] is False
+    assert record["last_active"] == "2026-03-05 09:00:00"
+    assert record["joined"] == FULL["joined"]
+
+
+def test_congrats_keep_latest_day():
+    record = main.UserRecord()
+    record["iftar_congrats_sent_2026-02-20"] = True
+    record["iftar_congrats_sent_2026-02-19"] = True
+    assert record.get("iftar_congrats_sent_2026-02-20") is True
+    assert record.get("iftar_congrats_sent_2026-02-19") is None
+    assert record.keys() == ["iftar_congrats_sent_2026-02-20"]
+
+
+def test_malformed_timestamp_is_dropped():
+    assert main.ts_to_int("вчера") is None
+    record = main.UserRecord({"joined": "2026-13-40 99:00:00", "lang": "uz"})
+    assert "joined" not in record
+    assert record.to_dict() == {"lang": "uz"}
+
+
+def test_aware_timestamp_is_converted_to_tashkent():
+    assert main.ts_to_int("2026-02-18T07:00:00+00:00") == main.ts_to_int("2026-02-18 12:00:00")
+    record = main.UserRecord({"last_active": "2026-02-18T08:00:00+01:00"})
+    assert record["last_active"] == "2026-02-18 12:00:00"
+
+
+def test_out_of_range_timestamp_is_dropped():
+    assert main.ts_to_int("1969-12-31 23:59:59") is None
+    assert main.ts_to_int("2107-01-01 00:00:00") is None
+    assert main.ts_to_int(-1) is None
+    assert main.ts_to_int(main.TS_MASK + 1) is None
+    # Соседнее поле в упакованных times не портится
+    record = main.UserRecord({"joined": "2026-02-18 12:00:00", "last_active": "1900-01-01 00:00:00"})
+    assert record.to_dict() == {"joined": "2026-02-18 12:00:00"}
+
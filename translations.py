@@ -33,6 +33,11 @@ TEXTS = {
         "choose_rem": "Hodisadan necha daqiqa oldin eslatilsin?",
         "lang_changed": "✅ Til muvaffaqiyatli o'zgartirildi",
         "city_changed": "✅ Shahar saqlandi. Vaqt yangilandi!",
+        "locate_city_btn": "📍 Joylashuv bo'yicha aniqlash",
+        "locate_btn": "📍 Joylashuvni yuborish",
+        "locate_prompt": "Pastdagi tugma orqali joylashuvingizni yuboring 👇",
+        "location_city": "📍 Eng yaqin shahar: {city} (~{km} km)",
+        "location_too_far": "📍 Yaqin atrofda qo'llab-quvvatlanadigan shahar topilmadi (eng yaqini — {city}, ~{km} km).",
         "remind_changed": "✅ Eslatma sozlandi",
         
         # Времена
@@ -45,6 +50,9 @@ TEXTS = {
         "close_time": "Yopilish",
         "open_time": "Ochilish",
         "suhoor_time_now": "🌅 Saharlik vaqti tugadi!\n\nRo'za boshlandi!",
+        "live_countdown_on": "🔄 Har daqiqada yangilash",
+        "live_countdown_off": "⏹ Yangilashni to'xtatish",
+        "live_countdown_note": "🔄 Har daqiqada yangilanadi",
         
         # Напоминания
         "suhoor_rem_text": "Saharlik tugashiga",
@@ -110,6 +118,11 @@ TEXTS = {
         "choose_rem": "За сколько минут напоминать о событии?",
         "lang_changed": "✅ Язык успешно изменён",
         "city_changed": "✅ Город сохранён. Время обновлено!",
+        "locate_city_btn": "📍 Определить по геолокации",
+        "locate_btn": "📍 Отправить геолокацию",
+        "locate_prompt": "Отправьте геолокацию кнопкой ниже 👇",
+        "location_city": "📍 Ближайший город: {city} (~{km} км)",
+        "location_too_far": "📍 Рядом нет поддерживаемых городов (ближайший — {city}, ~{km} км).",
         "remind_changed": "✅ Напоминание установлено",
         
         # Времена
@@ -122,6 +135,9 @@ TEXTS = {
         "close_time": "Закрытие",
         "open_time": "Открытие",
         "suhoor_time_now": "🌅 Время сухура закончилось!\n\nПост начался!",
+        "live_countdown_on": "🔄 Обновлять каждую минуту",
+        "live_countdown_off": "⏹ Остановить обновление",
+        "live_countdown_note": "🔄 Обновляется каждую минуту",
         
         # Напоминания
         "suhoor_rem_text": "До окончания сухура",